@@ -53,6 +53,9 @@ DEFAULT_INSTALLED_APPS = [
 INSTALLED_APPS = DEFAULT_INSTALLED_APPS + LOCAL_APPS + THIRD_PARTY_APPS
 
 MIDDLEWARE = [
+    'helpers.middlewares.RequestInstrumentationMiddleware',
+    'helpers.middlewares.RequestProfilingMiddleware',
+    'helpers.middlewares.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -60,7 +63,8 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
-    'helpers.middlewares.RestTokenDecoderMiddleware'
+    'helpers.middlewares.RestTokenDecoderMiddleware',
+    'helpers.middlewares.AdmissionControlMiddleware',
 ]
 
 ROOT_URLCONF = 'SignEasy.urls'
@@ -151,6 +155,7 @@ JWT_AUTH = {
     'JWT_AUDIENCE': None,
     'JWT_ISSUER': None,
     'JWT_ALLOW_REFRESH': True,
+    'JWT_REFRESH_EXPIRATION_DELTA': datetime.timedelta(days=30),
     'JWT_AUTH_HEADER_PREFIX': 'Token',
     'JWT_AUTH_COOKIE': None,
 }
@@ -182,6 +187,141 @@ MEDIA_URL = '/media/'
 
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# Reads the files archived in pack files as well (see documents.storage).
+DEFAULT_FILE_STORAGE = 'documents.storage.PackAwareStorage'
+
+# Version packs
+# 'manage.py pack_versions' archives the version and diff files of the document versions older than
+# VERSION_PACK_MIN_AGE_DAYS days (except the files of the current revisions) into pack files of about
+# VERSION_PACK_MAX_BYTES bytes under MEDIA_ROOT/document_packs/.
+VERSION_PACK_MIN_AGE_DAYS = int(os.environ.get('VERSION_PACK_MIN_AGE_DAYS', 180))
+
+VERSION_PACK_MAX_BYTES = 512 * 1024 * 1024
+
+# Document diffs
+# Block size (bytes) of the binary delta used for the non-text documents. Smaller blocks find more matches but
+# produce more copy operations.
+DOCUMENT_DELTA_BLOCK_SIZE = 2048
+
+# The delta is computed on the request path and its scan of the changed regions is pure python (about 1s per MB
+# rolled byte by byte). Once DOCUMENT_DELTA_MAX_SCAN_BYTES bytes have been rolled without a match, the rest of the
+# new revision (up to the common suffix) is stored whole, zlib compressed, instead of being matched.
+DOCUMENT_DELTA_MAX_SCAN_BYTES = 512 * 1024
+
+# Text documents with more lines than DOCUMENT_DIFF_PARALLEL_THRESHOLD (both revisions together) are diffed in a
+# pool of DOCUMENT_DIFF_PARALLELISM processes (defaults to the number of CPUs). Set it to 1 to always diff in the
+# request process.
+DOCUMENT_DIFF_PARALLELISM = int(os.environ.get('DOCUMENT_DIFF_PARALLELISM', 0)) or os.cpu_count()
+
+DOCUMENT_DIFF_PARALLEL_THRESHOLD = 20000
+
+# Diff cache
+# Diffs are cached by (hash of the old revision, hash of the new revision, diff format) in a per process memory
+# LRU and in a disk cache shared by the worker processes (set DIFF_CACHE_DIR to an empty value to disable it).
+DIFF_CACHE_MEMORY_BYTES = 32 * 1024 * 1024
+
+DIFF_CACHE_DIR = os.environ.get('DIFF_CACHE_DIR', '/tmp/signeasy_diff_cache')
+
+DIFF_CACHE_DISK_BYTES = 1024 * 1024 * 1024
+
+DIFF_CACHE_MAX_ENTRY_BYTES = 8 * 1024 * 1024
+
+# Document version partitioning
+# Partition the document versions table by month of created_on (postgresql only) when the migrations run. Run
+# 'manage.py partition_document_versions' daily to create the partitions of the coming months.
+DOCUMENT_VERSION_PARTITIONING = bool(os.environ.get('DOCUMENT_VERSION_PARTITIONING', ''))
+
+# Storage usage
+# Bytes a user can store across the files of the documents they own (documents, versions and diffs). Uploads over
+# the quota are rejected, the quota isn't enforced when it's not set.
+USER_STORAGE_QUOTA_BYTES = int(os.environ.get('USER_STORAGE_QUOTA_BYTES', 0)) or None
+
+# Admission control
+# Token bucket (rate per second, burst) and concurrent requests cap of every client per class of routes (url names),
+# only enforced when ADMISSION_CONTROL_DB is set. The database is shared by the worker processes of the host, keep
+# it on a local disk. Clients are the users of the tokens, anonymous requests (eg. logins) are keyed by IP address.
+# The slot of a request that never finished (eg. killed worker) is reclaimed after ADMISSION_SLOT_TIMEOUT seconds.
+ADMISSION_CONTROL_DB = os.environ.get('ADMISSION_CONTROL_DB', None)
+
+ADMISSION_CONTROL = {
+    'upload': {
+        'routes': ['re-upload-document', 'document-api-list', 'user-import'],
+        'methods': ['POST', 'PATCH'],
+        'rate': 0.5,
+        'burst': 10,
+        'concurrency': 2,
+    },
+    'login': {
+        'routes': ['user-login', 'token-refresh', 'user-registration', 'change-password'],
+        'rate': 0.2,
+        'burst': 10,
+        'concurrency': 2,
+    },
+    'list': {
+        'routes': ['document-api-list', 'document-version', 'document-version-timeline', 'user-api-list',
+                   'user-autocomplete', 'change-feed'],
+        'methods': ['GET'],
+        'rate': 20,
+        'burst': 100,
+        'concurrency': 8,
+    },
+    'events': {
+        'routes': ['document-events'],
+        'methods': ['GET'],
+        'rate': 0.5,
+        'burst': 10,
+        'concurrency': 2,
+    },
+}
+
+ADMISSION_SLOT_TIMEOUT = 600
+
+ADMISSION_CLEANUP_INTERVAL = 60
+
+# Bulk download
+BULK_DOWNLOAD_MAX_FILES = 500
+
+# Events
+# Server-Sent Events of the document changes (/api/v1/events/). EVENTS_BROKER 'local' only pushes the changes made by
+# this process, 'changelog' also polls the change log every EVENTS_POLL_INTERVAL seconds for the changes made by the
+# other worker processes. Every open stream holds a worker thread for at most EVENTS_STREAM_DURATION seconds: the
+# route needs threaded workers (eg. gunicorn --worker-class gthread --threads 32, runserver) and a worker process
+# keeps at most EVENTS_MAX_STREAMS streams open (EVENTS_MAX_STREAMS_PER_USER per user), below its thread count so
+# the other requests always get a thread. The streams over the caps get a 429.
+EVENTS_BROKER = os.environ.get('EVENTS_BROKER', 'changelog')
+
+EVENTS_POLL_INTERVAL = 1
+
+EVENTS_HEARTBEAT = 15
+
+EVENTS_STREAM_DURATION = 300
+
+EVENTS_MAX_STREAMS = 16
+
+EVENTS_MAX_STREAMS_PER_USER = 2
+
+# User import
+# Bulk user import (manage.py import_users and /api/v1/user-import/). Passwords are hashed by
+# USER_IMPORT_HASH_WORKERS processes (cpu count when not set), the API is only open to the usernames in
+# USER_IMPORT_ADMINS (comma separated).
+USER_IMPORT_HASH_WORKERS = int(os.environ.get('USER_IMPORT_HASH_WORKERS', 0)) or None
+
+USER_IMPORT_ADMINS = [name for name in os.environ.get('USER_IMPORT_ADMINS', '').split(',') if name]
+
+# Signed media URLs
+# Version and diff files are downloaded through short lived HMAC signed URLs (SIGNED_MEDIA_URL<file name>).
+# MEDIA_SERVE_MODE hands the file over to the web server: 'x-accel-redirect' (nginx, internal location
+# MEDIA_ACCEL_REDIRECT_PREFIX aliased to MEDIA_ROOT), 'x-sendfile' (apache/lighttpd) or '' to stream it from django.
+SIGNED_MEDIA_URL = '/signed-media/'
+
+SIGNED_MEDIA_KEY = os.environ.get('SIGNED_MEDIA_KEY', SECRET_KEY)
+
+SIGNED_MEDIA_TTL = 300
+
+MEDIA_SERVE_MODE = os.environ.get('MEDIA_SERVE_MODE', '')
+
+MEDIA_ACCEL_REDIRECT_PREFIX = '/protected-media/'
+
 # Swagger
 SWAGGER_SETTINGS = {
     'SECURITY_DEFINITIONS': {
@@ -191,4 +331,42 @@ SWAGGER_SETTINGS = {
             "in": "header"
         },
     }
-}
\ No newline at end of file
+}
+
+# Request instrumentation
+# Adds the Server-Timing header and a JSON log line (logger 'signeasy.requests') to every request.
+REQUEST_INSTRUMENTATION = bool(os.environ.get('REQUEST_INSTRUMENTATION', ''))
+
+# Request profiling
+# Profiles are only collected when REQUEST_PROFILING_DIR is set. A request is profiled when its
+# 'X-Profile-Request' header matches REQUEST_PROFILING_SECRET or when it's sampled by REQUEST_PROFILING_SAMPLE_RATE.
+REQUEST_PROFILING_DIR = os.environ.get('REQUEST_PROFILING_DIR', None)
+
+REQUEST_PROFILING_SECRET = os.environ.get('REQUEST_PROFILING_SECRET', None)
+
+REQUEST_PROFILING_SAMPLE_RATE = float(os.environ.get('REQUEST_PROFILING_SAMPLE_RATE', 0))
+
+# Metrics
+# Directory shared by all the worker processes to exchange metric snapshots. When it's not set '/metrics' only
+# reports the metrics of the worker that serves the scrape.
+METRICS_DIR = os.environ.get('METRICS_DIR', None)
+
+METRICS_FLUSH_INTERVAL = 5
+
+# Logging
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'signeasy.requests': {
+            'handlers': ['console'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+    },
+}
@@ -5,7 +5,7 @@ from django.contrib import admin
 from drf_yasg.views import get_schema_view
 from drf_yasg import openapi
 from rest_framework import permissions
-from django.conf.urls.static import static
+from helpers.views import metrics_view, signed_media_view
 
 from django.conf import LazySettings
 settings = LazySettings()
@@ -27,9 +27,11 @@ apis = [
     url(r'^api/v1/', include("users.urls")),
     url(r'^api/v1/', include("documents.urls")),
 
-] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+]
 
 urlpatterns = apis + [
+    url(r'^metrics$', metrics_view, name='metrics'),
+    url(rf'^{settings.SIGNED_MEDIA_URL.lstrip("/")}(?P<name>.+)$', signed_media_view, name='signed-media'),
     url(r'^swagger(?P<format>\.json|\.yaml)$', schema_view.without_ui(cache_timeout=0), name='schema-json'),
     url(r'^swagger/$', schema_view.with_ui('swagger', cache_timeout=0), name='schema-swagger-ui'),
     url(r'^redoc/$', schema_view.with_ui('redoc', cache_timeout=0), name='schema-redoc'),
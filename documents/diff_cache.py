@@ -0,0 +1,168 @@
+import hashlib
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+
+from helpers import metrics
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as infile:
+        for chunk in iter(lambda: infile.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def make_key(old_path, new_path, diff_format):
+    """
+    Cache key of a diff: (hash of the old revision, hash of the new revision, diff format).
+    """
+    return hashlib.sha256(f"{file_digest(old_path)}:{file_digest(new_path)}:{diff_format}".encode()).hexdigest()
+
+
+class DiffCache:
+    """
+    Two tier cache of diff results, keyed by make_key().
+    The memory tier is a per process LRU bounded by settings.DIFF_CACHE_MEMORY_BYTES. The disk tier lives in
+    settings.DIFF_CACHE_DIR, is shared by every worker process and is trimmed (least recently used first) when it
+    grows over settings.DIFF_CACHE_DISK_BYTES. Disk hits are promoted to the memory tier.
+    Values are (diff format, diff bytes) tuples.
+    """
+
+    scan_interval = 60
+
+    def __init__(self):
+        self.memory = OrderedDict()
+        self.memory_size = 0
+        self.lock = threading.Lock()
+        self.disk_size = None
+        self.last_scan = 0.0
+
+    @property
+    def memory_limit(self):
+        return getattr(settings, "DIFF_CACHE_MEMORY_BYTES", 32 * 1024 * 1024)
+
+    @property
+    def disk_limit(self):
+        return getattr(settings, "DIFF_CACHE_DISK_BYTES", 1024 * 1024 * 1024)
+
+    @property
+    def directory(self):
+        return getattr(settings, "DIFF_CACHE_DIR", None)
+
+    @property
+    def max_entry_size(self):
+        return getattr(settings, "DIFF_CACHE_MAX_ENTRY_BYTES", 8 * 1024 * 1024)
+
+    def get(self, key):
+        with self.lock:
+            value = self.memory.get(key)
+            if value is not None:
+                self.memory.move_to_end(key)
+        if value is not None:
+            metrics.CACHE_REQUESTS.inc(cache="diff", result="hit")
+            return value
+
+        value = self.get_from_disk(key)
+        if value is not None:
+            self.set_in_memory(key, value)
+            metrics.CACHE_REQUESTS.inc(cache="diff", result="hit")
+            return value
+
+        metrics.CACHE_REQUESTS.inc(cache="diff", result="miss")
+        return None
+
+    def set(self, key, diff_format, data):
+        if len(data) > self.max_entry_size:
+            return
+        value = (diff_format, data)
+        self.set_in_memory(key, value)
+        self.set_on_disk(key, value)
+
+    def set_in_memory(self, key, value):
+        size = len(value[1])
+        with self.lock:
+            previous = self.memory.pop(key, None)
+            if previous is not None:
+                self.memory_size -= len(previous[1])
+            self.memory[key] = value
+            self.memory_size += size
+            while self.memory_size > self.memory_limit and self.memory:
+                _, evicted = self.memory.popitem(last=False)
+                self.memory_size -= len(evicted[1])
+
+    def disk_path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get_from_disk(self, key):
+        if not self.directory:
+            return None
+        path = self.disk_path(key)
+        try:
+            with open(path, "rb") as infile:
+                diff_format, data = infile.read().split(b"\n", 1)
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return diff_format.decode(), data
+
+    def set_on_disk(self, key, value):
+        """
+        atomically writing the entry, so a concurrent reader never sees a partial file.
+        """
+        if not self.directory:
+            return
+        path = self.disk_path(key)
+        temp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(temp_path, "wb") as outfile:
+                outfile.write(value[0].encode() + b"\n" + value[1])
+            os.replace(temp_path, path)
+        except OSError:
+            return
+
+        if self.disk_size is not None:
+            self.disk_size += len(value[1])
+        if self.disk_size is None or self.disk_size > self.disk_limit \
+                or time.monotonic() - self.last_scan > self.scan_interval:
+            self.trim_disk()
+
+    def trim_disk(self):
+        """
+        scanning the cache directory and removing the least recently used entries until it's under 90% of the
+        limit.
+        """
+        self.last_scan = time.monotonic()
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for file_name in files:
+                path = os.path.join(root, file_name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        if total > self.disk_limit:
+            entries.sort()
+            for _, size, path in entries:
+                if total <= self.disk_limit * 0.9:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+        self.disk_size = total
+
+
+diff_cache = DiffCache()
@@ -0,0 +1,402 @@
+import difflib
+import hashlib
+import io
+import mimetypes
+import os
+import struct
+import zlib
+
+from django.conf import settings
+
+from documents import diff_cache, hunks, parallel_diff
+
+"""
+Formats of the DocumentVersion.diff_file.
+hunks: changed hunks of the two text revisions as opcodes, line ranges and lines (see documents.hunks)
+ndiff: line by line difflib.Differ output of the two text revisions (diffs written before the hunks format)
+binary: rsync style delta (copy ranges of the old revision + literal data) that rebuilds the new revision
+"""
+DIFF_FORMAT_HUNKS = "hunks"
+DIFF_FORMAT_NDIFF = "ndiff"
+DIFF_FORMAT_BINARY = "binary"
+
+DIFF_FORMAT_CHOICES = (
+    (DIFF_FORMAT_HUNKS, "hunks"),
+    (DIFF_FORMAT_NDIFF, "ndiff"),
+    (DIFF_FORMAT_BINARY, "binary delta"),
+)
+
+"""
+MIME types that are diffed line by line on top of every 'text/*' type.
+"""
+TEXT_MIME_TYPES = {
+    "application/json",
+    "application/xml",
+    "application/javascript",
+    "application/x-sh",
+    "application/x-python-code",
+    "application/sql",
+    "application/x-yaml",
+}
+
+SNIFF_SIZE = 8192
+
+DELTA_MAGIC = b"SEDELTA1"
+DELTA_HEADER = struct.Struct(">QQ32s")
+DELTA_COPY = b"C"
+DELTA_INSERT = b"I"
+DELTA_INSERT_COMPRESSED = b"Z"
+DELTA_RANGE = struct.Struct(">QQ")
+DELTA_LENGTH = struct.Struct(">Q")
+
+ROLLING_MODULUS = 1 << 16
+
+
+def is_text_file(path):
+    """
+    Sniffing the beginning of the file. A file is treated as text when it doesn't contain NUL bytes and
+    decodes as utf-8.
+    """
+    with open(path, "rb") as infile:
+        sample = infile.read(SNIFF_SIZE)
+    if b"\0" in sample:
+        return False
+    try:
+        sample.decode("utf-8")
+    except UnicodeDecodeError as e:
+        """
+        the sample can end in the middle of a multi-byte character.
+        """
+        return e.start >= len(sample) - 3
+    return True
+
+
+def detect_diff_format(file_name, *paths):
+    """
+    Picking the diff format from the MIME type of the document. Documents with an unknown MIME type are sniffed.
+    file_name[string]: name of the document used to guess the MIME type
+    paths[list]: paths of the revisions to sniff when the MIME type is unknown
+    """
+    mime_type, encoding = mimetypes.guess_type(file_name)
+    if encoding is None and mime_type is not None:
+        if mime_type.startswith("text/") or mime_type in TEXT_MIME_TYPES:
+            return DIFF_FORMAT_HUNKS
+        return DIFF_FORMAT_BINARY
+    return DIFF_FORMAT_HUNKS if all(is_text_file(path) for path in paths) else DIFF_FORMAT_BINARY
+
+
+def diff_file_extension(diff_format, file_extension):
+    """
+    hunks diffs are stored as '.hunks', binary deltas as '.delta' and ndiff files keep the extension of the document.
+    """
+    if diff_format == DIFF_FORMAT_HUNKS:
+        return ".hunks"
+    return ".delta" if diff_format == DIFF_FORMAT_BINARY else file_extension
+
+
+def write_diff(diff_format, old_path, new_path, diff_path):
+    """
+    Writing the diff of the two revisions to diff_path. The diff cache is checked first, so diffing the same pair
+    of revisions again (eg. a revert followed by a re-upload) only costs hashing the two files.
+    Returns the format of the written diff.
+    """
+    cache_key = diff_cache.make_key(old_path, new_path, diff_format)
+    cached = diff_cache.diff_cache.get(cache_key)
+    if cached is not None:
+        cached_format, data = cached
+        with open(diff_path, "wb+") as diff_file:
+            diff_file.write(data)
+        return cached_format
+
+    written_format = compute_diff(diff_format, old_path, new_path, diff_path)
+    if os.path.getsize(diff_path) <= diff_cache.diff_cache.max_entry_size:
+        with open(diff_path, "rb") as diff_file:
+            diff_cache.diff_cache.set(cache_key, written_format, diff_file.read())
+    return written_format
+
+
+def compute_diff(diff_format, old_path, new_path, diff_path):
+    """
+    Text documents that turn out not to be decodable are diffed as binary.
+    """
+    if diff_format in (DIFF_FORMAT_HUNKS, DIFF_FORMAT_NDIFF):
+        try:
+            if diff_format == DIFF_FORMAT_HUNKS:
+                write_hunks_diff(old_path, new_path, diff_path)
+            else:
+                write_ndiff(old_path, new_path, diff_path)
+            return diff_format
+        except UnicodeDecodeError:
+            pass
+    write_binary_delta(old_path, new_path, diff_path)
+    return DIFF_FORMAT_BINARY
+
+
+def read_lines(old_path, new_path):
+    with open(old_path, "r") as current_file, open(new_path, "r") as new_file:
+        return current_file.readlines(), new_file.readlines()
+
+
+def write_hunks_diff(old_path, new_path, diff_path):
+    """
+    write only the changed hunks of the two revisions (see documents.hunks).
+    """
+    current_lines, new_lines = read_lines(old_path, new_path)
+    with open(diff_path, "wb+") as diff_file:
+        hunks.write_hunks(diff_file, text_opcodes(current_lines, new_lines), current_lines, new_lines)
+
+
+def hunk_index_name(diff_name):
+    """
+    name of the offset index stored next to a hunks diff
+    """
+    return f"{diff_name}.idx"
+
+
+def write_hunk_index(diff_path, index_path):
+    with open(diff_path, "rb") as diff_file, open(index_path, "wb+") as index_file:
+        hunks.write_index(diff_file, index_file)
+
+
+def text_opcodes(current_lines, new_lines):
+    """
+    difflib.SequenceMatcher opcodes of the two revisions. Very large documents are matched in a process pool (see
+    documents.parallel_diff), the opcodes are the same.
+    """
+    if parallel_diff.should_parallelize(current_lines, new_lines):
+        return parallel_diff.parallel_opcodes(current_lines, new_lines)
+    return difflib.SequenceMatcher(None, current_lines, new_lines).get_opcodes()
+
+
+def write_ndiff(old_path, new_path, diff_path):
+    """
+    check line by line and write the file difference in a new file.
+    """
+    current_lines, new_lines = read_lines(old_path, new_path)
+    with open(diff_path, "w+") as diff_file:
+        diff_file.writelines(ndiff_lines(current_lines, new_lines))
+
+
+def ndiff_lines(current_lines, new_lines):
+    """
+    difflib.Differ output of the two revisions. Very large documents are diffed in a process pool (see
+    documents.parallel_diff), the output is the same.
+    """
+    if parallel_diff.should_parallelize(current_lines, new_lines):
+        return parallel_diff.parallel_ndiff(current_lines, new_lines)
+    return difflib.Differ().compare(current_lines, new_lines)
+
+
+def render_text_diff(diff_format, diff_file, new_file=None, style="unified"):
+    """
+    Rendering the diff of a text document version as text.
+    diff_format[string]: format of the diff file (hunks or ndiff)
+    diff_file[file]: the diff file opened in binary mode
+    new_file[file]: the new revision (the document of the version) opened in binary mode, only read for the
+                    unchanged lines of a hunks diff rendered as ndiff
+    style[string]: 'unified' or 'ndiff'
+    Returns the list of lines, the lines difflib.unified_diff() or difflib.ndiff() give for the two revisions.
+    """
+    if style not in ("unified", "ndiff"):
+        raise ValueError(f"Unknown diff style {style}.")
+    if diff_format == DIFF_FORMAT_HUNKS:
+        if style == "unified":
+            return list(hunks.render_unified(diff_file))
+        if new_file is None:
+            raise ValueError("The new revision is needed to render the diff as ndiff.")
+        return list(hunks.render_ndiff(diff_file, text_lines(new_file)))
+    if diff_format == DIFF_FORMAT_NDIFF:
+        ndiff = text_lines(diff_file)
+        if style == "ndiff":
+            return ndiff
+        return list(difflib.unified_diff(list(difflib.restore(ndiff, 1)), list(difflib.restore(ndiff, 2))))
+    raise ValueError(f"{diff_format} diffs can't be rendered as text.")
+
+
+def text_lines(infile):
+    """
+    lines of a file opened in binary mode, decoded like read_lines() decodes the revisions.
+    """
+    return io.TextIOWrapper(io.BytesIO(infile.read())).readlines()
+
+
+def write_binary_delta(old_path, new_path, diff_path):
+    with open(old_path, "rb") as current_file, open(new_path, "rb") as new_file:
+        old, new = current_file.read(), new_file.read()
+    with open(diff_path, "wb+") as diff_file:
+        diff_file.write(binary_delta(old, new))
+
+
+def rolling_checksum(window):
+    """
+    rsync weak checksum of a window. a is the sum of the bytes, b the sum of the bytes weighted by their distance
+    from the end of the window, both modulo 2^16.
+    """
+    size = len(window)
+    a = sum(window) % ROLLING_MODULUS
+    b = sum((size - index) * byte for index, byte in enumerate(window)) % ROLLING_MODULUS
+    return a, b
+
+
+def binary_delta(old, new, block_size=None, max_scan=None):
+    """
+    rsync style delta of two byte strings.
+    The old revision is indexed by the weak checksum of its block aligned blocks. The new revision is scanned with
+    a rolling checksum. Every window whose checksum and bytes match an old block becomes a copy of that block (and
+    the match is extended block by block), the bytes between matches become literal inserts.
+    The scan jumps a whole block after every match, so unchanged regions cost one lookup per block and only the
+    changed regions are rolled byte by byte. The common prefix and suffix of the two revisions are copied without
+    being scanned at all. Once max_scan bytes (settings.DOCUMENT_DELTA_MAX_SCAN_BYTES) have been rolled without a
+    match the scan stops and the rest of the changed bytes are stored whole, so a large rewrite doesn't hold the
+    request for seconds.
+    """
+    block_size = block_size or getattr(settings, "DOCUMENT_DELTA_BLOCK_SIZE", 2048)
+    if max_scan is None:
+        max_scan = getattr(settings, "DOCUMENT_DELTA_MAX_SCAN_BYTES", 512 * 1024)
+    operations = []
+
+    def add_copy(offset, length):
+        if operations and operations[-1][0] == DELTA_COPY and sum(operations[-1][1]) == offset:
+            operations[-1] = (DELTA_COPY, (operations[-1][1][0], operations[-1][1][1] + length))
+        else:
+            operations.append((DELTA_COPY, (offset, length)))
+
+    def add_insert(data):
+        if data:
+            operations.append((DELTA_INSERT, data))
+
+    prefix = common_prefix_length(old, new)
+    suffix = common_suffix_length(old[prefix:], new[prefix:])
+    if prefix:
+        add_copy(0, prefix)
+
+    blocks = {}
+    for offset in range(0, len(old) - block_size + 1, block_size):
+        a, b = rolling_checksum(old[offset:offset + block_size])
+        blocks.setdefault(a | (b << 16), []).append(offset)
+
+    position, literal_start, new_size = prefix, prefix, len(new) - suffix
+    rolled = 0
+    if blocks and new_size >= block_size:
+        a, b = rolling_checksum(new[position:position + block_size])
+        while position + block_size <= new_size and rolled <= max_scan:
+            match = None
+            candidates = blocks.get(a | (b << 16))
+            if candidates:
+                window = new[position:position + block_size]
+                for offset in candidates:
+                    if old[offset:offset + block_size] == window:
+                        match = offset
+                        break
+
+            if match is None:
+                if position + block_size < new_size:
+                    outgoing, incoming = new[position], new[position + block_size]
+                    a = (a - outgoing + incoming) % ROLLING_MODULUS
+                    b = (b - block_size * outgoing + a) % ROLLING_MODULUS
+                position += 1
+                rolled += 1
+                continue
+
+            add_insert(new[literal_start:position])
+            length = block_size
+            while match + length + block_size <= len(old) and position + length + block_size <= new_size \
+                    and old[match + length:match + length + block_size] == new[position + length:
+                                                                                position + length + block_size]:
+                length += block_size
+            add_copy(match, length)
+            position += length
+            literal_start = position
+            if position + block_size <= new_size:
+                a, b = rolling_checksum(new[position:position + block_size])
+
+    add_insert(new[literal_start:new_size])
+    if suffix:
+        add_copy(len(old) - suffix, suffix)
+    return encode_delta(len(old), new, operations)
+
+
+def common_prefix_length(first, second, chunk_size=4096):
+    """
+    length of the common prefix of two byte strings, compared chunk by chunk.
+    """
+    limit, length = min(len(first), len(second)), 0
+    while length < limit and first[length:length + chunk_size] == second[length:length + chunk_size]:
+        length += chunk_size
+    length = min(length, limit)
+    while length < limit and first[length] == second[length]:
+        length += 1
+    return length
+
+
+def common_suffix_length(first, second, chunk_size=4096):
+    """
+    length of the common suffix of two byte strings, compared chunk by chunk.
+    """
+    limit, length = min(len(first), len(second)), 0
+    while length < limit and first[max(len(first) - length - chunk_size, 0):len(first) - length] == \
+            second[max(len(second) - length - chunk_size, 0):len(second) - length]:
+        length += chunk_size
+    length = min(length, limit)
+    while length < limit and first[len(first) - length - 1] == second[len(second) - length - 1]:
+        length += 1
+    return length
+
+
+def encode_delta(old_size, new, operations):
+    """
+    Delta layout: magic, (old size, new size, sha256 of the new revision) and then the operations.
+    C<offset><length>: copy a range of the old revision
+    I<length><data>: insert literal data
+    Z<length><data>: insert zlib compressed literal data (used when compression pays off)
+    """
+    chunks = [DELTA_MAGIC, DELTA_HEADER.pack(old_size, len(new), hashlib.sha256(new).digest())]
+    for operation, value in operations:
+        if operation == DELTA_COPY:
+            chunks.append(DELTA_COPY + DELTA_RANGE.pack(*value))
+            continue
+        compressed = zlib.compress(value)
+        if len(compressed) < len(value):
+            chunks.append(DELTA_INSERT_COMPRESSED + DELTA_LENGTH.pack(len(compressed)) + compressed)
+        else:
+            chunks.append(DELTA_INSERT + DELTA_LENGTH.pack(len(value)) + value)
+    return b"".join(chunks)
+
+
+def apply_binary_delta(old, delta):
+    """
+    Rebuilding the new revision from the old revision and a delta created by binary_delta().
+    Raises ValueError if the delta is corrupt (or truncated) or doesn't belong to the old revision.
+    """
+    if not delta.startswith(DELTA_MAGIC):
+        raise ValueError("Not a document delta.")
+    position = len(DELTA_MAGIC)
+    try:
+        old_size, new_size, checksum = DELTA_HEADER.unpack_from(delta, position)
+        position += DELTA_HEADER.size
+        if old_size != len(old):
+            raise ValueError("Delta doesn't belong to this revision.")
+
+        chunks = []
+        while position < len(delta):
+            operation = delta[position:position + 1]
+            position += 1
+            if operation == DELTA_COPY:
+                offset, length = DELTA_RANGE.unpack_from(delta, position)
+                position += DELTA_RANGE.size
+                chunks.append(old[offset:offset + length])
+            elif operation in (DELTA_INSERT, DELTA_INSERT_COMPRESSED):
+                length, = DELTA_LENGTH.unpack_from(delta, position)
+                position += DELTA_LENGTH.size
+                data = delta[position:position + length]
+                position += length
+                chunks.append(zlib.decompress(data) if operation == DELTA_INSERT_COMPRESSED else data)
+            else:
+                raise ValueError("Corrupt document delta.")
+    except (struct.error, zlib.error):
+        raise ValueError("Corrupt document delta.")
+
+    new = b"".join(chunks)
+    if len(new) != new_size or hashlib.sha256(new).digest() != checksum:
+        raise ValueError("Delta checksum mismatch.")
+    return new
@@ -0,0 +1,174 @@
+import json
+import threading
+import time
+
+from django.conf import settings
+from django.db import close_old_connections, connection
+
+"""
+Server-Sent Events of the document changes.
+
+Events are the entries of the change log (documents.models.ChangeLogEntry), the id of an event is the id of its
+entry so a client reconnecting with the Last-Event-ID header gets every event it missed from the log. The brokers
+below only wake up the open streams when there are new entries, the streams then read the entries from the log.
+
+local: woken up when a change is committed by this process. Enough for a single worker process.
+changelog: also polls the change log every settings.EVENTS_POLL_INTERVAL seconds (one query per process, whatever
+           the number of streams), so changes made by other worker processes are pushed as well.
+"""
+
+
+class LocalBroker:
+    """
+    In process notification of new change log entries.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.sequence = 0
+
+    def notify(self):
+        with self.condition:
+            self.sequence += 1
+            self.condition.notify_all()
+
+    def wait(self, sequence, timeout):
+        """
+        Blocking until notify() is called after 'sequence' was read (or the timeout).
+        Returns the current sequence.
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.sequence != sequence, timeout)
+            return self.sequence
+
+
+class ChangeLogBroker(LocalBroker):
+    """
+    LocalBroker that also tails the change log from a daemon thread, started with the first stream.
+    """
+
+    def __init__(self, poll_interval):
+        super(ChangeLogBroker, self).__init__()
+        self.poll_interval = poll_interval
+        self.last_id = None
+        self.thread = None
+        self.thread_lock = threading.Lock()
+
+    def start(self):
+        with self.thread_lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.poll, name="changelog-broker", daemon=True)
+                self.thread.start()
+
+    def poll(self):
+        from documents.models import ChangeLogEntry
+
+        while True:
+            try:
+                last_id = ChangeLogEntry.objects.order_by("-id").values_list("id", flat=True).first()
+                if self.last_id is not None and last_id != self.last_id:
+                    self.notify()
+                self.last_id = last_id
+            except Exception:
+                close_old_connections()
+            time.sleep(self.poll_interval)
+
+    def wait(self, sequence, timeout):
+        self.start()
+        return super(ChangeLogBroker, self).wait(sequence, timeout)
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    global _broker
+    with _broker_lock:
+        if _broker is None:
+            if getattr(settings, "EVENTS_BROKER", "changelog") == "local":
+                _broker = LocalBroker()
+            else:
+                _broker = ChangeLogBroker(getattr(settings, "EVENTS_POLL_INTERVAL", 1))
+        return _broker
+
+
+def notify():
+    get_broker().notify()
+
+
+class StreamSlots:
+    """
+    Event streams open in this process, capped per user (settings.EVENTS_MAX_STREAMS_PER_USER) and in total
+    (settings.EVENTS_MAX_STREAMS) since every stream holds a worker thread for up to EVENTS_STREAM_DURATION seconds.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.streams = {}
+
+    def acquire(self, user_id):
+        with self.lock:
+            if sum(self.streams.values()) >= getattr(settings, "EVENTS_MAX_STREAMS", 16) or \
+                    self.streams.get(user_id, 0) >= getattr(settings, "EVENTS_MAX_STREAMS_PER_USER", 2):
+                return False
+            self.streams[user_id] = self.streams.get(user_id, 0) + 1
+            return True
+
+    def release(self, user_id):
+        with self.lock:
+            self.streams[user_id] -= 1
+            if not self.streams[user_id]:
+                del self.streams[user_id]
+
+
+stream_slots = StreamSlots()
+
+
+def format_event(entry):
+    data = json.dumps({"document_id": entry.document_id, "kind": entry.kind, "payload": entry.payload,
+                       "created_on": entry.created_on.isoformat()}, separators=(",", ":"))
+    return f"id: {entry.id}\nevent: {entry.kind}\ndata: {data}\n\n"
+
+
+def event_stream(last_id, document_ids=None, kinds=None, batch_size=100):
+    """
+    Generator of the Server-Sent Events after the change log entry 'last_id'.
+    document_ids[set]: only the events of these documents
+    kinds[set]: only these kinds of events
+    The stream ends after settings.EVENTS_STREAM_DURATION seconds, the client reconnects with the id of the last
+    event it got (EventSource does it automatically), so a worker thread isn't held forever. A comment is sent
+    every settings.EVENTS_HEARTBEAT seconds without events to keep proxies from closing the connection.
+    """
+    from documents.models import ChangeLogEntry
+
+    broker = get_broker()
+    heartbeat = getattr(settings, "EVENTS_HEARTBEAT", 15)
+    deadline = time.monotonic() + getattr(settings, "EVENTS_STREAM_DURATION", 300)
+
+    yield f"retry: {getattr(settings, 'EVENTS_RETRY_MS', 3000)}\n\n"
+    while time.monotonic() < deadline:
+        sequence = broker.sequence
+        """
+        the entries are committed in id order (see ChangeLogEntry.record_many), no entry below last_id can show up
+        after it was read.
+        """
+        entries = ChangeLogEntry.objects.filter(id__gt=last_id).order_by("id")
+        if document_ids:
+            entries = entries.filter(document_id__in=document_ids)
+        if kinds:
+            entries = entries.filter(kind__in=kinds)
+        entries = list(entries[:batch_size])
+        """
+        not holding a database connection while waiting.
+        """
+        connection.close()
+
+        for entry in entries:
+            last_id = entry.id
+            yield format_event(entry)
+        if len(entries) == batch_size:
+            continue
+
+        if broker.wait(sequence, min(heartbeat, max(deadline - time.monotonic(), 0))) == sequence:
+            yield ": keepalive\n\n"
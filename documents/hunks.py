@@ -0,0 +1,211 @@
+import difflib
+import json
+import struct
+
+"""
+Compact diff format of text documents ('hunks').
+
+Only the changed regions of the two revisions are stored, as hunks of difflib opcodes with their line ranges and
+the lines they touch, surrounded by a few lines of context (like a unified diff). The file is newline delimited
+JSON: a header line followed by one line per hunk.
+
+    {"format":"hunks","version":1,"context":3,"old_lines":120,"new_lines":121,"hunks":2}
+    {"old":[10,16],"new":[10,17],"ops":[["equal",10,13,10,13,[...]],["insert",13,13,13,14,[...]],...]}
+
+ops: [tag, old start, old end, new start, new end, lines...]. 'equal' and 'delete' ops carry the old lines,
+'insert' ops the new lines and 'replace' ops both (old lines, new lines).
+The unified diff is rendered from the hunks alone, the full ndiff also needs the new revision for the unchanged
+lines between the hunks.
+
+Every hunks diff has an offset index stored next to it ('<diff file>.idx'): the big endian uint64 offsets of the
+hunk lines in the diff file followed by the size of the file, so any range of hunks is read with two seeks.
+"""
+HUNKS_FORMAT_VERSION = 1
+DEFAULT_CONTEXT = 3
+INDEX_ENTRY = struct.Struct(">Q")
+
+
+def group_opcodes(opcodes, context=DEFAULT_CONTEXT):
+    """
+    Same groups as difflib.SequenceMatcher.get_grouped_opcodes(), for opcodes computed elsewhere (eg. by
+    documents.parallel_diff). Revisions without changes give no group at all.
+    """
+    opcodes = list(opcodes)
+    if not any(tag != "equal" for tag, *_ in opcodes):
+        return []
+    if opcodes[0][0] == "equal":
+        tag, i1, i2, j1, j2 = opcodes[0]
+        opcodes[0] = tag, max(i1, i2 - context), i2, max(j1, j2 - context), j2
+    if opcodes[-1][0] == "equal":
+        tag, i1, i2, j1, j2 = opcodes[-1]
+        opcodes[-1] = tag, i1, min(i2, i1 + context), j1, min(j2, j1 + context)
+
+    groups, group = [], []
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag == "equal" and i2 - i1 > context * 2:
+            group.append((tag, i1, min(i2, i1 + context), j1, min(j2, j1 + context)))
+            groups.append(group)
+            group = []
+            i1, j1 = max(i1, i2 - context), max(j1, j2 - context)
+        group.append((tag, i1, i2, j1, j2))
+    if group and not (len(group) == 1 and group[0][0] == "equal"):
+        groups.append(group)
+    return groups
+
+
+def build_hunk(group, current_lines, new_lines):
+    ops = []
+    for tag, i1, i2, j1, j2 in group:
+        if tag == "insert":
+            ops.append([tag, i1, i2, j1, j2, new_lines[j1:j2]])
+        elif tag == "replace":
+            ops.append([tag, i1, i2, j1, j2, current_lines[i1:i2], new_lines[j1:j2]])
+        else:
+            ops.append([tag, i1, i2, j1, j2, current_lines[i1:i2]])
+    return {"old": [group[0][1], group[-1][2]], "new": [group[0][3], group[-1][4]], "ops": ops}
+
+
+def encode_line(record):
+    return (json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+
+
+def write_hunks(outfile, opcodes, current_lines, new_lines, context=DEFAULT_CONTEXT):
+    """
+    Writing the hunks diff of the two revisions to a binary file object.
+    opcodes[list]: difflib opcodes of current_lines -> new_lines
+    """
+    groups = group_opcodes(opcodes, context)
+    header = {"format": "hunks", "version": HUNKS_FORMAT_VERSION, "context": context,
+              "old_lines": len(current_lines), "new_lines": len(new_lines), "hunks": len(groups)}
+    outfile.write(encode_line(header))
+    for group in groups:
+        outfile.write(encode_line(build_hunk(group, current_lines, new_lines)))
+
+
+def read_hunks(infile):
+    """
+    Reading a hunks diff from a binary file object.
+    Returns the header and an iterator over the hunks.
+    Raises ValueError if the file isn't a hunks diff.
+    """
+    header = json.loads(infile.readline() or b"{}")
+    if header.get("format") != "hunks":
+        raise ValueError("Not a hunks diff.")
+    if header.get("version") != HUNKS_FORMAT_VERSION:
+        raise ValueError(f"Unsupported hunks diff version {header.get('version')}.")
+    """
+    readline() and not iterating the file: iterating a django File restarts from the start of the file.
+    """
+    return header, (json.loads(line) for line in iter(infile.readline, b""))
+
+
+def write_index(diff_file, index_file):
+    """
+    Writing the offset index of a hunks diff by scanning the lines of the diff file (both binary file objects).
+    """
+    position = len(diff_file.readline())
+    for line in iter(diff_file.readline, b""):
+        index_file.write(INDEX_ENTRY.pack(position))
+        position += len(line)
+    index_file.write(INDEX_ENTRY.pack(position))
+
+
+class HunkSequence:
+    """
+    Read only sequence of the hunks of a diff backed by its offset index. Slicing it only reads the index entries
+    and the hunk lines of the slice, so it can be handed to a paginator without loading the whole diff.
+    diff_file[file]: binary file object of the hunks diff
+    index_file[file]: binary file object of its offset index
+    """
+
+    def __init__(self, diff_file, index_file):
+        self.diff_file = diff_file
+        self.index_file = index_file
+        self.index_file.seek(0, 2)
+        self.length = max(self.index_file.tell() // INDEX_ENTRY.size - 1, 0)
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, item):
+        if not isinstance(item, slice):
+            if item < 0:
+                item += self.length
+            hunks = self[item:item + 1] if item >= 0 else []
+            if not hunks:
+                raise IndexError("hunk index out of range")
+            return hunks[0]
+        start, stop, step = item.indices(self.length)
+        if step != 1:
+            raise ValueError("Hunks can only be sliced with a step of 1.")
+        if start >= stop:
+            return []
+
+        self.index_file.seek(start * INDEX_ENTRY.size)
+        offsets = [INDEX_ENTRY.unpack(self.index_file.read(INDEX_ENTRY.size))[0] for _ in range(stop - start + 1)]
+        self.diff_file.seek(offsets[0])
+        data = self.diff_file.read(offsets[-1] - offsets[0])
+        return [json.loads(data[begin - offsets[0]:end - offsets[0]]) for begin, end in zip(offsets, offsets[1:])]
+
+
+def format_range(start, stop):
+    """
+    unified diff range, as written by difflib.unified_diff()
+    """
+    length = stop - start
+    if length == 1:
+        return f"{start + 1}"
+    return f"{start + 1 if length else start},{length}"
+
+
+def render_unified(infile, fromfile="", tofile=""):
+    """
+    Rendering a hunks diff as unified diff lines, the same lines difflib.unified_diff() gives for the two
+    revisions with the context the diff was written with.
+    """
+    header, hunks = read_hunks(infile)
+    started = False
+    for hunk in hunks:
+        if not started:
+            started = True
+            yield f"--- {fromfile}\n"
+            yield f"+++ {tofile}\n"
+        yield f"@@ -{format_range(*hunk['old'])} +{format_range(*hunk['new'])} @@\n"
+        for tag, i1, i2, j1, j2, *lines in hunk["ops"]:
+            if tag == "equal":
+                yield from (" " + line for line in lines[0])
+            elif tag == "delete":
+                yield from ("-" + line for line in lines[0])
+            elif tag == "insert":
+                yield from ("+" + line for line in lines[0])
+            else:
+                yield from ("-" + line for line in lines[0])
+                yield from ("+" + line for line in lines[1])
+
+
+def render_ndiff(infile, new_lines):
+    """
+    Rendering a hunks diff as the full difflib.Differ (ndiff) output of the two revisions. The unchanged lines
+    between the hunks are taken from the new revision.
+    new_lines[list]: lines of the new revision
+    Raises ValueError if new_lines aren't the lines the diff was written with.
+    """
+    header, hunks = read_hunks(infile)
+    if header["new_lines"] != len(new_lines):
+        raise ValueError("The diff doesn't belong to this revision.")
+
+    differ = difflib.Differ()
+    position = 0
+    for hunk in hunks:
+        yield from differ._dump(" ", new_lines, position, hunk["new"][0])
+        for tag, i1, i2, j1, j2, *lines in hunk["ops"]:
+            if tag == "equal":
+                yield from ("  " + line for line in lines[0])
+            elif tag == "delete":
+                yield from ("- " + line for line in lines[0])
+            elif tag == "insert":
+                yield from ("+ " + line for line in lines[0])
+            else:
+                yield from differ._fancy_replace(lines[0], 0, len(lines[0]), lines[1], 0, len(lines[1]))
+        position = hunk["new"][1]
+    yield from differ._dump(" ", new_lines, position, len(new_lines))
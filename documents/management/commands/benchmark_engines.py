@@ -0,0 +1,209 @@
+import filecmp
+import os
+import random
+import shutil
+import tempfile
+
+from django.core.files.base import File
+from django.core.files.storage import FileSystemStorage
+from django.core.management.base import BaseCommand, CommandError
+
+from documents import diffing
+from helpers.benchmarking import measure, compare_results, environment_info, write_results, load_results
+
+WORDS = ("agreement", "party", "clause", "signature", "witness", "term", "payment", "notice", "schedule",
+         "liability", "confidential", "renewal", "effective", "date", "hereby", "shall", "section", "annex")
+
+"""
+Stages of UploadEditedDocumentView.patch measured for every corpus case, in the order they run in the view.
+temp_write: writing the uploaded revision to a temporary file
+compare: filecmp.cmp of the two revisions
+diff_<format>: writing the diff (without the diff cache), text cases are diffed with every text format
+hunk_index: writing the offset index of the hunks diff
+storage_save: saving the diff through the file system storage
+"""
+STAGES = ("temp_write", "compare", "diff_hunks", "diff_ndiff", "diff_binary", "hunk_index", "storage_save")
+
+KIND_TEXT = "text"
+KIND_BINARY = "binary"
+
+
+def parse_size(value):
+    units = {"k": 1024, "m": 1024 * 1024}
+    value = value.strip().lower()
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+class Command(BaseCommand):
+    help = "Time the file operations of a document re-upload (temporary write, compare, diff, diff index and " \
+           "storage) over a synthetic corpus of text and binary revisions of several sizes and edit densities. " \
+           "Results are written as JSON and can be compared with a previous run to catch regressions."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", default="16k,256k,1m", help="comma separated revision sizes (k/m suffixes)")
+        parser.add_argument("--densities", default="0.001,0.01,0.1",
+                            help="comma separated fractions of the lines (text) or bytes (binary) edited")
+        parser.add_argument("--kinds", default="text,binary", help="comma separated content kinds (text, binary)")
+        parser.add_argument("--stages", default=",".join(STAGES), help="comma separated stages to measure")
+        parser.add_argument("--repeat", type=int, default=5, help="timed runs of every stage")
+        parser.add_argument("--seed", type=int, default=0, help="random seed of the corpus")
+        parser.add_argument("--output", default="-", help="path of the JSON result file ('-' for stdout)")
+        parser.add_argument("--baseline", help="JSON result file of a previous run to compare with")
+        parser.add_argument("--threshold", type=float, default=0.2,
+                            help="relative increase over the baseline reported as a regression (0.2 = +20%%)")
+        parser.add_argument("--min-ms", type=float, default=1.0,
+                            help="timing increases below this many milliseconds are not regressions")
+
+    def handle(self, *args, **options):
+        try:
+            sizes = [parse_size(size) for size in options["sizes"].split(",") if size.strip()]
+            densities = [float(density) for density in options["densities"].split(",") if density.strip()]
+        except ValueError:
+            raise CommandError("Invalid --sizes or --densities.")
+        kinds = [kind for kind in options["kinds"].split(",") if kind]
+        stages = [stage for stage in options["stages"].split(",") if stage]
+        for name, values, choices in (("kind", kinds, (KIND_TEXT, KIND_BINARY)), ("stage", stages, STAGES)):
+            unknown = set(values) - set(choices)
+            if unknown:
+                raise CommandError(f"Unknown {name} '{', '.join(sorted(unknown))}'. "
+                                   f"Choose from {', '.join(choices)}.")
+
+        self.random = random.Random(options["seed"])
+        self.workdir = tempfile.mkdtemp(prefix="benchmark_engines_")
+        cases = {}
+        try:
+            for kind in kinds:
+                for size in sizes:
+                    for density in densities:
+                        old, new = self.make_revisions(kind, size, density)
+                        for stage, summary in self.run_case(kind, old, new, stages, options["repeat"]):
+                            summary.update(kind=kind, size=size, density=density, stage=stage)
+                            cases[f"{kind}-{size}-{density}/{stage}"] = summary
+                            self.stderr.write(f"{kind:6} {size:>9} {density:<6} {stage:12} "
+                                              f"p50 {summary['p50_ms']:>10.3f}ms "
+                                              f"peak {summary['peak_memory_bytes']:>11} bytes")
+        finally:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
+        results = {
+            "benchmark": "benchmark_engines",
+            "environment": environment_info(),
+            "parameters": {
+                "sizes": sizes,
+                "densities": densities,
+                "kinds": kinds,
+                "stages": stages,
+                "repeat": options["repeat"],
+                "seed": options["seed"],
+            },
+            "cases": cases,
+        }
+        regressions = []
+        if options["baseline"]:
+            results["comparison"] = compare_results(load_results(options["baseline"]), results,
+                                                    options["threshold"], options["min_ms"])
+            regressions = [row for row in results["comparison"] if row["regression"]]
+        write_results(options["output"], results)
+
+        for row in regressions:
+            self.stderr.write(f"REGRESSION {row['case']} {row['metric']}: {row['baseline']} -> {row['current']} "
+                              f"({row['change']:+.1%})")
+        if regressions:
+            raise CommandError(f"{len(regressions)} regressions over {options['threshold']:.0%} of the baseline.")
+
+    # Corpus
+
+    def make_revisions(self, kind, size, density):
+        """
+        the old revision of about 'size' bytes and a new revision with 'density' of it edited.
+        """
+        if kind == KIND_TEXT:
+            lines, total = [], 0
+            while total < size:
+                line = " ".join(self.random.choices(WORDS, k=self.random.randint(4, 14))) + ".\n"
+                lines.append(line)
+                total += len(line)
+            edited = list(lines)
+            for _ in range(max(int(len(lines) * density), 1)):
+                position = self.random.randrange(len(edited))
+                action = self.random.choice(("replace", "insert", "delete"))
+                new_line = " ".join(self.random.choices(WORDS, k=self.random.randint(4, 14))) + ".\n"
+                if action == "replace":
+                    edited[position] = new_line
+                elif action == "insert":
+                    edited.insert(position, new_line)
+                elif len(edited) > 1:
+                    del edited[position]
+            return "".join(lines).encode(), "".join(edited).encode()
+
+        old = self.random_bytes(size)
+        edited = bytearray(old)
+        """
+        edits of 64 bytes blocks spread over the file, like the changes of a re-saved pdf.
+        """
+        for _ in range(max(int(size * density / 64), 1)):
+            position = self.random.randrange(max(len(edited) - 64, 1))
+            edited[position:position + 64] = self.random_bytes(64)
+        return old, bytes(edited)
+
+    def random_bytes(self, size):
+        return self.random.getrandbits(size * 8).to_bytes(size, "little") if size else b""
+
+    # Stages
+
+    def run_case(self, kind, old, new, stages, repeat):
+        """
+        Measuring the stages of one pair of revisions, every stage runs on the output of the previous ones.
+        Yields (stage, summary).
+        """
+        old_path = os.path.join(self.workdir, "old")
+        new_path = os.path.join(self.workdir, "new")
+        with open(old_path, "wb") as outfile:
+            outfile.write(old)
+
+        def temp_write():
+            with open(new_path, "wb+") as outfile:
+                outfile.write(new)
+
+        temp_write()
+        if "temp_write" in stages:
+            yield "temp_write", measure(temp_write, repeat)
+
+        def compare():
+            """
+            filecmp caches the result by the stat of the files.
+            """
+            filecmp.clear_cache()
+            filecmp.cmp(old_path, new_path, shallow=False)
+
+        if "compare" in stages:
+            yield "compare", measure(compare, repeat)
+
+        formats = (diffing.DIFF_FORMAT_HUNKS, diffing.DIFF_FORMAT_NDIFF) if kind == KIND_TEXT \
+            else (diffing.DIFF_FORMAT_BINARY,)
+        diff_paths = {}
+        for diff_format in formats:
+            diff_path = os.path.join(self.workdir, f"diff_{diff_format}")
+            diff_paths[diff_format] = diff_path
+            if f"diff_{diff_format}" in stages:
+                yield f"diff_{diff_format}", measure(
+                    lambda: diffing.compute_diff(diff_format, old_path, new_path, diff_path), repeat)
+            else:
+                diffing.compute_diff(diff_format, old_path, new_path, diff_path)
+
+        hunks_path = diff_paths.get(diffing.DIFF_FORMAT_HUNKS)
+        if hunks_path and "hunk_index" in stages:
+            yield "hunk_index", measure(
+                lambda: diffing.write_hunk_index(hunks_path, diffing.hunk_index_name(hunks_path)), repeat)
+
+        if "storage_save" in stages:
+            storage = FileSystemStorage(location=os.path.join(self.workdir, "storage"))
+            diff_path = diff_paths[formats[0]]
+
+            def storage_save():
+                with open(diff_path, "rb") as infile:
+                    storage.delete(storage.save("document_diff_files/diff", File(infile)))
+
+            yield "storage_save", measure(storage_save, repeat)
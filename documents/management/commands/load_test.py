@@ -0,0 +1,310 @@
+import random
+import time
+import uuid
+from collections import defaultdict
+
+from django.contrib.auth.hashers import make_password
+from django.core.files.base import ContentFile
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.client import encode_multipart, BOUNDARY, MULTIPART_CONTENT
+from django.test.utils import CaptureQueriesContext
+
+from documents.models import Document, DocumentVersion
+from helpers.benchmarking import summarize_latencies, environment_info, write_results
+from users.models import User
+
+WORDS = ("agreement", "party", "clause", "signature", "witness", "term", "payment", "notice", "schedule",
+         "liability", "confidential", "renewal", "effective", "date", "hereby", "shall", "section", "annex")
+
+"""
+Relative weight of every operation in the replayed workload. 'edit' is a fetch_document followed by a
+reupload_document of the same document, 'collaborate' is an add_document_collaborator followed by a
+remove_document_collaborator and 'create' is a document create followed by its delete.
+"""
+DEFAULT_MIX = {
+    "login": 5,
+    "user_list": 5,
+    "user_retrieve": 5,
+    "document_list": 25,
+    "document_retrieve": 15,
+    "document_version_list": 10,
+    "edit": 20,
+    "collaborate": 10,
+    "create": 5,
+}
+
+
+class Command(BaseCommand):
+    help = "Seed a dataset and replay a mixed API workload against it, reporting latency percentiles, " \
+           "throughput and queries per request. Run it against a disposable database only."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=10)
+        parser.add_argument("--documents", type=int, default=50, help="total number of seeded documents")
+        parser.add_argument("--versions", type=int, default=3, help="versions per seeded document")
+        parser.add_argument("--file-size", type=int, default=16 * 1024, help="average document size in bytes")
+        parser.add_argument("--collaborators", type=int, default=3, help="collaborators per seeded document")
+        parser.add_argument("--requests", type=int, default=1000, help="number of workload operations")
+        parser.add_argument("--mix", default="",
+                            help="comma separated operation weights, eg. 'document_list=50,edit=10'")
+        parser.add_argument("--seed", type=int, default=0, help="random seed for the dataset and workload")
+        parser.add_argument("--output", default="-", help="path of the JSON result file ('-' for stdout)")
+        parser.add_argument("--keep-data", action="store_true", help="do not remove the seeded dataset")
+
+    def handle(self, *args, **options):
+        self.random = random.Random(options["seed"])
+        self.mix = self.parse_mix(options["mix"])
+        self.file_size = options["file_size"]
+        self.password = "loadtest-password"
+        self.run_id = uuid.uuid4().hex[:8]
+        self.client = Client()
+        self.samples = defaultdict(list)
+        self.queries = defaultdict(list)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+
+        seed_started = time.perf_counter()
+        self.seed(options["users"], options["documents"], options["versions"], options["collaborators"])
+        seed_duration = time.perf_counter() - seed_started
+        self.stderr.write(f"Seeded {len(self.users)} users and {len(self.documents)} documents "
+                          f"in {seed_duration:.2f}s")
+
+        try:
+            run_started = time.perf_counter()
+            operations = list(self.mix)
+            weights = [self.mix[operation] for operation in operations]
+            for _ in range(options["requests"]):
+                operation = self.random.choices(operations, weights)[0]
+                getattr(self, f"op_{operation}")()
+            run_duration = time.perf_counter() - run_started
+        finally:
+            if not options["keep_data"]:
+                self.cleanup()
+
+        write_results(options["output"], self.build_results(options, seed_duration, run_duration))
+
+    def parse_mix(self, mix):
+        weights = dict(DEFAULT_MIX)
+        for item in filter(None, mix.split(",")):
+            try:
+                operation, weight = item.split("=")
+                weight = int(weight)
+            except ValueError:
+                raise CommandError(f"Invalid mix entry '{item}'. Expected '<operation>=<weight>'.")
+            if operation not in DEFAULT_MIX:
+                raise CommandError(f"Unknown operation '{operation}'. Choose from {', '.join(DEFAULT_MIX)}.")
+            weights[operation] = weight
+        return {operation: weight for operation, weight in weights.items() if weight > 0}
+
+    # Dataset
+
+    def document_content(self):
+        """
+        plain text content of roughly '--file-size' bytes made of short sentence lines, so that re-uploads
+        produce realistic line based diffs.
+        """
+        target = max(int(self.random.gauss(self.file_size, self.file_size / 4)), 64)
+        lines, size = [], 0
+        while size < target:
+            line = " ".join(self.random.choices(WORDS, k=self.random.randint(4, 14))) + ".\n"
+            lines.append(line)
+            size += len(line)
+        return lines
+
+    def edited_content(self, lines):
+        """
+        copy of the lines with a handful of them replaced, inserted or removed.
+        """
+        lines = list(lines)
+        for _ in range(max(len(lines) // 50, 1)):
+            position = self.random.randrange(len(lines))
+            action = self.random.choice(("replace", "insert", "delete"))
+            new_line = " ".join(self.random.choices(WORDS, k=self.random.randint(4, 14))) + ".\n"
+            if action == "replace":
+                lines[position] = new_line
+            elif action == "insert":
+                lines.insert(position, new_line)
+            elif len(lines) > 1:
+                del lines[position]
+        return lines
+
+    def seed(self, user_count, document_count, version_count, collaborator_count):
+        """
+        creating the dataset directly through the ORM. The password is hashed once and shared by all the
+        seeded users to keep seeding fast.
+        """
+        password_hash = make_password(self.password)
+        User.objects.bulk_create([
+            User(username=f"loadtest_{self.run_id}_{index}", email=f"loadtest_{self.run_id}_{index}@example.com",
+                 first_name="Load", last_name=f"Test{index}", password=password_hash)
+            for index in range(max(user_count, 2))
+        ])
+        self.users = list(User.objects.filter(username__startswith=f"loadtest_{self.run_id}_").order_by("id"))
+        self.tokens = {user.id: user.get_jwt_token_for_user() for user in self.users}
+        user_ids = [user.id for user in self.users]
+
+        self.documents = []
+        self.contents = {}
+        for index in range(document_count):
+            owner = self.users[index % len(self.users)]
+            others = [user_id for user_id in user_ids if user_id != owner.id]
+            lines = self.document_content()
+            document_obj = Document(document_name=f"loadtest_{index}", owner=owner,
+                                    shared_with=self.random.sample(others, min(collaborator_count, len(others))))
+            document_obj.document.save(f"loadtest_{self.run_id}_{index}.txt", ContentFile("".join(lines)),
+                                       save=False)
+            document_obj.save()
+            document_obj.record_version(DocumentVersion.objects.create(parent_document=document_obj,
+                                                                       updated_by=owner,
+                                                                       document=document_obj.document))
+            for version_index in range(1, version_count):
+                lines = self.edited_content(lines)
+                version_obj = DocumentVersion(parent_document=document_obj, updated_by=owner)
+                version_obj.document.save(f"loadtest_{self.run_id}_{index}_{version_index}.txt",
+                                          ContentFile("".join(lines)), save=False)
+                version_obj.save()
+                document_obj.record_version(version_obj)
+            self.documents.append(document_obj)
+            self.contents[document_obj.id] = lines
+
+    def cleanup(self):
+        user_ids = [user.id for user in self.users]
+        documents = Document.objects.filter(owner_id__in=user_ids)
+        for version_obj in DocumentVersion.objects.filter(parent_document__in=documents):
+            for field_file in (version_obj.document, version_obj.diff_file):
+                if field_file:
+                    field_file.delete(save=False)
+        for document_obj in documents:
+            if document_obj.document:
+                document_obj.document.delete(save=False)
+        User.objects.filter(id__in=user_ids).delete()
+
+    # Workload
+
+    def request(self, name, method, path, user=None, **kwargs):
+        if user is not None:
+            kwargs["HTTP_AUTHORIZATION"] = f"Token {self.tokens[user.id]}"
+        with CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            api_response = getattr(self.client, method)(path, **kwargs)
+            duration = time.perf_counter() - started
+        self.samples[name].append(duration)
+        self.queries[name].append(len(queries))
+        self.statuses[name][api_response.status_code] += 1
+        return api_response
+
+    def any_user(self):
+        return self.random.choice(self.users)
+
+    def op_login(self):
+        user = self.any_user()
+        self.request("login", "post", "/api/v1/login/", data={"username": user.username, "password": self.password})
+
+    def op_user_list(self):
+        self.request("user_list", "get", "/api/v1/user/", user=self.any_user())
+
+    def op_user_retrieve(self):
+        self.request("user_retrieve", "get", f"/api/v1/user/{self.any_user().id}/", user=self.any_user())
+
+    def op_document_list(self):
+        self.request("document_list", "get", "/api/v1/document/", user=self.any_user())
+
+    def op_document_retrieve(self):
+        document_obj = self.random.choice(self.documents)
+        self.request("document_retrieve", "get", f"/api/v1/document/{document_obj.id}/", user=self.any_user())
+
+    def op_document_version_list(self):
+        self.request("document_version_list", "get", "/api/v1/document_version/", user=self.any_user())
+
+    def op_edit(self):
+        """
+        download (and lock) a document as its owner or a collaborator, then upload an edited copy of it
+        which also releases the lock.
+        """
+        document_obj = self.random.choice(self.documents)
+        document_obj.refresh_from_db(fields=["shared_with"])
+        editors = [document_obj.owner_id] + list(document_obj.shared_with)
+        editor_id = self.random.choice(editors)
+        user = next(user for user in self.users if user.id == editor_id)
+
+        fetch_response = self.request("fetch_document", "get", f"/api/v1/fetch_document/{document_obj.id}/",
+                                      user=user)
+        if fetch_response.status_code != 200:
+            return
+        lines = self.edited_content(self.contents[document_obj.id])
+        upload = ContentFile("".join(lines).encode(), name=f"edited_{document_obj.id}.txt")
+        upload_response = self.request("reupload_document", "patch", f"/api/v1/reupload_document/{document_obj.id}/",
+                                       user=user, data=encode_multipart(BOUNDARY, {"document": upload}),
+                                       content_type=MULTIPART_CONTENT)
+        if upload_response.status_code == 200:
+            self.contents[document_obj.id] = lines
+
+    def op_collaborate(self):
+        document_obj = self.random.choice(self.documents)
+        document_obj.refresh_from_db(fields=["shared_with", "currently_edited_by"])
+        candidates = [user for user in self.users
+                      if user.id != document_obj.owner_id and user.id not in document_obj.shared_with]
+        if not candidates:
+            return
+        collaborator = self.random.choice(candidates)
+        owner = next(user for user in self.users if user.id == document_obj.owner_id)
+        data = {"document_id": document_obj.id, "collaborator": collaborator.id}
+        self.request("add_collaborator", "post", "/api/v1/add_document_collaborator/", user=owner, data=data)
+        self.request("remove_collaborator", "post", "/api/v1/remove_document_collaborator/", user=owner, data=data)
+
+    def op_create(self):
+        user = self.any_user()
+        upload = ContentFile("".join(self.document_content()).encode(), name="created.txt")
+        create_response = self.request("document_create", "post", "/api/v1/document/", user=user,
+                                       data={"document_name": f"loadtest_created_{uuid.uuid4().hex[:8]}",
+                                             "document": upload})
+        if create_response.status_code == 201:
+            document_id = create_response.json()["id"]
+            for version_obj in DocumentVersion.objects.filter(parent_document_id=document_id):
+                version_obj.document.delete(save=False)
+            self.request("document_delete", "delete", f"/api/v1/document/{document_id}/", user=user)
+
+    # Results
+
+    def build_results(self, options, seed_duration, run_duration):
+        endpoints = {}
+        for name, latencies in sorted(self.samples.items()):
+            queries = self.queries[name]
+            summary = summarize_latencies(latencies)
+            summary["requests_per_second"] = round(len(latencies) / sum(latencies), 2) if sum(latencies) else None
+            summary["queries_per_request"] = {
+                "mean": round(sum(queries) / len(queries), 2),
+                "max": max(queries),
+            }
+            summary["status_codes"] = {str(code): count for code, count in sorted(self.statuses[name].items())}
+            summary["errors"] = sum(count for code, count in self.statuses[name].items() if code >= 400)
+            endpoints[name] = summary
+
+        all_latencies = [latency for latencies in self.samples.values() for latency in latencies]
+        all_queries = [count for counts in self.queries.values() for count in counts]
+        overall = summarize_latencies(all_latencies)
+        overall["requests_per_second"] = round(len(all_latencies) / run_duration, 2) if run_duration else None
+        overall["queries_per_request"] = {
+            "mean": round(sum(all_queries) / len(all_queries), 2) if all_queries else 0,
+            "max": max(all_queries, default=0),
+        }
+
+        return {
+            "benchmark": "load_test",
+            "environment": environment_info(),
+            "parameters": {
+                "users": options["users"],
+                "documents": options["documents"],
+                "versions": options["versions"],
+                "file_size": options["file_size"],
+                "collaborators": options["collaborators"],
+                "requests": options["requests"],
+                "mix": self.mix,
+                "seed": options["seed"],
+            },
+            "seed_duration_s": round(seed_duration, 3),
+            "run_duration_s": round(run_duration, 3),
+            "overall": overall,
+            "endpoints": endpoints,
+        }
@@ -0,0 +1,168 @@
+import datetime
+import os
+import time
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from documents import packs
+from documents.diffing import DIFF_FORMAT_HUNKS, hunk_index_name
+from documents.models import Document, DocumentVersion, PackedFile, VersionPack
+
+
+class Command(BaseCommand):
+    help = "Archive the version and diff files of the old document versions into large append only pack files and " \
+           "remove them from the media directories. The files stay readable through the media storage with a seek " \
+           "into their pack (see documents.packs). The files of the current revisions of the documents are never " \
+           "archived. --verify checks the checksums of every pack instead."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--min-age-days", type=int, default=settings.VERSION_PACK_MIN_AGE_DAYS,
+                            help="archive the files of the versions created more than that many days ago")
+        parser.add_argument("--max-pack-bytes", type=int, default=settings.VERSION_PACK_MAX_BYTES,
+                            help="a new pack is started once the current one is over that size")
+        parser.add_argument("--batch-size", type=int, default=500, help="document versions read per query")
+        parser.add_argument("--sleep", type=float, default=0, help="seconds to pause between the batches")
+        parser.add_argument("--dry-run", action="store_true", help="only count the files to archive")
+        parser.add_argument("--verify", action="store_true",
+                            help="verify the checksums of every pack and its index, nothing is archived")
+
+    def handle(self, *args, **options):
+        if options["verify"]:
+            return self.verify()
+
+        self.options = options
+        self.writer = None
+        self.archived = self.archived_bytes = self.pack_count = 0
+        cutoff = timezone.now() - datetime.timedelta(days=options["min_age_days"])
+
+        last_id = 0
+        while True:
+            rows = list(DocumentVersion.objects.filter(id__gt=last_id, created_on__lt=cutoff).order_by("id")
+                        .values_list("id", "document", "diff_file", "diff_format")[:options["batch_size"]])
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            self.archive_batch(rows)
+            if options["sleep"]:
+                time.sleep(options["sleep"])
+        if self.writer is not None:
+            self.finish_pack()
+
+        action = "To archive" if options["dry_run"] else "Archived"
+        self.stdout.write(f"{action}: {self.archived} files, {self.archived_bytes} bytes"
+                          f"{'' if options['dry_run'] else f' in {self.pack_count} packs'}.")
+
+    def archive_batch(self, rows):
+        names = set()
+        for _, document_name, diff_name, diff_format in rows:
+            names.update(name for name in (document_name, diff_name) if name)
+            if diff_name and diff_format == DIFF_FORMAT_HUNKS:
+                names.add(hunk_index_name(diff_name))
+
+        """
+        the file of the current revision of a document is also the file of its latest version, it's kept loose.
+        A file left loose by an interrupted run after its pack was committed is only removed.
+        """
+        names -= set(Document.objects.filter(document__in=names).values_list("document", flat=True))
+        packed = set(PackedFile.objects.filter(name__in=names).values_list("name", flat=True))
+        if not self.options["dry_run"]:
+            self.remove_loose(name for name in packed if os.path.isfile(default_storage.path(name)))
+
+        for name in sorted(names - packed):
+            path = default_storage.path(name)
+            if not os.path.isfile(path):
+                continue
+            if self.options["dry_run"]:
+                self.archived += 1
+                self.archived_bytes += os.path.getsize(path)
+                continue
+
+            if self.writer is None:
+                self.pack_name = packs.new_pack_name()
+                self.writer = packs.PackWriter(default_storage.path(self.pack_name))
+            try:
+                infile = open(path, "rb")
+            except FileNotFoundError:
+                continue
+            try:
+                with infile:
+                    self.writer.add(name, infile)
+            except Exception:
+                self.writer.abort()
+                raise
+            if self.writer.size >= self.options["max_pack_bytes"]:
+                self.finish_pack()
+
+    def finish_pack(self):
+        """
+        Closing the pack, reading it back to verify every checksum, then indexing its files in one transaction and
+        only then removing the loose files. An interruption before the commit leaves the loose files and the index
+        untouched.
+        """
+        writer, self.writer = self.writer, None
+        path = writer.path
+        try:
+            checksum = writer.close()
+            entries, errors = packs.read_pack(path)
+            if errors or entries != writer.entries:
+                raise CommandError(f"Verification of the new pack {self.pack_name} failed: "
+                                   f"{'; '.join(errors) or 'the index differs'}")
+            with transaction.atomic():
+                pack = VersionPack.objects.create(name=self.pack_name, size=writer.size, checksum=checksum,
+                                                  file_count=len(entries), verified_on=timezone.now())
+                PackedFile.objects.bulk_create([PackedFile(name=entry.name, pack=pack, offset=entry.offset,
+                                                           size=entry.size, checksum=entry.checksum)
+                                                for entry in entries], batch_size=1000)
+        except Exception:
+            writer.abort()
+            if os.path.exists(path):
+                os.remove(path)
+            raise
+
+        self.remove_loose(entry.name for entry in entries)
+        self.archived += len(entries)
+        self.archived_bytes += sum(entry.size for entry in entries)
+        self.pack_count += 1
+        self.stdout.write(f"Wrote {self.pack_name}: {len(entries)} files, {writer.size} bytes.")
+
+    @staticmethod
+    def remove_loose(names):
+        for name in names:
+            try:
+                os.remove(default_storage.path(name))
+            except FileNotFoundError:
+                pass
+
+    def verify(self):
+        """
+        Reading every pack: checksums of the files and of the pack, and the offsets, sizes and checksums of the
+        index. The files deleted from the index since they were packed aren't errors.
+        """
+        failed = 0
+        for pack in VersionPack.objects.order_by("id"):
+            try:
+                entries, errors = packs.read_pack(default_storage.path(pack.name))
+            except OSError as e:
+                entries, errors = [], [f"{pack.name} can't be read: {e}"]
+
+            indexed = {name: (offset, size, checksum) for name, offset, size, checksum in
+                       pack.files.values_list("name", "offset", "size", "checksum")}
+            for entry in entries:
+                if entry.name in indexed and indexed.pop(entry.name) != (entry.offset, entry.size, entry.checksum):
+                    errors.append(f"index entry of {entry.name} doesn't match the pack")
+            errors.extend(f"{name} is indexed but missing from the pack" for name in sorted(indexed))
+
+            if errors:
+                failed += 1
+                for error in errors:
+                    self.stderr.write(f"{pack.name}: {error}")
+            else:
+                VersionPack.objects.filter(id=pack.id).update(verified_on=timezone.now())
+                self.stdout.write(f"{pack.name}: OK ({len(entries)} files).")
+
+        if failed:
+            raise CommandError(f"{failed} packs failed the verification.")
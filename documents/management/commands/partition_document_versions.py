@@ -0,0 +1,81 @@
+import datetime
+import gzip
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from documents import partitioning
+
+
+class Command(BaseCommand):
+    help = "Maintain the monthly partitions of the document versions table (postgresql only): create the partitions " \
+           "of the coming months (run it daily from cron), detach the partitions of old months and optionally " \
+           "archive them as gzipped CSV files or drop them. --convert partitions an existing plain table."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--months-ahead", type=int, default=3, help="months to create partitions for in advance")
+        parser.add_argument("--convert", action="store_true",
+                            help="convert the plain table to a partitioned table first (locks it during the copy)")
+        parser.add_argument("--detach-before", help="detach the partitions of the months before YYYY-MM")
+        parser.add_argument("--archive-dir", help="write the detached partitions to <dir>/<partition>.csv.gz and "
+                                                  "drop them")
+        parser.add_argument("--drop", action="store_true", help="drop the detached partitions without archiving them")
+        parser.add_argument("--list", action="store_true", help="only list the partitions")
+
+    def handle(self, *args, **options):
+        if connection.vendor != "postgresql":
+            raise CommandError("Partitioning is only supported on postgresql.")
+
+        with connection.cursor() as cursor:
+            if not partitioning.is_partitioned(cursor):
+                if not options["convert"]:
+                    raise CommandError("The document versions table isn't partitioned, run with --convert first.")
+                with connection.schema_editor() as schema_editor:
+                    partitioning.convert_table(schema_editor, partitioned=True,
+                                               months_ahead=options["months_ahead"])
+                self.stdout.write("Converted the document versions table to a partitioned table.")
+
+            if options["list"]:
+                for name, rows in partitioning.list_partitions(cursor):
+                    self.stdout.write(f"{name}: ~{int(max(rows, 0))} rows")
+                return
+
+            this_month = datetime.date.today().replace(day=1)
+            created = partitioning.ensure_partitions(cursor, this_month,
+                                                     partitioning.add_months(this_month, options["months_ahead"]))
+            self.stdout.write(f"Created {len(created)} partitions{': ' + ', '.join(created) if created else ''}.")
+
+            if options["detach_before"]:
+                self.detach(cursor, options)
+
+    def detach(self, cursor, options):
+        try:
+            before = datetime.datetime.strptime(options["detach_before"], "%Y-%m").date()
+        except ValueError:
+            raise CommandError("--detach-before should be formatted as YYYY-MM.")
+        if options["archive_dir"]:
+            os.makedirs(options["archive_dir"], exist_ok=True)
+
+        for name, rows in partitioning.list_partitions(cursor):
+            month = partitioning.parse_partition_name(name)
+            if month is None or month >= before:
+                continue
+            with transaction.atomic():
+                partitioning.detach_partition(cursor, name)
+                cursor.execute(f"SELECT COUNT(*) FROM documents_document WHERE latest_version_id IN "
+                               f"(SELECT id FROM {name})")
+                latest = cursor.fetchone()[0]
+            self.stdout.write(f"Detached {name}.")
+            if latest:
+                self.stderr.write(f"{latest} documents have their latest version in {name}, their latest_version "
+                                  f"now references an archived version.")
+
+            if options["archive_dir"]:
+                path = os.path.join(options["archive_dir"], f"{name}.csv.gz")
+                with gzip.open(path, "wb") as outfile:
+                    cursor.copy_expert(f"COPY {name} TO STDOUT WITH (FORMAT csv, HEADER)", outfile)
+                self.stdout.write(f"Archived {name} to {path}.")
+            if options["archive_dir"] or options["drop"]:
+                cursor.execute(f"DROP TABLE {name}")
+                self.stdout.write(f"Dropped {name}.")
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Max
+
+from documents.models import Document
+
+
+class Command(BaseCommand):
+    help = "Recompute version_count, latest_version, last_updated_by and updated_on of the documents from their " \
+           "document versions."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000, help="documents updated per statement")
+        parser.add_argument("--document", type=int, action="append", dest="document_ids",
+                            help="only recompute this document id (can be repeated)")
+
+    def handle(self, *args, **options):
+        if options["document_ids"]:
+            updated = Document.recompute_version_summaries(Document.objects.filter(id__in=options["document_ids"]))
+            self.stdout.write(f"Recomputed {updated} documents.")
+            return
+
+        batch_size = options["batch_size"]
+        last_id = Document.objects.aggregate(last_id=Max("id"))["last_id"] or 0
+        updated = 0
+        for start in range(0, last_id + 1, batch_size):
+            with transaction.atomic():
+                updated += Document.recompute_version_summaries(
+                    Document.objects.filter(id__gte=start, id__lt=start + batch_size))
+        self.stdout.write(f"Recomputed {updated} documents.")
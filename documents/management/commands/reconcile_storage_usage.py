@@ -0,0 +1,76 @@
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Max, Sum
+
+from documents import usage
+from documents.models import Document, DocumentVersion
+from users.models import User
+
+
+class Command(BaseCommand):
+    help = "Recompute the storage usage counters of the documents from the sizes of their files, then the counters " \
+           "of the users from their documents, and repair the ones that drifted. Rows are locked batch by batch " \
+           "so uploads running meanwhile are not lost."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500, help="documents or users checked per transaction")
+        parser.add_argument("--dry-run", action="store_true", help="only report the drift")
+
+    def handle(self, *args, **options):
+        self.dry_run = options["dry_run"]
+        batch_size = options["batch_size"]
+
+        checked = repaired = drift = 0
+        last_id = Document.objects.aggregate(last_id=Max("id"))["last_id"] or 0
+        for start in range(0, last_id + 1, batch_size):
+            batch_checked, batch_repaired, batch_drift = self.reconcile_documents(start, start + batch_size)
+            checked, repaired, drift = checked + batch_checked, repaired + batch_repaired, drift + batch_drift
+        self.stdout.write(f"Documents: {checked} checked, {repaired} drifted by {drift} bytes in total.")
+
+        checked = repaired = drift = 0
+        last_id = User.objects.aggregate(last_id=Max("id"))["last_id"] or 0
+        for start in range(0, last_id + 1, batch_size):
+            batch_checked, batch_repaired, batch_drift = self.reconcile_users(start, start + batch_size)
+            checked, repaired, drift = checked + batch_checked, repaired + batch_repaired, drift + batch_drift
+        self.stdout.write(f"Users: {checked} checked, {repaired} drifted by {drift} bytes in total.")
+        if self.dry_run:
+            self.stdout.write("Dry run, nothing was repaired.")
+
+    def reconcile_documents(self, start, end):
+        with transaction.atomic():
+            documents = list(Document.objects.select_for_update().filter(id__gte=start, id__lt=end)
+                             .values_list("id", "document", "storage_bytes"))
+            versions = defaultdict(list)
+            for parent_id, document_name, diff_name, diff_format in DocumentVersion.objects\
+                    .filter(parent_document_id__gte=start, parent_document_id__lt=end)\
+                    .values_list("parent_document_id", "document", "diff_file", "diff_format"):
+                versions[parent_id].append((document_name, diff_name, diff_format))
+
+            sizes, repaired, drift = {}, 0, 0
+            for document_id, document_name, storage_bytes in documents:
+                actual = usage.document_storage_bytes(document_name, versions[document_id], sizes)
+                if actual != storage_bytes:
+                    repaired += 1
+                    drift += abs(actual - storage_bytes)
+                    if not self.dry_run:
+                        Document.objects.filter(id=document_id).update(storage_bytes=actual)
+        return len(documents), repaired, drift
+
+    def reconcile_users(self, start, end):
+        with transaction.atomic():
+            users = list(User.objects.select_for_update().filter(id__gte=start, id__lt=end)
+                         .values_list("id", "storage_bytes"))
+            totals = dict(Document.objects.filter(owner_id__gte=start, owner_id__lt=end).order_by()
+                          .values("owner_id").annotate(total=Sum("storage_bytes")).values_list("owner_id", "total"))
+
+            repaired, drift = 0, 0
+            for user_id, storage_bytes in users:
+                actual = totals.get(user_id) or 0
+                if actual != storage_bytes:
+                    repaired += 1
+                    drift += abs(actual - storage_bytes)
+                    if not self.dry_run:
+                        User.objects.filter(id=user_id).update(storage_bytes=actual)
+        return len(users), repaired, drift
@@ -0,0 +1,109 @@
+import os
+import shutil
+import time
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from documents.diffing import hunk_index_name
+from documents.models import Document, DocumentVersion, PackedFile
+from documents.storage import ShardedUploadTo
+
+"""
+File fields moved by the command. The same file name can be referenced by several rows and fields (the first
+version of a document shares the file of the document), every reference is updated together.
+"""
+FILE_FIELDS = (
+    (Document, "document"),
+    (DocumentVersion, "document"),
+    (DocumentVersion, "diff_file"),
+)
+
+
+class Command(BaseCommand):
+    help = "Move the media files stored in the old flat directories (eg. 'document/<name>') to the sharded layout " \
+           "('document/ab/cd/<id>') while the service is running. Every file is hard linked to its new name, the " \
+           "rows referencing it are updated and only then the old name is removed."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500, help="files moved per transaction")
+        parser.add_argument("--sleep", type=float, default=0, help="seconds to pause between the batches")
+        parser.add_argument("--dry-run", action="store_true", help="only count the files to move")
+
+    def handle(self, *args, **options):
+        moved = missing = 0
+        for model, field_name in FILE_FIELDS:
+            last_id = 0
+            while True:
+                rows = list(model.objects.filter(id__gt=last_id).exclude(**{field_name: ""})
+                            .exclude(**{f"{field_name}__isnull": True}).order_by("id")
+                            .values_list("id", field_name)[:options["batch_size"]])
+                if not rows:
+                    break
+                last_id = rows[-1][0]
+                names = {name for _, name in rows if not ShardedUploadTo.is_sharded(name)}
+                """
+                the files archived in pack files (see documents.packs) have no path on disk, they keep their names.
+                """
+                names -= set(PackedFile.objects.filter(name__in=names).values_list("name", flat=True))
+                if options["dry_run"]:
+                    moved += len(names)
+                    continue
+
+                batch_moved, batch_missing = self.move_batch(names)
+                moved += batch_moved
+                missing += batch_missing
+                if names and options["sleep"]:
+                    time.sleep(options["sleep"])
+
+        action = "To move" if options["dry_run"] else "Moved"
+        self.stdout.write(f"{action}: {moved} files, missing on disk: {missing}.")
+
+    def move_batch(self, names):
+        """
+        link every file of the batch to its new name (sharded under the same top level directory), point the rows
+        to the new names in one transaction and then remove the old names. A failure before the commit leaves the
+        old files and rows untouched (only the new links have to be removed).
+        """
+        renames, missing = {}, 0
+        for name in names:
+            if not os.path.isfile(default_storage.path(name)):
+                missing += 1
+                continue
+            new_name = ShardedUploadTo(os.path.dirname(name))(None, os.path.basename(name))
+            self.link(name, new_name)
+            if os.path.isfile(default_storage.path(hunk_index_name(name))):
+                self.link(hunk_index_name(name), hunk_index_name(new_name))
+            renames[name] = new_name
+
+        try:
+            with transaction.atomic():
+                for name, new_name in renames.items():
+                    for model, field_name in FILE_FIELDS:
+                        model.objects.filter(**{field_name: name}).update(**{field_name: new_name})
+        except Exception:
+            for new_name in renames.values():
+                self.remove(new_name)
+            raise
+
+        for name in renames:
+            self.remove(name)
+        return len(renames), missing
+
+    @staticmethod
+    def link(name, new_name):
+        path, new_path = default_storage.path(name), default_storage.path(new_name)
+        os.makedirs(os.path.dirname(new_path), exist_ok=True)
+        try:
+            os.link(path, new_path)
+        except OSError:
+            shutil.copy2(path, new_path)
+
+    @staticmethod
+    def remove(name):
+        for path in (default_storage.path(name), default_storage.path(hunk_index_name(name))):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
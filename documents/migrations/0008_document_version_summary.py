@@ -0,0 +1,51 @@
+# Generated by Django 3.2.11 on 2026-10-19 10:55
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+import django.db.models.deletion
+
+
+def backfill_version_summaries(apps, schema_editor):
+    Document = apps.get_model('documents', 'Document')
+    DocumentVersion = apps.get_model('documents', 'DocumentVersion')
+    versions = DocumentVersion.objects.filter(parent_document=OuterRef('pk')).order_by('-created_on', '-id')
+    version_count = DocumentVersion.objects.filter(parent_document=OuterRef('pk')).order_by()\
+        .values('parent_document').annotate(count=Count('id')).values('count')
+    Document.objects.update(version_count=Coalesce(Subquery(version_count), 0),
+                            latest_version=Subquery(versions.values('id')[:1]),
+                            last_updated_by=Subquery(versions.values('updated_by')[:1]),
+                            updated_on=Subquery(versions.values('created_on')[:1]))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('documents', '0007_auto_20220117_0316'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='last_updated_by',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='document_last_updated_by', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='document',
+            name='latest_version',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='documents.documentversion'),
+        ),
+        migrations.AddField(
+            model_name='document',
+            name='updated_on',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='document',
+            name='version_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_version_summaries, migrations.RunPython.noop),
+    ]
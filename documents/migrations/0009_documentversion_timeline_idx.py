@@ -0,0 +1,17 @@
+# Generated by Django 3.2.11 on 2026-10-19 10:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0008_document_version_summary'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='documentversion',
+            index=models.Index(fields=['parent_document', 'created_on'], name='documentversion_timeline_idx'),
+        ),
+    ]
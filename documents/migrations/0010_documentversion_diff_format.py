@@ -0,0 +1,24 @@
+# Generated by Django 3.2.11 on 2026-10-19 10:58
+
+from django.db import migrations, models
+
+
+def mark_existing_diffs_as_ndiff(apps, schema_editor):
+    DocumentVersion = apps.get_model('documents', 'DocumentVersion')
+    DocumentVersion.objects.exclude(diff_file='').exclude(diff_file__isnull=True).update(diff_format='ndiff')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0009_documentversion_timeline_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='documentversion',
+            name='diff_format',
+            field=models.CharField(blank=True, choices=[('ndiff', 'ndiff'), ('binary', 'binary delta')], default='', max_length=16),
+        ),
+        migrations.RunPython(mark_existing_diffs_as_ndiff, migrations.RunPython.noop),
+    ]
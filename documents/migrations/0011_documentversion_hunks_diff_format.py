@@ -0,0 +1,18 @@
+# Generated by Django 3.2.11 on 2026-10-19 11:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0010_documentversion_diff_format'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='documentversion',
+            name='diff_format',
+            field=models.CharField(blank=True, choices=[('hunks', 'hunks'), ('ndiff', 'ndiff'), ('binary', 'binary delta')], default='', max_length=16),
+        ),
+    ]
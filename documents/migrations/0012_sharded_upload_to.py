@@ -0,0 +1,29 @@
+# Generated by Django 3.2.11 on 2026-10-19 11:08
+
+from django.db import migrations, models
+import documents.storage
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0011_documentversion_hunks_diff_format'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='document',
+            name='document',
+            field=models.FileField(upload_to=documents.storage.ShardedUploadTo('document')),
+        ),
+        migrations.AlterField(
+            model_name='documentversion',
+            name='diff_file',
+            field=models.FileField(blank=True, null=True, upload_to=documents.storage.ShardedUploadTo('document_diff_files')),
+        ),
+        migrations.AlterField(
+            model_name='documentversion',
+            name='document',
+            field=models.FileField(blank=True, null=True, upload_to=documents.storage.ShardedUploadTo('document_version_files')),
+        ),
+    ]
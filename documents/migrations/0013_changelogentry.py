@@ -0,0 +1,23 @@
+# Generated by Django 3.2.11 on 2026-10-19 11:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0012_sharded_upload_to'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChangeLogEntry',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('document_id', models.IntegerField()),
+                ('kind', models.CharField(choices=[('created', 'document created'), ('updated', 'document updated'), ('deleted', 'document deleted'), ('collaborators', 'collaborators changed'), ('locked', 'edit lock acquired'), ('unlocked', 'edit lock released'), ('version', 'version created')], max_length=16)),
+                ('payload', models.JSONField(default=dict)),
+                ('created_on', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.11 on 2026-10-19 11:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0013_changelogentry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='storage_bytes',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
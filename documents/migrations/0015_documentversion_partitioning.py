@@ -0,0 +1,31 @@
+# Generated by Django 3.2.11 on 2026-10-19 11:29
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+from documents.partitioning import partition_table, unpartition_table
+
+
+class Migration(migrations.Migration):
+    """
+    latest_version loses its database constraint and the table is partitioned by month when
+    settings.DOCUMENT_VERSION_PARTITIONING is set on postgresql (see documents.partitioning). The table is locked
+    while its rows are copied.
+    """
+
+    dependencies = [
+        ('documents', '0014_document_storage_bytes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='document',
+            name='latest_version',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='documents.documentversion'),
+        ),
+        migrations.AddIndex(
+            model_name='documentversion',
+            index=models.Index(fields=['created_on'], name='documentversion_created_idx'),
+        ),
+        migrations.RunPython(partition_table, unpartition_table),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 3.2.11 on 2026-10-19 11:33
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0015_documentversion_partitioning'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VersionPack',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('size', models.BigIntegerField()),
+                ('checksum', models.CharField(max_length=64)),
+                ('file_count', models.PositiveIntegerField()),
+                ('created_on', models.DateTimeField(auto_now_add=True)),
+                ('verified_on', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='PackedFile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('offset', models.BigIntegerField()),
+                ('size', models.BigIntegerField()),
+                ('checksum', models.CharField(max_length=64)),
+                ('pack', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='files', to='documents.versionpack')),
+            ],
+        ),
+    ]
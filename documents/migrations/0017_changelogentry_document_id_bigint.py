@@ -0,0 +1,18 @@
+# Generated by Django 3.2.11 on 2026-10-19 12:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0016_version_packs'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='changelogentry',
+            name='document_id',
+            field=models.BigIntegerField(),
+        ),
+    ]
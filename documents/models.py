@@ -1,5 +1,10 @@
-from django.db import models
+from django.db import connection, models, transaction
+from django.db.models import F, Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
 from users.models import User
+from documents.diffing import DIFF_FORMAT_CHOICES
+from documents.storage import ShardedUploadTo
+from documents import events
 
 
 class Document(models.Model):
@@ -7,20 +12,37 @@ class Document(models.Model):
     Model responsible to store all the documents.
     
     document_name[string]: name of the document
-    document[file]: document file that'll be uploaded in the MEDIA_ROOT
+    document[file]: document file that'll be uploaded in the MEDIA_ROOT (sharded directories, see documents.storage)
     owner[object]: User that has first created this document object
     shared_with[list]: list of user_id's with whom the document is shared. (id's of Collaborators)
     created_on[datetime]: datetime when this object is created
     currently_edited_by[object]: User object of an owner or a collaborator that is currently working on it.
                                  Also works as a lock to identify whether this document free to edit or not.
+    version_count[int]: number of document versions of this document
+    latest_version[object]: most recently created document version (no database constraint, the document
+                            versions table can be partitioned, see documents.partitioning)
+    last_updated_by[object]: User that has created the latest document version
+    updated_on[datetime]: datetime when the latest document version is created
+    (the last four fields are maintained by record_version(), run 'manage.py recompute_document_versions' to
+    repair them)
+    storage_bytes[int]: bytes of the distinct files referenced by the document and its versions (diffs and their
+                        index included), maintained by record_version(). Run 'manage.py reconcile_storage_usage'
+                        to repair it.
     """
     document_name = models.CharField(max_length=128)
-    document = models.FileField(upload_to="document/")
+    document = models.FileField(upload_to=ShardedUploadTo("document"))
     owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name="document_owner", null=True, blank=True)
     shared_with = models.JSONField(default=list)
     created_on = models.DateTimeField(auto_now_add=True)
     currently_edited_by = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True,
                                             related_name="document_currently_edited_by")
+    version_count = models.PositiveIntegerField(default=0)
+    latest_version = models.ForeignKey("DocumentVersion", on_delete=models.SET_NULL, null=True, blank=True,
+                                       related_name="+", db_constraint=False)
+    last_updated_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True,
+                                        related_name="document_last_updated_by")
+    updated_on = models.DateTimeField(null=True, blank=True)
+    storage_bytes = models.BigIntegerField(default=0)
 
     class Meta:
         """
@@ -52,6 +74,38 @@ class Document(models.Model):
         """
         self.currently_edited_by = None
 
+    def record_version(self, document_version, storage_bytes=0):
+        """
+        Updating the version summary fields after a document version of this document is created. Should be called
+        in the same transaction that creates the document version.
+        document_version[object]: newly created document version
+        storage_bytes[int]: bytes of the files stored (or released) with the version, added to storage_bytes
+        """
+        Document.objects.filter(id=self.id).update(version_count=F("version_count") + 1,
+                                                   latest_version=document_version,
+                                                   last_updated_by=document_version.updated_by_id,
+                                                   updated_on=document_version.created_on,
+                                                   storage_bytes=F("storage_bytes") + storage_bytes)
+        self.storage_bytes += storage_bytes
+        self.version_count += 1
+        self.latest_version = document_version
+        self.last_updated_by = document_version.updated_by
+        self.updated_on = document_version.created_on
+
+    @staticmethod
+    def recompute_version_summaries(queryset):
+        """
+        Recomputing the version summary fields of the documents in the queryset from their document versions,
+        with a single UPDATE statement.
+        """
+        versions = DocumentVersion.objects.filter(parent_document=OuterRef("pk")).order_by("-created_on", "-id")
+        version_count = DocumentVersion.objects.filter(parent_document=OuterRef("pk")).order_by()\
+            .values("parent_document").annotate(count=Count("id")).values("count")
+        return queryset.update(version_count=Coalesce(Subquery(version_count), 0),
+                               latest_version=Subquery(versions.values("id")[:1]),
+                               last_updated_by=Subquery(versions.values("updated_by")[:1]),
+                               updated_on=Subquery(versions.values("created_on")[:1]))
+
 
 class DocumentVersion(models.Model):
     """
@@ -63,14 +117,163 @@ class DocumentVersion(models.Model):
     created_on[datetime]: datetime when this object is created
     diff_file[file]: A file that contains the info of both the old lines and the new lines that replaced them.
                      Check the APIdocumentation PDF mentioned in the README.md
+    diff_format[string]: format of the diff_file. 'hunks' for text documents, 'binary' for a binary delta and
+                         'ndiff' for text diffs written before the hunks format (see documents.diffing)
     """
     parent_document = models.ForeignKey("Document", on_delete=models.CASCADE, null=True, blank=True)
-    document = models.FileField(upload_to="document_version_files/", null=True, blank=True)
+    document = models.FileField(upload_to=ShardedUploadTo("document_version_files"), null=True, blank=True)
     updated_by = models.ForeignKey(User, on_delete=models.CASCADE)
     created_on = models.DateTimeField(auto_now_add=True)
-    diff_file = models.FileField(upload_to="document_diff_files/", null=True, blank=True)
+    diff_file = models.FileField(upload_to=ShardedUploadTo("document_diff_files"), null=True, blank=True)
+    diff_format = models.CharField(max_length=16, choices=DIFF_FORMAT_CHOICES, blank=True, default="")
+
+    class Meta:
+        """
+        Index used to list the version history (timeline) of a single document ordered by created_on, and the index
+        of the version list ordered by created_on (scanned partition by partition when the table is partitioned).
+        """
+        indexes = [
+            models.Index(fields=["parent_document", "created_on"], name="documentversion_timeline_idx"),
+            models.Index(fields=["created_on"], name="documentversion_created_idx"),
+        ]
 
     def __str__(self):
         return f"{self.document}"
 
 
+class VersionPack(models.Model):
+    """
+    Pack file of archived document version files, written by 'manage.py pack_versions' (see documents.packs).
+
+    name[string]: name of the pack file in the media storage ('document_packs/pack-<id>.pack')
+    size[int]: bytes of the pack file
+    checksum[string]: sha256 of the pack file (without its trailer, which holds the same checksum)
+    file_count[int]: number of files written to the pack
+    created_on[datetime]: datetime when the pack is written
+    verified_on[datetime]: last time every checksum of the pack was verified ('manage.py pack_versions --verify')
+    """
+    name = models.CharField(max_length=255, unique=True)
+    size = models.BigIntegerField()
+    checksum = models.CharField(max_length=64)
+    file_count = models.PositiveIntegerField()
+    created_on = models.DateTimeField(auto_now_add=True)
+    verified_on = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return self.name
+
+
+class PackedFile(models.Model):
+    """
+    Offset index of the archived files. A file is read with a seek into its pack (see documents.storage).
+
+    name[string]: storage name of the archived file, as referenced by the file fields
+    pack[object]: pack holding the file
+    offset[int]: position of the first byte of the file in the pack
+    size[int]: bytes of the file
+    checksum[string]: sha256 of the file
+    """
+    name = models.CharField(max_length=255, unique=True)
+    pack = models.ForeignKey("VersionPack", on_delete=models.PROTECT, related_name="files")
+    offset = models.BigIntegerField()
+    size = models.BigIntegerField()
+    checksum = models.CharField(max_length=64)
+
+    def __str__(self):
+        return f"{self.name}->{self.pack_id}"
+
+
+class ChangeLogEntry(models.Model):
+    """
+    Append only log of the changes of the documents, read by the change feed (/api/v1/changes/). The auto
+    incremented id is the position of the change in the feed, the entries are committed in the order of their ids
+    (see record_many()).
+
+    document_id[int]: id of the changed document. Not a foreign key so the tombstones of deleted documents are kept.
+    kind[string]: type of the change (see KIND_CHOICES)
+    payload[dict]: snapshot of the document after the change (see document_snapshot()), {"id": ..} for deletes
+                   and the version id / updated_by for new versions
+    created_on[datetime]: datetime when the change happened
+    """
+    LOG_LOCK_KEY = 40040
+
+    KIND_CREATED = "created"
+    KIND_UPDATED = "updated"
+    KIND_DELETED = "deleted"
+    KIND_COLLABORATORS = "collaborators"
+    KIND_LOCKED = "locked"
+    KIND_UNLOCKED = "unlocked"
+    KIND_VERSION = "version"
+
+    KIND_CHOICES = (
+        (KIND_CREATED, "document created"),
+        (KIND_UPDATED, "document updated"),
+        (KIND_DELETED, "document deleted"),
+        (KIND_COLLABORATORS, "collaborators changed"),
+        (KIND_LOCKED, "edit lock acquired"),
+        (KIND_UNLOCKED, "edit lock released"),
+        (KIND_VERSION, "version created"),
+    )
+
+    id = models.BigAutoField(primary_key=True)
+    document_id = models.BigIntegerField()
+    kind = models.CharField(max_length=16, choices=KIND_CHOICES)
+    payload = models.JSONField(default=dict)
+    created_on = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.id}: {self.kind} {self.document_id}"
+
+    @staticmethod
+    def document_snapshot(document_obj):
+        """
+        Fields of the document sent with every change, built from the loaded attributes without any query.
+        """
+        return {
+            "id": document_obj.id,
+            "document_name": document_obj.document_name,
+            "owner": document_obj.owner_id,
+            "shared_with": list(document_obj.shared_with),
+            "currently_edited_by": document_obj.currently_edited_by_id,
+            "version_count": document_obj.version_count,
+            "latest_version": document_obj.latest_version_id,
+            "last_updated_by": document_obj.last_updated_by_id,
+            "updated_on": document_obj.updated_on.isoformat() if document_obj.updated_on else None,
+        }
+
+    @classmethod
+    def build(cls, kind, document_obj, **payload):
+        """
+        Unsaved entry of a change of the document. Deletes only keep the document id (tombstone).
+        payload: extra payload keys (eg. version=<id>)
+        """
+        if kind == cls.KIND_DELETED:
+            return cls(document_id=document_obj.id, kind=kind, payload={"id": document_obj.id, **payload})
+        return cls(document_id=document_obj.id, kind=kind,
+                   payload={"document": cls.document_snapshot(document_obj), **payload})
+
+    @classmethod
+    def record(cls, kind, document_obj, **payload):
+        """
+        Saving a change of the document. Should be called in the transaction that makes the change.
+        """
+        return cls.record_many(cls.build(kind, document_obj, **payload))[0]
+
+    @classmethod
+    def record_many(cls, *entries):
+        """
+        Saving several entries made with build() with a single INSERT. The open event streams are woken up when the
+        transaction commits.
+        On postgresql the ids are taken from the sequence when the rows are inserted, not when they're committed, so
+        two transactions could commit id N+1 before id N and a reader resuming after N+1 would never see N. The
+        transaction takes the change log lock (pg_advisory_xact_lock, held until it commits or rolls back) before
+        inserting, so the ids become visible in order (one more query, counted in the query budgets). The sqlite
+        writes are serialized already. No savepoint: the entries are part of the change made by the caller.
+        """
+        with transaction.atomic(savepoint=False):
+            if connection.vendor == "postgresql":
+                with connection.cursor() as cursor:
+                    cursor.execute("SELECT pg_advisory_xact_lock(%s)", [cls.LOG_LOCK_KEY])
+            entries = cls.objects.bulk_create(entries)
+        transaction.on_commit(events.notify)
+        return entries
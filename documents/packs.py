@@ -0,0 +1,198 @@
+import hashlib
+import io
+import os
+import struct
+import uuid
+from collections import namedtuple
+
+"""
+Pack files of the archived document version files (see 'manage.py pack_versions').
+
+Old version and diff files are appended to large pack files, like git packfiles, and removed from the media
+directories. A pack starts with MAGIC, followed by the files, each one as an entry header (length of the name, size
+of the file), the name, the bytes of the file and their sha256. It ends with the sha256 of everything before it.
+The offset index of the files (PackedFile rows) points to the first byte of every file, reads seek to it. The
+names stored in the pack let the index be checked (and rebuilt) from the pack alone.
+"""
+MAGIC = b"SEPACK1\n"
+ENTRY_HEADER = struct.Struct(">HQ")
+DIGEST_SIZE = hashlib.sha256().digest_size
+PACK_DIRECTORY = "document_packs"
+CHUNK_SIZE = 1024 * 1024
+
+PackEntry = namedtuple("PackEntry", ["name", "offset", "size", "checksum"])
+
+
+class PackChecksumError(OSError):
+    pass
+
+
+def new_pack_name():
+    return f"{PACK_DIRECTORY}/pack-{uuid.uuid4().hex}.pack"
+
+
+class PackWriter:
+    """
+    Writing a new pack file. The files are appended to '<path>.tmp', the pack only gets its final name once it's
+    complete and synced to the disk.
+    path[string]: final path of the pack file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.temp_path = f"{path}.tmp"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.file = open(self.temp_path, "xb")
+        self.hasher = hashlib.sha256()
+        self.size = 0
+        self.entries = []
+        self.write(MAGIC)
+
+    def write(self, data):
+        self.file.write(data)
+        self.hasher.update(data)
+        self.size += len(data)
+
+    def add(self, name, infile):
+        """
+        Appending a file. Returns its PackEntry.
+        name[string]: storage name of the file
+        infile[file]: the file opened in binary mode
+        """
+        encoded_name = name.encode()
+        size = os.fstat(infile.fileno()).st_size
+        self.write(ENTRY_HEADER.pack(len(encoded_name), size))
+        self.write(encoded_name)
+
+        offset, file_hasher = self.size, hashlib.sha256()
+        for chunk in iter(lambda: infile.read(CHUNK_SIZE), b""):
+            file_hasher.update(chunk)
+            self.write(chunk)
+        if self.size - offset != size:
+            raise OSError(f"{name} changed while it was packed.")
+        self.write(file_hasher.digest())
+
+        entry = PackEntry(name, offset, size, file_hasher.hexdigest())
+        self.entries.append(entry)
+        return entry
+
+    def close(self):
+        """
+        Writing the trailer and renaming the pack to its final name. Returns the checksum of the pack.
+        """
+        checksum = self.hasher.digest()
+        self.file.write(checksum)
+        self.size += len(checksum)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        os.replace(self.temp_path, self.path)
+        return checksum.hex()
+
+    def abort(self):
+        self.file.close()
+        try:
+            os.remove(self.temp_path)
+        except FileNotFoundError:
+            pass
+
+
+def read_pack(path):
+    """
+    Reading a whole pack and verifying its checksums.
+    Returns (entries, errors): the PackEntry of every file, with the checksum computed from its bytes, and the
+    descriptions of the checksums that didn't match or of the truncated entries.
+    """
+    entries, errors = [], []
+    hasher = hashlib.sha256()
+    with open(path, "rb") as infile:
+        end = os.fstat(infile.fileno()).st_size - DIGEST_SIZE
+
+        def read(size):
+            data = infile.read(size)
+            hasher.update(data)
+            if len(data) != size:
+                raise EOFError()
+            return data
+
+        try:
+            if read(len(MAGIC)) != MAGIC:
+                return entries, [f"{path} isn't a pack file."]
+            while infile.tell() < end:
+                name_length, size = ENTRY_HEADER.unpack(read(ENTRY_HEADER.size))
+                name = read(name_length).decode()
+                offset, file_hasher = infile.tell(), hashlib.sha256()
+                remaining = size
+                while remaining:
+                    chunk = read(min(CHUNK_SIZE, remaining))
+                    file_hasher.update(chunk)
+                    remaining -= len(chunk)
+                if read(DIGEST_SIZE) != file_hasher.digest():
+                    errors.append(f"checksum mismatch of {name} at offset {offset}")
+                entries.append(PackEntry(name, offset, size, file_hasher.hexdigest()))
+        except (EOFError, struct.error, UnicodeDecodeError):
+            return entries, errors + [f"{path} is truncated after {len(entries)} files."]
+
+        if infile.tell() != end or infile.read(DIGEST_SIZE) != hasher.digest():
+            errors.append(f"checksum mismatch of the pack {path}")
+    return entries, errors
+
+
+class PackedFileReader(io.RawIOBase):
+    """
+    Read only, seekable file object over the bytes of one file of a pack. When the file is read from start to end
+    its sha256 is checked against the index and PackChecksumError is raised on the last read if it doesn't match.
+    """
+
+    def __init__(self, path, offset, size, checksum, name=None):
+        self.file = open(path, "rb")
+        self.offset = offset
+        self.size = size
+        self.checksum = checksum
+        self.name = name
+        self.position = 0
+        self.hasher = hashlib.sha256()
+        self.hashed = 0
+        self.verified = False
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        length = max(min(len(buffer), self.size - self.position), 0)
+        if length:
+            self.file.seek(self.offset + self.position)
+            data = self.file.read(length)
+            if len(data) != length:
+                raise OSError(f"The pack of {self.name} is truncated.")
+            buffer[:length] = data
+            if self.hashed == self.position:
+                self.hasher.update(data)
+                self.hashed += length
+            self.position += length
+        if self.hashed == self.size and not self.verified:
+            self.verified = True
+            if self.hasher.hexdigest() != self.checksum:
+                raise PackChecksumError(f"Checksum mismatch of the packed file {self.name}.")
+        return length
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError("Negative seek position.")
+        self.position = offset
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        if not self.closed:
+            self.file.close()
+        super().close()
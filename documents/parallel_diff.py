@@ -0,0 +1,218 @@
+import difflib
+import heapq
+import logging
+import multiprocessing
+import os
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from django.conf import settings
+
+"""
+Parallel version of difflib for very large text documents, with output identical to the sequential
+difflib.SequenceMatcher / difflib.Differ.
+
+SequenceMatcher finds the longest matching block of the whole range and then recurses independently on the parts
+left and right of it. The first levels of that recursion are run here, in the calling process, which splits both
+revisions at the matching blocks (the anchors) into independent segments. The segments are then matched in a
+process pool with the 'popular' lines of the whole new revision (SequenceMatcher's autojunk heuristic), so every
+segment is matched exactly like the sequential matcher would match it. Rendering the ndiff lines of the resulting
+opcodes (difflib.Differ's character level replace) is spread over the pool as well.
+When the pool can't be started or breaks (eg. a worker killed by the OOM killer) the diff is finished in the
+calling process, with the same output.
+"""
+logger = logging.getLogger("signeasy.parallel_diff")
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_parallelism():
+    return int(getattr(settings, "DOCUMENT_DIFF_PARALLELISM", None) or os.cpu_count() or 1)
+
+
+def should_parallelize(current_lines, new_lines):
+    """
+    Only documents with more lines than settings.DOCUMENT_DIFF_PARALLEL_THRESHOLD (both revisions together) are
+    diffed in parallel, smaller ones aren't worth the inter-process overhead.
+    """
+    threshold = getattr(settings, "DOCUMENT_DIFF_PARALLEL_THRESHOLD", 20000)
+    return get_parallelism() > 1 and len(current_lines) + len(new_lines) >= threshold
+
+
+def get_executor():
+    """
+    Process pool shared by the requests of this worker, created on the first large diff. The workers are spawned
+    rather than forked (python 3.7+) so they don't inherit the database connections and threads of the worker.
+    ProcessPoolExecutor only takes mp_context since python 3.7, on 3.6 the pool uses the default start method.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            options = {"mp_context": multiprocessing.get_context("spawn")} if sys.version_info >= (3, 7) else {}
+            _executor = ProcessPoolExecutor(max_workers=get_parallelism(), **options)
+        return _executor
+
+
+def reset_executor(executor):
+    """
+    dropping a broken pool, the next diff creates a new one.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is executor:
+            _executor = None
+    if executor is not None:
+        executor.shutdown(wait=False)
+
+
+def pool_map(function, tasks):
+    """
+    Results of function for every task, computed in the pool or in this process when the pool is unusable.
+    """
+    executor = None
+    try:
+        executor = get_executor()
+        return list(executor.map(function, tasks))
+    except (BrokenProcessPool, OSError) as e:
+        logger.warning(f"Diff process pool unavailable, diffing in the worker: {e!r}")
+        reset_executor(executor)
+        return [function(task) for task in tasks]
+
+
+class PresetPopularSequenceMatcher(difflib.SequenceMatcher):
+    """
+    SequenceMatcher whose popular elements are given instead of being computed from b. Matching a segment of b
+    with the popular elements of the whole b gives the same matching blocks as the full matcher gives for that
+    range.
+    """
+
+    def __init__(self, a, b, popular):
+        self.preset_popular = popular
+        super(PresetPopularSequenceMatcher, self).__init__(None, a, b, autojunk=False)
+
+    def _SequenceMatcher__chain_b(self):
+        self.b2j = b2j = {}
+        for index, element in enumerate(self.b):
+            b2j.setdefault(element, []).append(index)
+        self.bjunk = set()
+        self.bpopular = {element for element in self.preset_popular if element in b2j}
+        for element in self.bpopular:
+            del b2j[element]
+
+
+def _match_segment(task):
+    """
+    pool worker: matching blocks of one segment, with offsets relative to the segment.
+    """
+    a, b, popular = task
+    return PresetPopularSequenceMatcher(a, b, popular).get_matching_blocks()[:-1]
+
+
+def _render_ndiff(task):
+    """
+    pool worker: difflib.Differ lines of a group of opcodes.
+    """
+    a, b, opcodes = task
+    differ = difflib.Differ()
+    lines = []
+    for tag, alo, ahi, blo, bhi in opcodes:
+        if tag == "replace":
+            lines.extend(differ._fancy_replace(a, alo, ahi, b, blo, bhi))
+        elif tag == "delete":
+            lines.extend(differ._dump("-", a, alo, ahi))
+        elif tag == "insert":
+            lines.extend(differ._dump("+", b, blo, bhi))
+        else:
+            lines.extend(differ._dump(" ", a, alo, ahi))
+    return lines
+
+
+def split_segments(matcher, segment_count):
+    """
+    Running the first levels of SequenceMatcher.get_matching_blocks() until there are segment_count independent
+    segments, always splitting the largest one.
+    Returns the anchors (matching blocks found here) and the segments left to match.
+    """
+    anchors = []
+    segments = [(-(len(matcher.a) + len(matcher.b)), 0, len(matcher.a), 0, len(matcher.b))]
+    while segments and len(segments) < segment_count:
+        _, alo, ahi, blo, bhi = heapq.heappop(segments)
+        i, j, k = matcher.find_longest_match(alo, ahi, blo, bhi)
+        if not k:
+            continue
+        anchors.append((i, j, k))
+        for child in ((alo, i, blo, j), (i + k, ahi, j + k, bhi)):
+            if child[0] < child[1] and child[2] < child[3]:
+                heapq.heappush(segments, (-((child[1] - child[0]) + (child[3] - child[2])),) + child)
+    return anchors, [segment[1:] for segment in segments]
+
+
+def parallel_opcodes(current_lines, new_lines):
+    """
+    Same result as difflib.SequenceMatcher(None, current_lines, new_lines).get_opcodes(), computed in the pool.
+    """
+    matcher = difflib.SequenceMatcher(None, current_lines, new_lines)
+    anchors, segments = split_segments(matcher, get_parallelism() * 4)
+
+    tasks = [(current_lines[alo:ahi], new_lines[blo:bhi], matcher.bpopular) for alo, ahi, blo, bhi in segments]
+    blocks = list(anchors)
+    for (alo, ahi, blo, bhi), segment_blocks in zip(segments, pool_map(_match_segment, tasks)):
+        blocks.extend((alo + i, blo + j, k) for i, j, k in segment_blocks)
+    blocks.sort()
+
+    """
+    collapsing adjacent blocks exactly like SequenceMatcher.get_matching_blocks()
+    """
+    collapsed = []
+    i1 = j1 = k1 = 0
+    for i2, j2, k2 in blocks:
+        if i1 + k1 == i2 and j1 + k1 == j2:
+            k1 += k2
+        else:
+            if k1:
+                collapsed.append((i1, j1, k1))
+            i1, j1, k1 = i2, j2, k2
+    if k1:
+        collapsed.append((i1, j1, k1))
+    collapsed.append((len(current_lines), len(new_lines), 0))
+
+    matcher.matching_blocks = list(map(difflib.Match._make, collapsed))
+    return matcher.get_opcodes()
+
+
+def group_opcodes(opcodes, group_count):
+    """
+    Splitting the opcodes into about group_count consecutive groups of similar rendering cost.
+    """
+    def cost(opcode):
+        tag, alo, ahi, blo, bhi = opcode
+        return (ahi - alo) * (bhi - blo) if tag == "replace" else (ahi - alo) + (bhi - blo)
+
+    budget = max(sum(cost(opcode) for opcode in opcodes) / max(group_count, 1), 1)
+    groups, group, group_cost = [], [], 0
+    for opcode in opcodes:
+        group.append(opcode)
+        group_cost += cost(opcode)
+        if group_cost >= budget:
+            groups.append(group)
+            group, group_cost = [], 0
+    if group:
+        groups.append(group)
+    return groups
+
+
+def parallel_ndiff(current_lines, new_lines):
+    """
+    Same lines as difflib.Differ().compare(current_lines, new_lines), computed in the pool.
+    """
+    tasks = []
+    for group in group_opcodes(parallel_opcodes(current_lines, new_lines), get_parallelism() * 4):
+        alo, blo = group[0][1], group[0][3]
+        ahi, bhi = group[-1][2], group[-1][4]
+        tasks.append((current_lines[alo:ahi], new_lines[blo:bhi],
+                      [(tag, i1 - alo, i2 - alo, j1 - blo, j2 - blo) for tag, i1, i2, j1, j2 in group]))
+    for lines in pool_map(_render_ndiff, tasks):
+        yield from lines
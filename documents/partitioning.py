@@ -0,0 +1,180 @@
+import datetime
+
+from django.conf import settings
+from django.db import transaction
+
+"""
+Optional postgresql declarative partitioning of the document versions table by month of created_on
+(settings.DOCUMENT_VERSION_PARTITIONING).
+
+The partitioned table has the same columns, indexes and foreign keys as the plain table. Its primary key is
+(id, created_on) since it has to include the partition key, the ids still come from the same sequence.
+Document.latest_version has no database constraint because a partitioned table can't be referenced by id alone.
+Partitions are named '<table>_pYYYY_MM', rows outside of the monthly partitions go to '<table>_pdefault'.
+Queries filtering or ordering on created_on (the version list, the timeline pages) only scan the partitions of the
+months they cover.
+"""
+TABLE = "documents_documentversion"
+DEFAULT_PARTITION = f"{TABLE}_pdefault"
+
+
+def is_enabled():
+    return bool(getattr(settings, "DOCUMENT_VERSION_PARTITIONING", False))
+
+
+def add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return datetime.date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month):
+    return f"{TABLE}_p{month.year:04d}_{month.month:02d}"
+
+
+def parse_partition_name(name):
+    """
+    month of a monthly partition, None for the other tables
+    """
+    try:
+        year, month = name[len(f"{TABLE}_p"):].split("_")
+        return datetime.date(int(year), int(month), 1)
+    except ValueError:
+        return None
+
+
+def is_partitioned(cursor):
+    cursor.execute("SELECT 1 FROM pg_partitioned_table WHERE partrelid = %s::regclass", [TABLE])
+    return cursor.fetchone() is not None
+
+
+def list_partitions(cursor):
+    """
+    names of the attached partitions with their estimated number of rows, ordered by name
+    """
+    cursor.execute("SELECT child.relname, child.reltuples FROM pg_inherits "
+                   "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+                   "WHERE pg_inherits.inhparent = %s::regclass ORDER BY child.relname", [TABLE])
+    return cursor.fetchall()
+
+
+def create_partition(cursor, month):
+    """
+    Creating the partition of the month. Rows of that month already stored in the default partition are moved to
+    it (the default partition is detached meanwhile, postgresql refuses the new partition otherwise).
+    Returns False when the partition already exists.
+    """
+    name = partition_name(month)
+    cursor.execute("SELECT to_regclass(%s)", [name])
+    if cursor.fetchone()[0] is not None:
+        return False
+
+    start, end = month.isoformat(), add_months(month, 1).isoformat()
+    with transaction.atomic():
+        cursor.execute(f"SELECT 1 FROM {DEFAULT_PARTITION} WHERE created_on >= %s::date AND created_on < %s::date "
+                       f"LIMIT 1", [start, end])
+        if cursor.fetchone() is None:
+            cursor.execute(f"CREATE TABLE {name} PARTITION OF {TABLE} FOR VALUES FROM ('{start}') TO ('{end}')")
+            return True
+
+        cursor.execute(f"ALTER TABLE {TABLE} DETACH PARTITION {DEFAULT_PARTITION}")
+        cursor.execute(f"CREATE TABLE {name} PARTITION OF {TABLE} FOR VALUES FROM ('{start}') TO ('{end}')")
+        cursor.execute(f"INSERT INTO {TABLE} SELECT * FROM {DEFAULT_PARTITION} "
+                       f"WHERE created_on >= %s::date AND created_on < %s::date", [start, end])
+        cursor.execute(f"DELETE FROM {DEFAULT_PARTITION} WHERE created_on >= %s::date AND created_on < %s::date",
+                       [start, end])
+        cursor.execute(f"ALTER TABLE {TABLE} ATTACH PARTITION {DEFAULT_PARTITION} DEFAULT")
+    return True
+
+
+def ensure_partitions(cursor, first_month, last_month):
+    """
+    creating the missing monthly partitions from first_month to last_month (included). Returns the created names.
+    """
+    created = []
+    month = first_month
+    while month <= last_month:
+        if create_partition(cursor, month):
+            created.append(partition_name(month))
+        month = add_months(month, 1)
+    return created
+
+
+def detach_partition(cursor, name):
+    """
+    Detaching a partition keeps it as a plain table (to archive or drop), its rows aren't visible to the
+    application anymore. Takes a short exclusive lock of the table (DETACH CONCURRENTLY isn't allowed with a
+    default partition).
+    """
+    cursor.execute(f"ALTER TABLE {TABLE} DETACH PARTITION {name}")
+
+
+def convert_table(schema_editor, partitioned, months_ahead=3):
+    """
+    Rebuilding the document versions table as a partitioned table (partitioned=True) or back as a plain table.
+    The rows are copied to the new table, the indexes and foreign keys are re-created with the same names and
+    definitions and the id sequence is kept. It locks the table for the whole copy, run it in a maintenance window.
+    """
+    legacy = f"{TABLE}_legacy"
+    cursor = schema_editor.connection.cursor()
+    cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", [TABLE])
+    sequence = cursor.fetchone()[0]
+    cursor.execute("SELECT indexrelid::regclass::text, pg_get_indexdef(indexrelid) FROM pg_index "
+                   "WHERE indrelid = %s::regclass AND NOT indisprimary", [TABLE])
+    indexes = cursor.fetchall()
+    cursor.execute("SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+                   "WHERE conrelid = %s::regclass AND contype = 'f'", [TABLE])
+    foreign_keys = cursor.fetchall()
+    cursor.execute("SELECT conname FROM pg_constraint WHERE conrelid = %s::regclass AND contype = 'p'", [TABLE])
+    primary_key = cursor.fetchone()[0]
+
+    """
+    freeing the names of the indexes and constraints, they're re-created on the new table after the copy.
+    """
+    for name, definition in indexes:
+        schema_editor.execute(f"DROP INDEX {name}")
+    for name, definition in foreign_keys:
+        schema_editor.execute(f"ALTER TABLE {TABLE} DROP CONSTRAINT {name}")
+    schema_editor.execute(f"ALTER TABLE {TABLE} RENAME CONSTRAINT {primary_key} TO {legacy}_pkey")
+    schema_editor.execute(f"ALTER TABLE {TABLE} RENAME TO {legacy}")
+
+    if partitioned:
+        schema_editor.execute(f"CREATE TABLE {TABLE} (LIKE {legacy} INCLUDING DEFAULTS) "
+                              f"PARTITION BY RANGE (created_on)")
+        schema_editor.execute(f"ALTER TABLE {TABLE} ADD CONSTRAINT {primary_key} PRIMARY KEY (id, created_on)")
+        schema_editor.execute(f"CREATE TABLE {DEFAULT_PARTITION} PARTITION OF {TABLE} DEFAULT")
+        cursor.execute(f"SELECT MIN(created_on) FROM {legacy}")
+        oldest = cursor.fetchone()[0]
+        this_month = datetime.date.today().replace(day=1)
+        first_month = oldest.date().replace(day=1) if oldest else this_month
+        ensure_partitions(cursor, min(first_month, this_month), add_months(this_month, months_ahead))
+    else:
+        schema_editor.execute(f"CREATE TABLE {TABLE} (LIKE {legacy} INCLUDING DEFAULTS)")
+        schema_editor.execute(f"ALTER TABLE {TABLE} ADD CONSTRAINT {primary_key} PRIMARY KEY (id)")
+
+    schema_editor.execute(f"INSERT INTO {TABLE} SELECT * FROM {legacy}")
+    schema_editor.execute(f"ALTER SEQUENCE {sequence} OWNED BY {TABLE}.id")
+    schema_editor.execute(f"DROP TABLE {legacy} CASCADE")
+
+    for name, definition in indexes:
+        schema_editor.execute(definition)
+    for name, definition in foreign_keys:
+        schema_editor.execute(f"ALTER TABLE {TABLE} ADD CONSTRAINT {name} {definition}")
+    schema_editor.execute(f"ANALYZE {TABLE}")
+
+
+def partition_table(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql" or not is_enabled():
+        return
+    with schema_editor.connection.cursor() as cursor:
+        if is_partitioned(cursor):
+            return
+    convert_table(schema_editor, partitioned=True)
+
+
+def unpartition_table(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    with schema_editor.connection.cursor() as cursor:
+        if not is_partitioned(cursor):
+            return
+    convert_table(schema_editor, partitioned=False)
@@ -1,9 +1,12 @@
 import uuid
 from rest_framework import serializers
-from .models import Document, DocumentVersion
+from .models import Document, DocumentVersion, ChangeLogEntry
 from users.models import User
-from users.serializers import UserMinimalListSerializer
+from users.serializers import UserMinimalListSerializer, UserMinimalListValuesSerializer
+from helpers.signed_urls import SignedFileField
+from helpers.values_serializers import ValuesSerializer
 import pathlib
+from django.conf import settings
 
 
 class DocumentCreateSerializer(serializers.ModelSerializer):
@@ -28,6 +31,7 @@ class DocumentCreateSerializer(serializers.ModelSerializer):
         the user.
         """
         exclude = ("shared_with", "currently_edited_by")
+        read_only_fields = ("version_count", "latest_version", "last_updated_by", "updated_on", "storage_bytes")
 
 
 class DocumentUpdateSerializer(serializers.ModelSerializer):
@@ -40,7 +44,8 @@ class DocumentUpdateSerializer(serializers.ModelSerializer):
         excluding the only fields that are either getting auto-updated or updated through API.
         'document' field is mentioned here because we have a seprated API to updated the document. 
         """
-        exclude = ("currently_edited_by", "document", "created_on", "shared_with")
+        exclude = ("currently_edited_by", "document", "created_on", "shared_with", "version_count",
+                   "latest_version", "last_updated_by", "updated_on", "storage_bytes")
 
 
 class DocumentListSerializer(serializers.ModelSerializer):
@@ -50,14 +55,16 @@ class DocumentListSerializer(serializers.ModelSerializer):
 
     owner = UserMinimalListSerializer()
     currently_edited_by = UserMinimalListSerializer()
+    last_updated_by = UserMinimalListSerializer()
     shared_with = serializers.SerializerMethodField()
 
     def get_shared_with(self, obj):
         """
         Instead of returning a list with ids (eg. [1,2,3]). It returns a list with user object dict.
         Check the APIdocumentation PDF mentioned in the README.md
+        The users are ordered by id so the list is the same on every database.
         """
-        user_qs = User.objects.filter(id__in=obj.shared_with)
+        user_qs = User.objects.filter(id__in=obj.shared_with).order_by("id")
         return UserMinimalListSerializer(user_qs, many=True).data
 
     class Meta:
@@ -65,6 +72,27 @@ class DocumentListSerializer(serializers.ModelSerializer):
         fields = "__all__"
 
 
+class DocumentListValuesSerializer(ValuesSerializer):
+    """
+    values() serializer of the document list, same output as DocumentListSerializer. The collaborators of all the
+    documents of the page are fetched with a single query.
+    """
+    serializer_class = DocumentListSerializer
+    method_columns = {"shared_with": "shared_with"}
+
+    def prepare(self, rows):
+        user_ids = {user_id for row in rows for user_id in row["shared_with"]}
+        users = UserMinimalListValuesSerializer(UserMinimalListValuesSerializer.values(
+            User.objects.filter(id__in=user_ids).order_by("id"))).data if user_ids else []
+        self.users = {user["id"]: user for user in users}
+
+    def get_shared_with(self, row):
+        """
+        same as DocumentListSerializer.get_shared_with: every collaborator once, in the order of their ids.
+        """
+        return [self.users[user_id] for user_id in sorted(set(row["shared_with"])) if user_id in self.users]
+
+
 class DocumentMinimalListSerializer(serializers.ModelSerializer):
     """
     Document serializer with minimal document object info that is used in as a nested serializer in other
@@ -141,16 +169,38 @@ class RemoveCollaboratorSerializer(serializers.Serializer):
 class DocumentVersionListSerializer(serializers.ModelSerializer):
     """
     Document version serializer used for the GET action
+    diff_file is a short lived signed URL (settings.SIGNED_MEDIA_TTL), the media directories aren't served.
     """
 
     updated_by = UserMinimalListSerializer()
     parent_document = DocumentMinimalListSerializer()
+    diff_file = SignedFileField()
 
     class Meta:
         model = DocumentVersion
         fields = "__all__"
 
 
+class DocumentVersionListValuesSerializer(ValuesSerializer):
+    """
+    values() serializer of the document version list, same output as DocumentVersionListSerializer
+    """
+    serializer_class = DocumentVersionListSerializer
+
+
+class DocumentVersionTimelineSerializer(serializers.ModelSerializer):
+    """
+    Document version serializer used for the version timeline of a document. Only has the metadata of the version,
+    the file fields are not loaded.
+    """
+
+    updated_by = UserMinimalListSerializer()
+
+    class Meta:
+        model = DocumentVersion
+        fields = ("id", "created_on", "updated_by")
+
+
 class UploadEditedDocumentSerializer(serializers.ModelSerializer):
     """
     Serializer used for POST action of the API responsible for the uploading edited documents.
@@ -180,3 +230,31 @@ class UploadEditedDocumentSerializer(serializers.ModelSerializer):
     class Meta:
         model = Document
         fields = ("document", )
+
+
+class BulkDownloadSerializer(serializers.Serializer):
+    """
+    Bulk download serializer used for the POST action. 'documents' are downloaded in their current revision and
+    'versions' in the revision of those document versions. 'lock' acquires the edit lock of the documents.
+    """
+    documents = serializers.ListField(child=serializers.IntegerField(), required=False, default=list)
+    versions = serializers.ListField(child=serializers.IntegerField(), required=False, default=list)
+    lock = serializers.BooleanField(required=False, default=False)
+
+    def validate(self, attrs):
+        if not attrs["documents"] and not attrs["versions"]:
+            raise serializers.ValidationError("Select at least one document or document version.")
+        max_files = getattr(settings, "BULK_DOWNLOAD_MAX_FILES", 500)
+        if len(set(attrs["documents"])) + len(set(attrs["versions"])) > max_files:
+            raise serializers.ValidationError(f"Cannot download more than {max_files} files at once.")
+        return attrs
+
+
+class ChangeLogEntrySerializer(serializers.ModelSerializer):
+    """
+    Change serializer used for the change feed
+    """
+
+    class Meta:
+        model = ChangeLogEntry
+        fields = ("document_id", "kind", "payload", "created_on")
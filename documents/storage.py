@@ -0,0 +1,103 @@
+import io
+import os
+import re
+import threading
+import uuid
+
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.utils.deconstruct import deconstructible
+
+from documents import packs
+
+SHARDED_NAME = re.compile(r"^[^/]+/[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{32}")
+
+
+@deconstructible
+class ShardedUploadTo:
+    """
+    upload_to of the document file fields. Files are stored in two levels of 256 sub directories under the prefix,
+    keyed by the first hex digits of a random 128 bit id, eg. 'document/3f/a2/3fa2c1...e9.pdf', so no directory
+    grows past a few thousand entries. The extension of the uploaded file is kept.
+    prefix[string]: top level directory of the field (eg. 'document')
+    """
+
+    def __init__(self, prefix):
+        self.prefix = prefix.strip("/")
+
+    def __call__(self, instance, filename):
+        key = uuid.uuid4().hex
+        return f"{self.prefix}/{key[:2]}/{key[2:4]}/{key}{os.path.splitext(filename)[1].lower()}"
+
+    @staticmethod
+    def is_sharded(name):
+        return bool(SHARDED_NAME.match(name or ""))
+
+    def __eq__(self, other):
+        return isinstance(other, ShardedUploadTo) and self.prefix == other.prefix
+
+
+class PackAwareStorage(FileSystemStorage):
+    """
+    Media storage (settings.DEFAULT_FILE_STORAGE) that also reads the document version files archived in pack files
+    by 'manage.py pack_versions' (see documents.packs), through the same open/exists/size calls as the other files.
+    The loose files are found first and cost no query. An archived file is looked up in the offset index
+    (PackedFile) and read with a seek into its pack, the checksum of the file is checked when it's read to the end.
+    Archived files have no path on disk.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.local = threading.local()
+
+    @staticmethod
+    def packed_file(name):
+        from documents.models import PackedFile
+        return PackedFile.objects.select_related("pack").filter(name=name).first()
+
+    def _open(self, name, mode="rb"):
+        try:
+            return super()._open(name, mode)
+        except FileNotFoundError:
+            packed_file = None if set(mode) & set("wax+") else self.packed_file(name)
+            if packed_file is None:
+                raise
+        reader = packs.PackedFileReader(self.path(packed_file.pack.name), packed_file.offset, packed_file.size,
+                                        packed_file.checksum, name)
+        file_obj = File(io.BufferedReader(reader, buffer_size=packs.CHUNK_SIZE), name=name)
+        file_obj.size = packed_file.size
+        return file_obj
+
+    def exists(self, name):
+        if super().exists(name):
+            return True
+        return not getattr(self.local, "loose_only", False) and self.packed_file(name) is not None
+
+    def get_available_name(self, name, max_length=None):
+        """
+        New names are only checked against the loose files so saving a file doesn't cost a query. The names of the
+        file fields are random (ShardedUploadTo), an archived name is never given to a new file.
+        """
+        self.local.loose_only = True
+        try:
+            return super().get_available_name(name, max_length=max_length)
+        finally:
+            self.local.loose_only = False
+
+    def size(self, name):
+        try:
+            return super().size(name)
+        except FileNotFoundError:
+            packed_file = self.packed_file(name)
+            if packed_file is None:
+                raise
+            return packed_file.size
+
+    def delete(self, name):
+        """
+        Deleting an archived file only removes it from the index, its bytes stay in the (append only) pack.
+        """
+        if super().exists(name):
+            return super().delete(name)
+        from documents.models import PackedFile
+        PackedFile.objects.filter(name=name).delete()
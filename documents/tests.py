@@ -1,3 +1,1226 @@
-from django.test import TestCase
+import datetime
+import difflib
+import io
+import multiprocessing
+import os
+import random
+import re
+import tempfile
+import zipfile
+from concurrent.futures.process import BrokenProcessPool
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.http import StreamingHttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.client import BOUNDARY, MULTIPART_CONTENT, encode_multipart
+from rest_framework.renderers import JSONRenderer
+from django.urls import resolve
+from rest_framework.test import APIRequestFactory
+
+from documents import diff_cache, diffing, events, hunks, packs, parallel_diff, partitioning, usage, views
+from documents.management.commands import partition_document_versions
+from helpers import metrics, signed_urls
+from documents.models import ChangeLogEntry, Document, DocumentVersion, PackedFile
+from documents.serializers import DocumentListSerializer, DocumentListValuesSerializer,\
+    DocumentVersionListSerializer, DocumentVersionListValuesSerializer
+from helpers.middlewares import AdmissionControlMiddleware
+from helpers.testing import MediaTestMixin, QueryBudgetExceeded, QueryBudgetMixin, assert_query_budget,\
+    auth_header
+from users.models import User
+
+
+class ValuesSerializerTestCase(TestCase):
+    """
+    The values() serializers of the list APIs must render the same JSON as the serializers they replace.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user(username="owner_user", email="owner@example.com",
+                                             first_name="Owner", last_name="User", password="password")
+        cls.collaborator = User.objects.create_user(username="collaborator", email="collaborator@example.com",
+                                                    first_name="Collaborator", last_name="User", password="password")
+        cls.editor = User.objects.create_user(username="editor_user", email="editor@example.com",
+                                              first_name="Editor", last_name="User", password="password")
+
+        """
+        a locked document with versions and a diff, a document without owner or lock whose collaborators include
+        a repeated and a deleted user id, and a document without collaborators.
+        """
+        cls.document = Document.objects.create(document_name="contract", document="document/ab/cd/contract.txt",
+                                               owner=cls.owner, shared_with=[cls.editor.id, cls.collaborator.id],
+                                               currently_edited_by=cls.editor)
+        first_version = DocumentVersion.objects.create(parent_document=cls.document, updated_by=cls.owner,
+                                                       document="document/ab/cd/contract.txt")
+        cls.document.record_version(first_version)
+        second_version = DocumentVersion.objects.create(parent_document=cls.document, updated_by=cls.editor,
+                                                        document="document_version_files/ef/01/contract.txt",
+                                                        diff_file="document_diff_files/23/45/contract.hunks",
+                                                        diff_format="hunks")
+        cls.document.record_version(second_version)
+        Document.objects.create(document_name="orphan", document="document/12/34/orphan.pdf",
+                                shared_with=[cls.collaborator.id, cls.collaborator.id, 987654])
+        Document.objects.create(document_name="private", document="document/56/78/private.txt", owner=cls.collaborator)
+        DocumentVersion.objects.create(parent_document=None, updated_by=cls.collaborator)
+
+    def setUp(self):
+        self.context = {"request": APIRequestFactory().get("/api/v1/document/")}
+
+    def render(self, data):
+        return JSONRenderer().render(data)
+
+    def test_document_list(self):
+        queryset = Document.objects.select_related("owner", "currently_edited_by", "last_updated_by")\
+            .order_by("-created_on")
+        expected = self.render(DocumentListSerializer(queryset, many=True, context=self.context).data)
+        with self.assertNumQueries(2):
+            data = DocumentListValuesSerializer(DocumentListValuesSerializer.values(queryset),
+                                                context=self.context).data
+        self.assertEqual(self.render(data), expected)
+
+    def test_document_list_without_request(self):
+        queryset = Document.objects.order_by("id")
+        self.assertEqual(self.render(DocumentListValuesSerializer(DocumentListValuesSerializer.values(queryset)).data),
+                         self.render(DocumentListSerializer(queryset, many=True).data))
+
+    @mock.patch("helpers.signed_urls.time.time", return_value=1600000000)
+    def test_document_version_list(self, mocked_time):
+        queryset = DocumentVersion.objects.order_by("-created_on")
+        expected = self.render(DocumentVersionListSerializer(queryset, many=True, context=self.context).data)
+        with self.assertNumQueries(1):
+            data = DocumentVersionListValuesSerializer(DocumentVersionListValuesSerializer.values(queryset),
+                                                       context=self.context).data
+        self.assertEqual(self.render(data), expected)
+
+
+def text_content(line_count=200, edits=()):
+    """
+    bytes of a text document, the line numbers in 'edits' are changed.
+    """
+    return "".join(f"edited line {index}\n" if index in edits else f"line {index}\n"
+                   for index in range(line_count)).encode()
+
+
+class DocumentAPITestMixin(MediaTestMixin):
+    """
+    Helpers creating users and documents and editing the documents through the API.
+    """
+
+    @staticmethod
+    def create_user(username):
+        return User.objects.create_user(username=username, email=f"{username}@example.com", first_name="Test",
+                                        last_name="User", password="password")
+
+    def create_document(self, user, content, name="contract.txt", document_name="contract"):
+        api_response = self.client.post("/api/v1/document/", {"document_name": document_name,
+                                                              "document": SimpleUploadedFile(name, content)},
+                                        **auth_header(user))
+        return api_response
+
+    def edit_document(self, user, document_id, content, name="contract.txt"):
+        """
+        fetching (and locking) the document, then uploading the edited content.
+        """
+        fetch_response = self.client.get(f"/api/v1/fetch_document/{document_id}/", **auth_header(user))
+        self.assertEqual(fetch_response.status_code, 200, fetch_response.content)
+        return self.client.patch(f"/api/v1/reupload_document/{document_id}/",
+                                 data=encode_multipart(BOUNDARY, {"document": SimpleUploadedFile(name, content)}),
+                                 content_type=MULTIPART_CONTENT, **auth_header(user))
+
+
+class StorageUsageTestCase(DocumentAPITestMixin, TestCase):
+    """
+    Storage usage counters of the documents and users, maintained by the upload APIs, enforced against the quota and
+    repaired by 'manage.py reconcile_storage_usage'.
+    """
+
+    def setUp(self):
+        self.owner = self.create_user("storage_owner")
+
+    def actual_storage_bytes(self, document_obj):
+        versions = DocumentVersion.objects.filter(parent_document=document_obj)\
+            .values_list("document", "diff_file", "diff_format")
+        return usage.document_storage_bytes(document_obj.document.name, list(versions))
+
+    def assertCountersMatchFiles(self, document_id):
+        document_obj = Document.objects.get(id=document_id)
+        self.assertEqual(document_obj.storage_bytes, self.actual_storage_bytes(document_obj))
+        self.owner.refresh_from_db()
+        self.assertEqual(self.owner.storage_bytes, sum(Document.objects.filter(owner=self.owner)
+                                                       .values_list("storage_bytes", flat=True)))
+        return document_obj
+
+    def test_create_reupload_delete(self):
+        content = text_content()
+        document_id = self.create_document(self.owner, content).json()["id"]
+        document_obj = self.assertCountersMatchFiles(document_id)
+        self.assertEqual(document_obj.storage_bytes, len(content))
+
+        """
+        the same file again only adds the version file, an edit adds the two copies of the new revision with the
+        diff and its index.
+        """
+        self.assertEqual(self.edit_document(self.owner, document_id, content).status_code, 200)
+        document_obj = self.assertCountersMatchFiles(document_id)
+        self.assertEqual(document_obj.storage_bytes, 2 * len(content))
+
+        edited = text_content(edits={10, 150})
+        self.assertEqual(self.edit_document(self.owner, document_id, edited).status_code, 200)
+        document_obj = self.assertCountersMatchFiles(document_id)
+        self.assertGreater(document_obj.storage_bytes, 2 * len(content) + 2 * len(edited))
+
+        self.assertEqual(self.client.delete(f"/api/v1/document/{document_id}/", **auth_header(self.owner))
+                         .status_code, 204)
+        self.owner.refresh_from_db()
+        self.assertEqual(self.owner.storage_bytes, 0)
+
+    def test_counters_not_writable(self):
+        document_id = self.create_document(self.owner, text_content()).json()["id"]
+        api_response = self.client.patch(f"/api/v1/document/{document_id}/", {"storage_bytes": 10 ** 12},
+                                         content_type="application/json", **auth_header(self.owner))
+        self.assertEqual(api_response.status_code, 200)
+        self.assertCountersMatchFiles(document_id)
+
+        self.client.patch(f"/api/v1/user/{self.owner.id}/", {"storage_bytes": -10 ** 12},
+                          content_type="application/json", **auth_header(self.owner))
+        self.assertCountersMatchFiles(document_id)
+
+    def test_quota_rejects_create(self):
+        content = text_content()
+        with override_settings(USER_STORAGE_QUOTA_BYTES=len(content) - 1):
+            api_response = self.create_document(self.owner, content)
+        self.assertEqual(api_response.status_code, 400)
+        self.assertIn("Storage quota exceeded.", api_response.json())
+        self.assertFalse(Document.objects.filter(owner=self.owner).exists())
+        self.owner.refresh_from_db()
+        self.assertEqual(self.owner.storage_bytes, 0)
+
+    def test_quota_rejects_create_in_transaction(self):
+        """
+        an upload passing the check made before the files are written (eg. concurrent uploads) is still rejected
+        by the atomic charge.
+        """
+        content = text_content()
+        with override_settings(USER_STORAGE_QUOTA_BYTES=len(content) - 1), \
+                mock.patch("documents.usage.exceeds_quota", return_value=False):
+            api_response = self.create_document(self.owner, content)
+        self.assertEqual(api_response.status_code, 400)
+        self.assertFalse(Document.objects.filter(owner=self.owner).exists())
+        self.owner.refresh_from_db()
+        self.assertEqual(self.owner.storage_bytes, 0)
+
+    def test_quota_rejects_reupload(self):
+        content = text_content()
+        document_id = self.create_document(self.owner, content).json()["id"]
+        for edited in (content, text_content(edits={3})):
+            for check_first in (True, False):
+                with override_settings(USER_STORAGE_QUOTA_BYTES=len(content) + 10), \
+                        mock.patch("documents.usage.exceeds_quota", wraps=usage.exceeds_quota if check_first
+                                   else lambda user, storage_bytes: False):
+                    api_response = self.edit_document(self.owner, document_id, edited)
+                self.assertEqual(api_response.status_code, 400, api_response.content)
+                self.assertIn("Storage quota exceeded.", api_response.json())
+                document_obj = self.assertCountersMatchFiles(document_id)
+                self.assertEqual(document_obj.version_count, 1)
+                self.assertEqual(document_obj.storage_bytes, len(content))
+
+    def test_charge(self):
+        with override_settings(USER_STORAGE_QUOTA_BYTES=100):
+            usage.charge(self.owner.id, 100)
+            with self.assertRaises(usage.QuotaExceeded):
+                usage.charge(self.owner.id, 1)
+            usage.charge(self.owner.id, -40)
+        self.owner.refresh_from_db()
+        self.assertEqual(self.owner.storage_bytes, 60)
+
+    def test_reconcile_storage_usage(self):
+        document_id = self.create_document(self.owner, text_content()).json()["id"]
+        self.edit_document(self.owner, document_id, text_content(edits={7}))
+        expected = Document.objects.get(id=document_id).storage_bytes
+        Document.objects.filter(id=document_id).update(storage_bytes=5)
+        User.objects.filter(id=self.owner.id).update(storage_bytes=-3)
+
+        call_command("reconcile_storage_usage", "--dry-run", stdout=io.StringIO())
+        self.assertEqual(Document.objects.get(id=document_id).storage_bytes, 5)
+
+        output = io.StringIO()
+        call_command("reconcile_storage_usage", "--batch-size", "1", stdout=output)
+        self.assertIn(f"Documents: 1 checked, 1 drifted by {expected - 5} bytes in total.", output.getvalue())
+        self.assertEqual(self.assertCountersMatchFiles(document_id).storage_bytes, expected)
+        self.assertEqual(self.owner.storage_bytes, expected)
+
+
+class BinaryDeltaTestCase(DocumentAPITestMixin, TestCase):
+    """
+    Binary deltas of the non-text documents rebuild the new revision exactly, also once the scan was cut short.
+    """
+
+    def setUp(self):
+        generator = random.Random(33)
+        self.old = bytes(generator.getrandbits(8) for _ in range(64 * 1024))
+
+    @staticmethod
+    def edited(data, offsets, length=16):
+        data = bytearray(data)
+        for offset in offsets:
+            data[offset:offset + length] = bytes(byte ^ 0xff for byte in data[offset:offset + length])
+        return bytes(data)
+
+    def assertRoundTrip(self, old, new, **kwargs):
+        delta = diffing.binary_delta(old, new, **kwargs)
+        self.assertEqual(diffing.apply_binary_delta(old, delta), new)
+        return delta
+
+    def test_round_trip(self):
+        revisions = [self.edited(self.old, range(1000, len(self.old), 9000)),
+                     b"inserted" + self.old[:30000] + self.old[31000:] + b"appended",
+                     self.old[5000:] + self.old[:5000], self.old[:100], b"", self.old * 2]
+        for new in revisions:
+            self.assertRoundTrip(self.old, new, block_size=512)
+        self.assertRoundTrip(b"", self.old)
+        delta = self.assertRoundTrip(self.old, revisions[0], block_size=512)
+        self.assertLess(len(delta), len(self.old) // 4)
+
+    def test_scan_capped(self):
+        """
+        past max_scan bytes rolled without a match the rest of the changed bytes are stored whole.
+        """
+        new = self.edited(self.old, range(1000, len(self.old), 9000))[:-2000] + os.urandom(2000)
+        scanned = self.assertRoundTrip(self.old, new, block_size=512, max_scan=len(new))
+        capped = self.assertRoundTrip(self.old, new, block_size=512, max_scan=32)
+        self.assertLess(len(scanned), len(self.old) // 4)
+        self.assertGreater(len(capped), len(new) // 2)
+        self.assertEqual(len(self.assertRoundTrip(self.old, os.urandom(len(self.old)), max_scan=0)),
+                         len(self.assertRoundTrip(self.old, os.urandom(len(self.old)))))
+
+    def test_corrupt_delta(self):
+        new = self.edited(self.old, [100])
+        delta = diffing.binary_delta(self.old, new)
+        self.assertRaises(ValueError, diffing.apply_binary_delta, self.old[:-1], delta)
+        self.assertRaises(ValueError, diffing.apply_binary_delta, self.old, delta[:-1])
+        self.assertRaises(ValueError, diffing.apply_binary_delta, self.old, b"not a delta")
+
+    @override_settings(DOCUMENT_DELTA_MAX_SCAN_BYTES=1024)
+    def test_uploaded_revisions(self):
+        owner = self.create_user("delta_owner")
+        revisions = [self.old, self.edited(self.old, [10, 40000]), os.urandom(len(self.old))]
+        document_id = self.create_document(owner, revisions[0], name="contract.bin").json()["id"]
+        for content in revisions[1:]:
+            self.assertEqual(self.edit_document(owner, document_id, content, name="contract.bin").status_code, 200)
+
+        versions = list(DocumentVersion.objects.filter(parent_document_id=document_id).order_by("id"))
+        for version_obj, old, new in zip(versions[1:], revisions, revisions[1:]):
+            self.assertEqual(version_obj.diff_format, "binary")
+            with version_obj.diff_file.open("rb") as diff_file:
+                self.assertEqual(diffing.apply_binary_delta(old, diff_file.read()), new)
+
+
+class DiffCacheTestCase(SimpleTestCase):
+    """
+    Two tier diff cache: memory LRU, disk tier shared by the worker processes, and the hit/miss metric.
+    """
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.cache_settings = override_settings(DIFF_CACHE_DIR=os.path.join(self.directory, "cache"),
+                                                DIFF_CACHE_MEMORY_BYTES=100, DIFF_CACHE_DISK_BYTES=1000)
+        self.cache_settings.enable()
+        self.addCleanup(self.cache_settings.disable)
+        self.cache = diff_cache.DiffCache()
+
+    @staticmethod
+    def requests():
+        values = metrics.CACHE_REQUESTS.collect()
+        return values.get(("diff", "hit"), 0), values.get(("diff", "miss"), 0)
+
+    def assertRequests(self, before, hits, misses):
+        self.assertEqual(self.requests(), (before[0] + hits, before[1] + misses))
+
+    def test_hit_and_miss(self):
+        before = self.requests()
+        self.assertIsNone(self.cache.get("a" * 64))
+        self.cache.set("a" * 64, "hunks", b"diff")
+        self.assertEqual(self.cache.get("a" * 64), ("hunks", b"diff"))
+        self.assertRequests(before, 1, 1)
+
+        self.cache.set("b" * 64, "hunks", b"x" * 101)
+        with self.settings(DIFF_CACHE_MAX_ENTRY_BYTES=10):
+            self.cache.set("c" * 64, "hunks", b"x" * 11)
+        self.assertIsNone(self.cache.get("c" * 64))
+
+    def test_memory_eviction(self):
+        with self.settings(DIFF_CACHE_DIR=None):
+            for key in "abc":
+                self.cache.set(key * 64, "hunks", key.encode() * 40)
+                if key == "b":
+                    self.cache.get("a" * 64)
+            self.assertEqual(list(self.cache.memory), ["a" * 64, "c" * 64])
+            self.assertEqual(self.cache.memory_size, 80)
+
+            before = self.requests()
+            self.assertIsNone(self.cache.get("b" * 64))
+            self.assertEqual(self.cache.get("a" * 64), ("hunks", b"a" * 40))
+            self.assertRequests(before, 1, 1)
+
+    def test_disk_tier(self):
+        """
+        an entry evicted from (or never in) the memory of this process is read from the disk and promoted.
+        """
+        self.cache.set("d" * 64, "binary", b"\ndelta\n")
+        other_process = diff_cache.DiffCache()
+        self.assertEqual(other_process.memory_size, 0)
+        before = self.requests()
+        self.assertEqual(other_process.get("d" * 64), ("binary", b"\ndelta\n"))
+        self.assertRequests(before, 1, 0)
+        self.assertIn("d" * 64, other_process.memory)
+
+        for key in "efgh":
+            self.cache.set(key * 64, "hunks", key.encode() * 90)
+        self.assertNotIn("d" * 64, self.cache.memory)
+        self.assertEqual(self.cache.get("d" * 64), ("binary", b"\ndelta\n"))
+
+    def test_disk_trimmed(self):
+        for index, key in enumerate("abcdef"):
+            self.cache.set(key * 64, "hunks", key.encode() * 300)
+            os.utime(self.cache.disk_path(key * 64), (1000 + index, 1000 + index))
+        self.cache.trim_disk()
+        self.assertLessEqual(self.cache.disk_size, 900)
+        self.cache.memory.clear()
+        self.assertIsNone(self.cache.get("a" * 64))
+        self.assertEqual(self.cache.get("f" * 64), ("hunks", b"f" * 300))
+
+    def test_write_diff_cached(self):
+        old_path, new_path = os.path.join(self.directory, "old.txt"), os.path.join(self.directory, "new.txt")
+        with open(old_path, "wb") as old_file, open(new_path, "wb") as new_file:
+            old_file.write(text_content())
+            new_file.write(text_content(edits={3}))
+        with mock.patch.object(diff_cache, "diff_cache", self.cache):
+            diffing.write_diff("hunks", old_path, new_path, os.path.join(self.directory, "first.hunks"))
+            with mock.patch.object(diffing, "compute_diff") as compute_diff:
+                self.assertEqual(diffing.write_diff("hunks", old_path, new_path,
+                                                    os.path.join(self.directory, "second.hunks")), "hunks")
+            compute_diff.assert_not_called()
+        with open(os.path.join(self.directory, "first.hunks"), "rb") as first, \
+                open(os.path.join(self.directory, "second.hunks"), "rb") as second:
+            self.assertEqual(first.read(), second.read())
+
+
+@override_settings(DOCUMENT_DIFF_PARALLELISM=2)
+class ParallelDiffTestCase(SimpleTestCase):
+    """
+    The parallel diff must give the output of the sequential difflib, in the process pool and in the fallback to
+    the calling process.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        generator = random.Random(34)
+        """
+        blank and closing lines are 'popular' (SequenceMatcher's autojunk), the rest are mostly unique.
+        """
+        cls.old = [generator.choice(["\n", "}\n", f"line {index}\n", f"value = {index % 50}\n"])
+                   for index in range(3000)]
+        cls.new = list(cls.old)
+        for index in sorted(generator.sample(range(3000), 60), reverse=True):
+            operation = generator.choice(["replace", "insert", "delete"])
+            if operation == "replace":
+                cls.new[index] = cls.new[index].replace("line", "edited line", 1)
+            elif operation == "insert":
+                cls.new[index:index] = [f"inserted {index}\n", "\n"]
+            else:
+                del cls.new[index:index + 3]
+
+    @classmethod
+    def tearDownClass(cls):
+        parallel_diff.reset_executor(parallel_diff._executor)
+        super().tearDownClass()
+
+    def assertSameAsDifflib(self):
+        self.assertEqual(parallel_diff.parallel_opcodes(self.old, self.new),
+                         difflib.SequenceMatcher(None, self.old, self.new).get_opcodes())
+        self.assertEqual(list(parallel_diff.parallel_ndiff(self.old, self.new)),
+                         list(difflib.ndiff(self.old, self.new)))
+
+    def test_same_as_difflib(self):
+        self.assertSameAsDifflib()
+        self.assertIsNotNone(parallel_diff._executor)
+
+    def test_should_parallelize(self):
+        with self.settings(DOCUMENT_DIFF_PARALLEL_THRESHOLD=len(self.old) + len(self.new)):
+            self.assertTrue(parallel_diff.should_parallelize(self.old, self.new))
+            self.assertFalse(parallel_diff.should_parallelize(self.old, self.new[1:]))
+            with self.settings(DOCUMENT_DIFF_PARALLELISM=1):
+                self.assertFalse(parallel_diff.should_parallelize(self.old, self.new))
+
+    def test_broken_pool_fallback(self):
+        """
+        a pool that can't spawn its workers (or broke) is dropped and the diff is finished in this process.
+        """
+        broken = mock.Mock()
+        broken.map.side_effect = BrokenProcessPool("A child process terminated abruptly.")
+        with mock.patch.object(parallel_diff, "get_executor", return_value=broken), \
+                self.assertLogs("signeasy.parallel_diff", "WARNING") as logs:
+            self.assertSameAsDifflib()
+        self.assertEqual(broken.map.call_count, len(logs.output))
+        broken.shutdown.assert_called_with(wait=False)
+
+        with mock.patch.object(parallel_diff, "ProcessPoolExecutor", side_effect=OSError("Too many open files")), \
+                mock.patch.object(parallel_diff, "_executor", None), self.assertLogs("signeasy.parallel_diff"):
+            self.assertSameAsDifflib()
+            self.assertIsNone(parallel_diff._executor)
+
+    def test_pool_start_method(self):
+        """
+        spawned workers on python 3.7+, mp_context isn't accepted by the ProcessPoolExecutor of python 3.6.
+        """
+        for version, options in (((3, 6, 15), {}),
+                                 ((3, 7, 0), {"mp_context": multiprocessing.get_context("spawn")})):
+            with mock.patch.object(parallel_diff, "_executor", None), \
+                    mock.patch.object(parallel_diff, "ProcessPoolExecutor") as executor_class, \
+                    mock.patch.object(parallel_diff, "sys", mock.Mock(version_info=version)):
+                self.assertIs(parallel_diff.get_executor(), executor_class.return_value)
+                self.assertIs(parallel_diff.get_executor(), executor_class.return_value)
+            executor_class.assert_called_once_with(max_workers=2, **options)
+
+
+class QueryBudgetTestCase(DocumentAPITestMixin, QueryBudgetMixin, TransactionTestCase):
+    """
+    The document APIs must stay within the query budgets declared on their views, whatever the number of versions
+    and collaborators. A TransactionTestCase: inside the transaction of a TestCase the atomic blocks of the views
+    become savepoints, queries that production requests don't run.
+    """
+
+    def setUp(self):
+        self.owner = self.create_user("budget_owner")
+        self.auth = auth_header(self.owner)
+        self.document_id = self.create_document(self.owner, text_content()).json()["id"]
+        for index in range(3):
+            collaborator = self.create_user(f"budget_collaborator_{index}")
+            self.client.post("/api/v1/add_document_collaborator/", {"document_id": self.document_id,
+                                                                    "collaborator": collaborator.id}, **self.auth)
+            self.assertEqual(self.edit_document(self.owner, self.document_id, text_content(edits={index * 10}))
+                             .status_code, 200)
+        self.version = DocumentVersion.objects.filter(parent_document_id=self.document_id).latest("id")
+
+    def assertGetWithinBudget(self, view_class, url, params=None):
+        with self.assertWithinQueryBudget(view_class, "GET"):
+            api_response = self.client.get(url, params, **self.auth)
+            self.assertEqual(api_response.status_code, 200, api_response.content)
+        return api_response
+
+    def test_read_apis(self):
+        self.assertGetWithinBudget(views.DocumentVersionTimelineView, f"/api/v1/document/{self.document_id}/versions/")
+        self.assertGetWithinBudget(views.DocumentVersionHunksView, f"/api/v1/document_version/{self.version.id}/hunks/")
+        self.assertGetWithinBudget(views.DocumentVersionHunksView, f"/api/v1/document_version/{self.version.id}/hunks/",
+                                   {"format": "unified"})
+        self.assertGetWithinBudget(views.DocumentVersionDownloadURLView,
+                                   f"/api/v1/document_version/{self.version.id}/download_urls/")
+        self.assertGetWithinBudget(views.StorageUsageView, "/api/v1/storage_usage/")
+        self.assertGetWithinBudget(views.ChangeFeedView, "/api/v1/changes/", {"limit": 50})
+
+    def test_fetch_and_reupload(self):
+        self.assertGetWithinBudget(views.FetchDocumentView, f"/api/v1/fetch_document/{self.document_id}/")
+        with self.assertWithinQueryBudget(views.UploadEditedDocumentView, "PATCH"):
+            api_response = self.client.patch(f"/api/v1/reupload_document/{self.document_id}/",
+                                             data=encode_multipart(BOUNDARY, {"document": SimpleUploadedFile(
+                                                 "contract.txt", text_content(edits={99}))}),
+                                             content_type=MULTIPART_CONTENT, **self.auth)
+            self.assertEqual(api_response.status_code, 200, api_response.content)
+
+    def test_bulk_download(self):
+        versions = list(DocumentVersion.objects.filter(parent_document_id=self.document_id).values_list("id",
+                                                                                                         flat=True))
+        with self.assertWithinQueryBudget(views.BulkDownloadView, "POST"):
+            api_response = self.client.post("/api/v1/download_documents/", {"documents": [self.document_id],
+                                                                            "versions": versions},
+                                            content_type="application/json", **self.auth)
+            self.assertEqual(api_response.status_code, 200)
+            archive = zipfile.ZipFile(io.BytesIO(b"".join(api_response.streaming_content)))
+        self.assertIsNone(archive.testzip())
+
+    def test_budget_exceeded(self):
+        with self.assertRaises(QueryBudgetExceeded):
+            with self.assertWithinQueryBudget(views.StorageUsageView, budget=0):
+                self.client.get("/api/v1/storage_usage/", **self.auth)
+        with self.assertRaises(ValueError):
+            with self.assertWithinQueryBudget(views.AddCollaboratorView, "POST"):
+                pass
+
+
+class SignedURLTestCase(DocumentAPITestMixin, TestCase):
+    """
+    Signed media URLs: signature, expiry and tampering, and the downloads of the diff files listed by the version
+    list (the media directories aren't served).
+    """
+
+    def setUp(self):
+        self.owner = self.create_user("signed_owner")
+        self.document_id = self.create_document(self.owner, text_content()).json()["id"]
+        self.edit_document(self.owner, self.document_id, text_content(edits={42}))
+        self.version = DocumentVersion.objects.filter(parent_document_id=self.document_id).latest("id")
+
+    def test_verify(self):
+        name = "document_diff_files/ab/cd/abcd.hunks"
+        url, expires = signed_urls.make_signed_url(name, ttl=60, now=1000)
+        self.assertTrue(url.startswith(f"/signed-media/{name}?"))
+        signature = signed_urls.sign(name, expires)
+        self.assertTrue(signed_urls.verify(name, expires, signature, now=1060))
+        self.assertFalse(signed_urls.verify(name, expires, signature, now=1061))
+        self.assertFalse(signed_urls.verify("document_diff_files/ab/cd/abce.hunks", expires, signature, now=1000))
+        self.assertFalse(signed_urls.verify(name, expires + 3600, signature, now=1000))
+        self.assertFalse(signed_urls.verify(name, expires, signature[:-1] + ("A" if signature[-1] != "A" else "B"),
+                                            now=1000))
+        self.assertFalse(signed_urls.verify(name, "soon", signature, now=1000))
+        self.assertFalse(signed_urls.verify(name, expires, None, now=1000))
+        with override_settings(SIGNED_MEDIA_KEY="another key"):
+            self.assertFalse(signed_urls.verify(name, expires, signature, now=1000))
+
+    def listed_diff_url(self):
+        versions = self.client.get("/api/v1/document_version/?remove_pagination=true",
+                                   **auth_header(self.owner)).json()
+        versions = versions["results"] if isinstance(versions, dict) else versions
+        diff_url = next(version["diff_file"] for version in versions if version["id"] == self.version.id)
+        return diff_url.replace("http://testserver", "")
+
+    def test_listed_diff_url(self):
+        diff_url = self.listed_diff_url()
+        self.assertTrue(diff_url.startswith(f"/signed-media/{self.version.diff_file.name}?"))
+        api_response = self.client.get(diff_url)
+        self.assertEqual(api_response.status_code, 200)
+        with self.version.diff_file.open("rb") as diff_file:
+            self.assertEqual(b"".join(api_response.streaming_content), diff_file.read())
+        self.assertEqual(self.client.head(diff_url).status_code, 200)
+        self.assertEqual(self.client.post(diff_url).status_code, 405)
+
+    def test_tampered_and_expired_urls(self):
+        diff_url = self.listed_diff_url()
+        path, query = diff_url.split("?")
+        self.assertEqual(self.client.get(f"{path}x?{query}").status_code, 403)
+        self.assertEqual(self.client.get(diff_url.replace("signature=", "signature=x")).status_code, 403)
+        expires = int(query.split("expires=")[1].split("&")[0])
+        self.assertEqual(self.client.get(diff_url.replace(f"expires={expires}", f"expires={expires + 1}"))
+                         .status_code, 403)
+        self.assertEqual(self.client.get(path).status_code, 403)
+        with mock.patch("helpers.signed_urls.time.time", return_value=expires + 1):
+            self.assertEqual(self.client.get(diff_url).status_code, 403)
+
+        url, _ = signed_urls.make_signed_url("document_diff_files/00/00/missing.hunks")
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_media_directories_not_served(self):
+        for name in (self.version.diff_file.name, self.version.document.name,
+                     f"{self.version.diff_file.name}.idx"):
+            self.assertEqual(self.client.get(f"/media/{name}").status_code, 401)
+            self.assertEqual(self.client.get(f"/media/{name}", **auth_header(self.owner)).status_code, 401)
+
+    def test_serve_modes(self):
+        name = self.version.diff_file.name
+        url, _ = signed_urls.make_signed_url(name)
+        with override_settings(MEDIA_SERVE_MODE="x-accel-redirect"):
+            api_response = self.client.get(url)
+        self.assertEqual(api_response["X-Accel-Redirect"], f"/protected-media/{name}")
+        self.assertEqual(api_response.content, b"")
+        with override_settings(MEDIA_SERVE_MODE="x-sendfile"):
+            api_response = self.client.get(url)
+        self.assertEqual(api_response["X-Sendfile"], self.version.diff_file.path)
+
+
+class HunksTestCase(DocumentAPITestMixin, TestCase):
+    """
+    Hunks API: slicing the hunk sequence through its offset index, paging through a diff and rebuilding a missing
+    index.
+    """
+
+    def setUp(self):
+        self.owner = self.create_user("hunks_owner")
+        self.edits = set(range(5, 1000, 20))
+        self.document_id = self.create_document(self.owner, text_content(1000)).json()["id"]
+        self.assertEqual(self.edit_document(self.owner, self.document_id, text_content(1000, self.edits))
+                         .status_code, 200)
+        self.version = DocumentVersion.objects.filter(parent_document_id=self.document_id).latest("id")
+        with self.version.diff_file.open("rb") as diff_file:
+            self.hunks = list(hunks.read_hunks(diff_file)[1])
+
+    def get_hunks(self, **params):
+        api_response = self.client.get(f"/api/v1/document_version/{self.version.id}/hunks/", params,
+                                       **auth_header(self.owner))
+        self.assertEqual(api_response.status_code, 200, api_response.content)
+        return api_response.json()
+
+    def test_hunk_sequence(self):
+        self.assertEqual(len(self.hunks), len(self.edits))
+        with self.version.diff_file.open("rb") as diff_file:
+            index_file = io.BytesIO()
+            hunks.write_index(diff_file, index_file)
+            sequence = hunks.HunkSequence(diff_file, index_file)
+            self.assertEqual(len(sequence), len(self.hunks))
+            for item in (slice(0, 1), slice(3, 17), slice(45, 60), slice(-3, None), slice(10, 5), slice(None)):
+                self.assertEqual(sequence[item], self.hunks[item])
+            self.assertEqual(sequence[0], self.hunks[0])
+            self.assertEqual(sequence[-1], self.hunks[-1])
+            self.assertRaises(IndexError, sequence.__getitem__, len(self.hunks))
+            self.assertRaises(IndexError, sequence.__getitem__, -len(self.hunks) - 1)
+            self.assertRaises(ValueError, sequence.__getitem__, slice(0, 10, 2))
+        self.assertEqual(len(hunks.HunkSequence(io.BytesIO(), io.BytesIO())), 0)
+
+    def test_pages(self):
+        collected, offset = [], 0
+        while True:
+            page = self.get_hunks(limit=7, offset=offset)
+            self.assertEqual(page["count"], len(self.hunks))
+            collected.extend(page["results"])
+            offset += 7
+            if page["next"] is None:
+                break
+        self.assertEqual(collected, self.hunks)
+        self.assertEqual(self.get_hunks()["results"], self.hunks[:50])
+        self.assertEqual(self.get_hunks(limit=1000)["results"], self.hunks)
+        self.assertEqual(self.get_hunks(offset=len(self.hunks))["results"], [])
+
+        first = self.hunks[0]
+        self.assertEqual(first["new"], [2, 9])
+        self.assertEqual([op[0] for op in first["ops"]], ["equal", "replace", "equal"])
+
+    def test_missing_index_rebuilt(self):
+        index_name = diffing.hunk_index_name(self.version.diff_file.name)
+        with default_storage.open(index_name, "rb") as index_file:
+            index = index_file.read()
+        default_storage.delete(index_name)
+
+        self.assertEqual(self.get_hunks(limit=5, offset=10)["results"], self.hunks[10:15])
+        with default_storage.open(index_name, "rb") as index_file:
+            self.assertEqual(index_file.read(), index)
+
+    def test_only_owner_and_collaborators(self):
+        outsider, collaborator = self.create_user("hunks_outsider"), self.create_user("hunks_collaborator")
+        url = f"/api/v1/document_version/{self.version.id}/hunks/"
+        for params in ({}, {"format": "unified"}, {"format": "ndiff"}):
+            api_response = self.client.get(url, params, **auth_header(outsider))
+            self.assertEqual(api_response.status_code, 400)
+            self.assertNotIn(b"edited line", api_response.content)
+        self.assertEqual(self.client.get(url).status_code, 401)
+
+        self.client.post("/api/v1/add_document_collaborator/", {"document_id": self.document_id,
+                                                                "collaborator": collaborator.id},
+                         **auth_header(self.owner))
+        api_response = self.client.get(url, {"format": "unified"}, **auth_header(collaborator))
+        self.assertEqual(api_response.status_code, 200)
+        self.assertIn(b"+edited line 5", api_response.content)
+
+    def test_not_a_text_diff(self):
+        self.version.diff_format = diffing.DIFF_FORMAT_BINARY
+        self.version.save(update_fields=["diff_format"])
+        self.assertEqual(self.client.get(f"/api/v1/document_version/{self.version.id}/hunks/",
+                                         **auth_header(self.owner)).status_code, 400)
+        self.assertEqual(self.client.get("/api/v1/document_version/0/hunks/", **auth_header(self.owner))
+                         .status_code, 400)
+
+
+class TextDiffTestCase(DocumentAPITestMixin, TestCase):
+    """
+    The diffs rendered as text (?format=unified|ndiff of the hunks API) must match difflib for the two revisions.
+    """
+
+    def setUp(self):
+        self.owner = self.create_user("diff_owner")
+        self.revisions = [text_content(300), text_content(300, {5, 6, 150}), text_content(300, {0, 299}),
+                          text_content(300, {0, 299})[:-40] + b"appended line\n"]
+        self.document_id = self.create_document(self.owner, self.revisions[0]).json()["id"]
+        for content in self.revisions[1:]:
+            self.assertEqual(self.edit_document(self.owner, self.document_id, content).status_code, 200)
+        self.versions = list(DocumentVersion.objects.filter(parent_document_id=self.document_id).order_by("id"))
+
+    def render(self, version_id, style):
+        api_response = self.client.get(f"/api/v1/document_version/{version_id}/hunks/", {"format": style},
+                                       **auth_header(self.owner))
+        self.assertEqual(api_response.status_code, 200, api_response.content)
+        return api_response.content.decode()
+
+    @staticmethod
+    def lines(content):
+        return content.decode().splitlines(keepends=True)
+
+    def test_matches_difflib(self):
+        for version_obj, old, new in zip(self.versions[1:], self.revisions, self.revisions[1:]):
+            self.assertEqual(version_obj.diff_format, "hunks")
+            old_lines, new_lines = self.lines(old), self.lines(new)
+            self.assertEqual(self.render(version_obj.id, "unified"),
+                             "".join(difflib.unified_diff(old_lines, new_lines)))
+            self.assertEqual(self.render(version_obj.id, "ndiff"), "".join(difflib.ndiff(old_lines, new_lines)))
+
+    def test_legacy_ndiff_files(self):
+        old_lines, new_lines = self.lines(self.revisions[0]), self.lines(self.revisions[1])
+        version_obj = self.versions[1]
+        version_obj.diff_file.save("legacy.txt", ContentFile("".join(difflib.ndiff(old_lines, new_lines))),
+                                   save=False)
+        version_obj.diff_format = "ndiff"
+        version_obj.save()
+
+        self.assertEqual(self.render(version_obj.id, "unified"), "".join(difflib.unified_diff(old_lines, new_lines)))
+        self.assertEqual(self.render(version_obj.id, "ndiff"), "".join(difflib.ndiff(old_lines, new_lines)))
+        self.assertEqual(self.client.get(f"/api/v1/document_version/{version_obj.id}/hunks/",
+                                         **auth_header(self.owner)).status_code, 400)
+
+    def test_render_text_diff(self):
+        with self.versions[1].diff_file.open("rb") as diff_file:
+            self.assertRaises(ValueError, diffing.render_text_diff, "hunks", diff_file, None, "ndiff")
+            diff_file.seek(0)
+            self.assertRaises(ValueError, diffing.render_text_diff, "hunks", diff_file, None, "context")
+            self.assertRaises(ValueError, diffing.render_text_diff, "binary", diff_file)
+        self.assertEqual(self.client.get(f"/api/v1/document_version/{self.versions[1].id}/hunks/",
+                                         {"format": "context"}, **auth_header(self.owner)).status_code, 404)
+
+
+class VersionPackTestCase(DocumentAPITestMixin, TestCase):
+    """
+    Files archived by 'manage.py pack_versions' stay readable through every API exposing them.
+    """
+
+    def setUp(self):
+        self.owner = self.create_user("pack_owner")
+        self.document_id = self.create_document(self.owner, text_content(2000)).json()["id"]
+        for edits in ({10}, {10, 1500}, {700}):
+            self.assertEqual(self.edit_document(self.owner, self.document_id, text_content(2000, edits))
+                             .status_code, 200)
+        self.versions = list(DocumentVersion.objects.filter(parent_document_id=self.document_id).order_by("id"))
+
+    def pack(self):
+        output = io.StringIO()
+        call_command("pack_versions", "--min-age-days", "0", "--max-pack-bytes", "20000", stdout=output)
+        return output.getvalue()
+
+    def download(self, url):
+        api_response = self.client.get(url.replace("http://testserver", ""))
+        self.assertEqual(api_response.status_code, 200, url)
+        return b"".join(api_response.streaming_content)
+
+    def read_all(self):
+        """
+        bytes returned by every API exposing the files of the versions.
+        """
+        auth = auth_header(self.owner)
+        data = {}
+        versions = self.client.get("/api/v1/document_version/?remove_pagination=true", **auth).json()
+        for version in versions["results"] if isinstance(versions, dict) else versions:
+            if version["diff_file"]:
+                data[(version["id"], "listed_diff")] = self.download(version["diff_file"])
+        for version_obj in self.versions:
+            urls = self.client.get(f"/api/v1/document_version/{version_obj.id}/download_urls/", **auth).json()
+            for key in ("document_url", "diff_url"):
+                if urls[key]:
+                    data[(version_obj.id, key)] = self.download(urls[key])
+            if version_obj.diff_format == "hunks":
+                for offset in (0, 1, 2):
+                    api_response = self.client.get(f"/api/v1/document_version/{version_obj.id}/hunks/"
+                                                   f"?limit=1&offset={offset}", **auth)
+                    self.assertEqual(api_response.status_code, 200)
+                    data[(version_obj.id, "hunks", offset)] = api_response.json()
+                for style in ("unified", "ndiff"):
+                    data[(version_obj.id, style)] = self.client.get(
+                        f"/api/v1/document_version/{version_obj.id}/hunks/?format={style}", **auth).content
+
+        api_response = self.client.post("/api/v1/download_documents/",
+                                        {"documents": [self.document_id],
+                                         "versions": [version_obj.id for version_obj in self.versions]},
+                                        content_type="application/json", **auth)
+        self.assertEqual(api_response.status_code, 200)
+        archive = zipfile.ZipFile(io.BytesIO(b"".join(api_response.streaming_content)))
+        data["zip"] = {name: archive.read(name) for name in archive.namelist()}
+        data["fetch"] = self.client.get(f"/api/v1/fetch_document/{self.document_id}/", **auth).content
+        return data
+
+    def test_reads_after_packing(self):
+        before = self.read_all()
+        self.assertIn("Archived: ", self.pack())
+
+        packed = set(PackedFile.objects.values_list("name", flat=True))
+        current = Document.objects.get(id=self.document_id).document.name
+        self.assertNotIn(current, packed)
+        self.assertTrue(os.path.isfile(default_storage.path(current)))
+        for version_obj in self.versions[:-1]:
+            self.assertIn(version_obj.document.name, packed)
+        for version_obj in self.versions[1:]:
+            self.assertIn(version_obj.diff_file.name, packed)
+        for name in packed:
+            self.assertFalse(os.path.isfile(default_storage.path(name)))
+            self.assertTrue(default_storage.exists(name))
+
+        self.assertEqual(self.read_all(), before)
+        self.assertIn("Archived: 0 files", self.pack())
+        self.assertEqual(self.client.get(f"/media/{next(iter(packed))}").status_code, 401)
+
+    def test_storage_usage_unchanged(self):
+        storage_bytes = Document.objects.get(id=self.document_id).storage_bytes
+        self.pack()
+        output = io.StringIO()
+        call_command("reconcile_storage_usage", "--dry-run", stdout=output)
+        self.assertIn("1 checked, 0 drifted", output.getvalue())
+        self.assertEqual(Document.objects.get(id=self.document_id).storage_bytes, storage_bytes)
+
+    def test_checksums(self):
+        self.pack()
+        call_command("pack_versions", "--verify", stdout=io.StringIO())
+        packed_file = PackedFile.objects.select_related("pack").filter(name=self.versions[1].diff_file.name).get()
+        with default_storage.open(packed_file.name) as infile:
+            content = infile.read()
+        self.assertEqual(len(content), packed_file.size)
+
+        with open(default_storage.path(packed_file.pack.name), "r+b") as pack_file:
+            pack_file.seek(packed_file.offset + 5)
+            pack_file.write(bytes([content[5] ^ 1]))
+        with self.assertRaises(packs.PackChecksumError), default_storage.open(packed_file.name) as infile:
+            infile.read()
+        with self.assertRaises(CommandError):
+            call_command("pack_versions", "--verify", stdout=io.StringIO(), stderr=io.StringIO())
+
+    def test_shard_media_skips_packed_files(self):
+        """
+        a version file of the old flat layout archived before 'manage.py shard_media' runs keeps its name.
+        """
+        name = default_storage.save("document_version_files/legacy_contract.txt", ContentFile(text_content()))
+        version_obj = DocumentVersion.objects.create(parent_document_id=self.document_id, updated_by=self.owner,
+                                                     document=name)
+        self.pack()
+        self.assertTrue(PackedFile.objects.filter(name=name).exists())
+
+        output = io.StringIO()
+        call_command("shard_media", stdout=output)
+        self.assertIn("missing on disk: 0", output.getvalue())
+        version_obj.refresh_from_db()
+        self.assertEqual(version_obj.document.name, name)
+        with version_obj.document.open("rb") as infile:
+            self.assertEqual(infile.read(), text_content())
+
+
+class ChangeFeedTestCase(DocumentAPITestMixin, TestCase):
+    """
+    Change feed paging and resuming from a cursor.
+    """
+
+    def setUp(self):
+        self.owner = self.create_user("feed_owner")
+        self.collaborator = self.create_user("feed_collaborator")
+
+    def feed(self, cursor=None, limit=None):
+        params = {key: value for key, value in (("cursor", cursor), ("limit", limit)) if value}
+        api_response = self.client.get("/api/v1/changes/", params, **auth_header(self.owner))
+        self.assertEqual(api_response.status_code, 200, api_response.content)
+        return api_response.json()
+
+    def read_until_end(self, cursor, limit=2):
+        changes = []
+        while True:
+            page = self.feed(cursor, limit)
+            changes.extend(page["changes"])
+            cursor = page["cursor"]
+            if not page["has_more"]:
+                return changes, cursor
+
+    def test_resume_from_cursor(self):
+        cursor = self.feed()["cursor"]
+        document_id = self.create_document(self.owner, text_content()).json()["id"]
+        self.client.post("/api/v1/add_document_collaborator/", {"document_id": document_id,
+                                                                "collaborator": self.collaborator.id},
+                         **auth_header(self.owner))
+        self.edit_document(self.owner, document_id, text_content(edits={1}))
+
+        changes, cursor = self.read_until_end(cursor)
+        expected = list(ChangeLogEntry.objects.order_by("id").values_list("document_id", "kind"))
+        self.assertEqual([(change["document_id"], change["kind"]) for change in changes], expected)
+        self.assertEqual([kind for _, kind in expected], ["created", "collaborators", "locked", "version",
+                                                          "unlocked"])
+
+        """
+        resuming with the last cursor only returns the changes made since.
+        """
+        self.assertEqual(self.feed(cursor), {"changes": [], "cursor": cursor, "has_more": False})
+        self.client.delete(f"/api/v1/document/{document_id}/", **auth_header(self.owner))
+        changes, _ = self.read_until_end(cursor)
+        self.assertEqual([(change["kind"], change["document_id"]) for change in changes], [("deleted", document_id)])
+
+        self.assertEqual(self.client.get("/api/v1/changes/", {"cursor": "bad"}, **auth_header(self.owner))
+                         .status_code, 400)
+
+    def test_entries_locked_before_insert(self):
+        """
+        on postgresql the change log lock is taken in the transaction of the insert, before it.
+        """
+        calls = []
+        with connection.cursor():
+            connection.connection.create_function("pg_advisory_xact_lock", 1, lambda key: calls.append(key) or 1)
+        document_obj = Document.objects.create(document_name="locked", document="document/aa/bb/locked.txt",
+                                               owner=self.owner)
+        with mock.patch.object(connection, "vendor", "postgresql"), CaptureQueriesContext(connection) as queries:
+            ChangeLogEntry.record(ChangeLogEntry.KIND_UPDATED, document_obj)
+        self.assertEqual(calls, [ChangeLogEntry.LOG_LOCK_KEY])
+        statements = [query["sql"] for query in queries.captured_queries]
+        lock_index = next(index for index, sql in enumerate(statements) if "pg_advisory_xact_lock" in sql)
+        insert_index = next(index for index, sql in enumerate(statements) if sql.startswith("INSERT"))
+        self.assertLess(lock_index, insert_index)
+
+
+class PartitionCursor:
+    """
+    Cursor recording the statements, answering the catalog queries of documents.partitioning from a fake state.
+    existing[set]: tables that exist
+    default_months[set]: months with rows in the default partition
+    partitioned[bool]: whether the document versions table is partitioned
+    latest[int]: count of documents having their latest version in a detached partition
+    """
+
+    def __init__(self, existing=(), default_months=(), partitioned=True, latest=0):
+        self.existing = set(existing)
+        self.default_months = set(default_months)
+        self.partitioned = partitioned
+        self.latest = latest
+        self.statements = []
+        self.result = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def execute(self, sql, params=None):
+        self.statements.append(sql)
+        if "to_regclass" in sql:
+            self.result = (params[0] if params[0] in self.existing else None, )
+        elif sql.startswith(f"SELECT 1 FROM {partitioning.DEFAULT_PARTITION}"):
+            start, end = (datetime.datetime.strptime(value, "%Y-%m-%d").date() for value in params)
+            self.result = (1, ) if any(start <= month < end for month in self.default_months) else None
+        elif "pg_partitioned_table" in sql:
+            self.result = (1, ) if self.partitioned else None
+        elif "COUNT(*)" in sql:
+            self.result = (self.latest, )
+        elif sql.startswith("CREATE TABLE"):
+            self.existing.add(sql.split()[2])
+
+    def fetchone(self):
+        return self.result
+
+    def fetchall(self):
+        return [(name, 10.0) for name in sorted(self.existing)]
+
+    def copy_expert(self, sql, outfile):
+        self.statements.append(sql)
+        outfile.write(b"id,created_on\n")
+
+
+class PartitioningTestCase(DocumentAPITestMixin, TestCase):
+    """
+    DDL of the monthly partitions and the partition maintenance command (against a recording cursor, the real
+    tables are only exercised on postgresql).
+    """
+
+    def test_partition_names(self):
+        self.assertEqual(partitioning.add_months(datetime.date(2026, 11, 1), 3), datetime.date(2027, 2, 1))
+        self.assertEqual(partitioning.add_months(datetime.date(2026, 1, 1), -1), datetime.date(2025, 12, 1))
+        self.assertEqual(partitioning.partition_name(datetime.date(2026, 3, 1)), "documents_documentversion_p2026_03")
+        self.assertEqual(partitioning.parse_partition_name("documents_documentversion_p2026_03"),
+                         datetime.date(2026, 3, 1))
+        self.assertIsNone(partitioning.parse_partition_name(partitioning.DEFAULT_PARTITION))
+
+    def test_create_partition(self):
+        cursor = PartitionCursor()
+        self.assertTrue(partitioning.create_partition(cursor, datetime.date(2026, 12, 1)))
+        self.assertEqual(cursor.statements[-1], "CREATE TABLE documents_documentversion_p2026_12 PARTITION OF "
+                                                "documents_documentversion FOR VALUES FROM ('2026-12-01') "
+                                                "TO ('2027-01-01')")
+        self.assertFalse(partitioning.create_partition(cursor, datetime.date(2026, 12, 1)))
+        self.assertFalse(any("ALTER TABLE" in statement for statement in cursor.statements))
+
+    def test_create_partition_moves_default_rows(self):
+        """
+        the default partition is detached while the partition of the month is created and its rows moved.
+        """
+        cursor = PartitionCursor(default_months={datetime.date(2026, 5, 1)})
+        partitioning.create_partition(cursor, datetime.date(2026, 5, 1))
+        self.assertEqual(cursor.statements[2:], [
+            "ALTER TABLE documents_documentversion DETACH PARTITION documents_documentversion_pdefault",
+            "CREATE TABLE documents_documentversion_p2026_05 PARTITION OF documents_documentversion "
+            "FOR VALUES FROM ('2026-05-01') TO ('2026-06-01')",
+            "INSERT INTO documents_documentversion SELECT * FROM documents_documentversion_pdefault "
+            "WHERE created_on >= %s::date AND created_on < %s::date",
+            "DELETE FROM documents_documentversion_pdefault WHERE created_on >= %s::date AND created_on < %s::date",
+            "ALTER TABLE documents_documentversion ATTACH PARTITION documents_documentversion_pdefault DEFAULT",
+        ])
+
+    def test_ensure_partitions(self):
+        cursor = PartitionCursor(existing={"documents_documentversion_p2027_01"})
+        self.assertEqual(partitioning.ensure_partitions(cursor, datetime.date(2026, 11, 1), datetime.date(2027, 2, 1)),
+                         ["documents_documentversion_p2026_11", "documents_documentversion_p2026_12",
+                          "documents_documentversion_p2027_02"])
+        self.assertEqual(partitioning.ensure_partitions(cursor, datetime.date(2027, 3, 1), datetime.date(2027, 2, 1)),
+                         [])
+
+    def call(self, cursor, *args, vendor="postgresql"):
+        output, errors = io.StringIO(), io.StringIO()
+        with mock.patch.object(partition_document_versions, "connection") as connection_mock:
+            connection_mock.vendor = vendor
+            connection_mock.cursor.return_value = cursor
+            call_command("partition_document_versions", *args, stdout=output, stderr=errors)
+        return output.getvalue(), errors.getvalue()
+
+    def test_command_creates_coming_months(self):
+        this_month = datetime.date.today().replace(day=1)
+        names = [partitioning.partition_name(partitioning.add_months(this_month, count)) for count in range(3)]
+        cursor = PartitionCursor(existing={names[1]})
+        output, _ = self.call(cursor, "--months-ahead", "2")
+        self.assertEqual(output, f"Created 2 partitions: {names[0]}, {names[2]}.\n")
+        self.assertEqual(self.call(cursor, "--months-ahead", "2")[0], "Created 0 partitions.\n")
+
+        output, _ = self.call(cursor, "--list")
+        self.assertEqual(output.splitlines(), [f"{name}: ~10 rows" for name in names])
+
+    def test_command_detaches_old_months(self):
+        """
+        only the monthly partitions before --detach-before are detached, archived then dropped.
+        """
+        months = ["2026_01", "2026_02", "2026_03"]
+        cursor = PartitionCursor(existing={f"documents_documentversion_p{month}" for month in months} |
+                                 {partitioning.DEFAULT_PARTITION}, latest=2)
+        with tempfile.TemporaryDirectory() as directory:
+            output, errors = self.call(cursor, "--months-ahead", "0", "--detach-before", "2026-03",
+                                       "--archive-dir", directory)
+            self.assertEqual(sorted(os.listdir(directory)), ["documents_documentversion_p2026_01.csv.gz",
+                                                             "documents_documentversion_p2026_02.csv.gz"])
+        detached = [statement.split()[-1] for statement in cursor.statements if "DETACH PARTITION" in statement]
+        dropped = [statement.split()[-1] for statement in cursor.statements if statement.startswith("DROP TABLE")]
+        self.assertEqual(detached, ["documents_documentversion_p2026_01", "documents_documentversion_p2026_02"])
+        self.assertEqual(dropped, detached)
+        self.assertEqual(output.count("Archived"), 2)
+        self.assertEqual(errors.count("2 documents have their latest version"), 2)
+
+    def test_command_errors(self):
+        with self.assertRaisesMessage(CommandError, "only supported on postgresql"):
+            self.call(PartitionCursor(), vendor="sqlite")
+        with self.assertRaisesMessage(CommandError, "run with --convert first"):
+            self.call(PartitionCursor(partitioned=False))
+        with self.assertRaisesMessage(CommandError, "YYYY-MM"):
+            self.call(PartitionCursor(), "--detach-before", "2026-3-1")
+
+    @skipUnless(connection.vendor == "postgresql", "partitioning needs postgresql")
+    def test_partitioned_table(self):
+        """
+        converting the table keeps the rows and the ids, new versions go to the partition of their month.
+        """
+        owner = self.create_user("owner")
+        document_id = self.create_document(owner, text_content()).json()["id"]
+        version = DocumentVersion.objects.get(parent_document_id=document_id)
+        call_command("partition_document_versions", "--convert", "--months-ahead", "1", stdout=io.StringIO())
+        try:
+            with connection.cursor() as cursor:
+                self.assertTrue(partitioning.is_partitioned(cursor))
+                names = [name for name, rows in partitioning.list_partitions(cursor)]
+                self.assertIn(partitioning.partition_name(datetime.date.today().replace(day=1)), names)
+                self.assertIn(partitioning.DEFAULT_PARTITION, names)
+            self.assertTrue(DocumentVersion.objects.filter(id=version.id).exists())
+            self.assertEqual(self.edit_document(owner, document_id, text_content(edits={1})).status_code, 200)
+            self.assertGreater(DocumentVersion.objects.filter(parent_document_id=document_id).latest("id").id,
+                               version.id)
+        finally:
+            with connection.schema_editor() as schema_editor:
+                partitioning.unpartition_table(None, schema_editor)
+        with connection.cursor() as cursor:
+            self.assertFalse(partitioning.is_partitioned(cursor))
+
+
+@override_settings(EVENTS_BROKER="local", EVENTS_STREAM_DURATION=0.3, EVENTS_HEARTBEAT=0.1)
+class EventsTestCase(DocumentAPITestMixin, TransactionTestCase):
+    """
+    Event streams: resuming after the Last-Event-ID and the caps of the open streams. A TransactionTestCase since
+    the streams close the database connection while they wait.
+    """
+
+    def setUp(self):
+        self.owner = self.create_user("events_owner")
+        self.other = self.create_user("events_other")
+
+    def open_stream(self, user, **headers):
+        return self.client.get("/api/v1/events/", **headers, **auth_header(user))
+
+    def test_resume_from_last_event_id(self):
+        document_id = self.create_document(self.owner, text_content()).json()["id"]
+        self.edit_document(self.owner, document_id, text_content(edits={1}))
+        entry_ids = list(ChangeLogEntry.objects.order_by("id").values_list("id", flat=True))
+
+        stream = self.open_stream(self.owner, HTTP_LAST_EVENT_ID=str(entry_ids[0]))
+        self.assertEqual(stream.status_code, 200)
+        content = b"".join(stream.streaming_content).decode()
+        stream.close()
+        self.assertEqual([int(event_id) for event_id in re.findall(r"^id: (\d+)$", content, re.MULTILINE)],
+                         entry_ids[1:])
+        self.assertIn("event: unlocked", content)
+
+        stream = self.open_stream(self.owner, HTTP_LAST_EVENT_ID=str(entry_ids[-1]))
+        self.assertNotIn("id: ", b"".join(stream.streaming_content).decode())
+        stream.close()
+        self.assertEqual(events.stream_slots.streams, {})
+
+    @override_settings(EVENTS_MAX_STREAMS_PER_USER=1, EVENTS_MAX_STREAMS=2)
+    def test_open_streams_capped(self):
+        first = self.open_stream(self.owner)
+        self.assertEqual(first.status_code, 200)
+        refused = self.open_stream(self.owner)
+        self.assertEqual(refused.status_code, 429)
+        self.assertEqual(refused["Retry-After"], "3")
+
+        other = self.open_stream(self.other)
+        self.assertEqual(other.status_code, 200)
+        self.assertEqual(self.open_stream(self.create_user("events_third")).status_code, 429)
+
+        """
+        closing a stream, read or not, frees its slot.
+        """
+        first.close()
+        second = self.open_stream(self.owner)
+        self.assertEqual(second.status_code, 200)
+        second.close()
+        other.close()
+        self.assertEqual(events.stream_slots.streams, {})
+
+    @override_settings(EVENTS_STREAM_DURATION=0.05, EVENTS_HEARTBEAT=1)
+    def test_query_budget(self):
+        """
+        a stream of a single read of the change log.
+        """
+        self.create_document(self.owner, text_content())
+        with assert_query_budget(views.DocumentEventsView, "GET"):
+            stream = self.open_stream(self.owner, HTTP_LAST_EVENT_ID="0")
+            self.assertIn(b"event: created", b"".join(stream.streaming_content))
+            stream.close()
+
+    def test_admission_slot_held_until_stream_closed(self):
+        route_classes = {"events": {"routes": ["document-events"], "methods": ["GET"], "concurrency": 1}}
+        with tempfile.TemporaryDirectory() as directory, mock.patch("helpers.middlewares.settings", settings), \
+                self.settings(ADMISSION_CONTROL_DB=os.path.join(directory, "admission.db"),
+                              ADMISSION_CONTROL=route_classes):
+            middleware = AdmissionControlMiddleware(lambda request: None)
+
+            def stream_request():
+                request = RequestFactory().get("/api/v1/events/")
+                request.resolver_match = resolve("/api/v1/events/")
+                request.user_val = {"user_id": self.owner.id}
+                return request
+
+            request = stream_request()
+            self.assertIsNone(middleware.process_view(request, None, (), {}))
+            stream = middleware.process_response(request, StreamingHttpResponse(iter([b"data: 1\n\n"])))
+            self.assertEqual(middleware.process_view(stream_request(), None, (), {}).status_code, 429)
+
+            self.assertEqual(b"".join(stream.streaming_content), b"data: 1\n\n")
+            self.assertEqual(middleware.process_view(stream_request(), None, (), {}).status_code, 429)
+            stream.close()
+            self.assertIsNone(middleware.process_view(stream_request(), None, (), {}))
@@ -7,10 +7,19 @@ router = DefaultRouter()
 router.register(r"document", apis.DocumentView, basename="document-api")
 
 urlpatterns = [
+    url(r'^document/(?P<pk>\d+)/versions/$', apis.DocumentVersionTimelineView.as_view(), name='document-version-timeline'),
     url(r'^', include(router.urls)),
     url(r'^document_version/$', apis.DocumentVersionView.as_view(), name='document-version'),
+    url(r'^document_version/(?P<pk>\d+)/hunks/$', apis.DocumentVersionHunksView.as_view(),
+        name='document-version-hunks'),
+    url(r'^document_version/(?P<pk>\d+)/download_urls/$', apis.DocumentVersionDownloadURLView.as_view(),
+        name='document-version-download-urls'),
+    url(r'^storage_usage/$', apis.StorageUsageView.as_view(), name='storage-usage'),
+    url(r'^changes/$', apis.ChangeFeedView.as_view(), name='change-feed'),
+    url(r'^events/$', apis.DocumentEventsView.as_view(), name='document-events'),
     url(r'^add_document_collaborator/$', apis.AddCollaboratorView.as_view(), name='add-collaborator'),
     url(r'^remove_document_collaborator/$', apis.RemoveCollaboratorView.as_view(), name='remove-collaborator'),
     url(r'^fetch_document/(?P<pk>\d+)/$', apis.FetchDocumentView.as_view(), name='fetch-document'),
+    url(r'^download_documents/$', apis.BulkDownloadView.as_view(), name='bulk-download'),
     url(r'^reupload_document/(?P<pk>\d+)/$', apis.UploadEditedDocumentView.as_view(), name='re-upload-document'),
 ]
\ No newline at end of file
@@ -0,0 +1,93 @@
+from django.conf import settings
+from django.core.files.storage import default_storage
+
+from documents.diffing import DIFF_FORMAT_HUNKS, hunk_index_name
+from users.models import User
+
+"""
+Storage usage of the documents and their owners.
+
+Document.storage_bytes counts the bytes of the distinct files referenced by a document and its versions: the current
+document file, the version files, the diff files and the offset index of the hunks diffs. The first version of a
+document shares the file of the document, it's only counted once. User.storage_bytes is the sum over the documents
+owned by the user.
+Both counters are updated in the transaction that stores (or releases) the files, 'manage.py
+reconcile_storage_usage' recomputes them from the files.
+"""
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+def get_quota():
+    """
+    settings.USER_STORAGE_QUOTA_BYTES, None when the quota is not enforced
+    """
+    return getattr(settings, "USER_STORAGE_QUOTA_BYTES", None) or None
+
+
+def exceeds_quota(user, storage_bytes):
+    """
+    Checking an upload of storage_bytes against the usage loaded with the user, before the files are written.
+    charge() checks it again atomically.
+    """
+    quota = get_quota()
+    return quota is not None and user is not None and user.storage_bytes + storage_bytes > quota
+
+
+def charge(owner_id, storage_bytes):
+    """
+    Adding storage_bytes to the usage of the owner of a document. Should be called in the transaction that stores
+    the files, along with record_version(storage_bytes=...). Raises QuotaExceeded when it would go over the quota.
+    """
+    if not User.add_storage_bytes(owner_id, storage_bytes, quota=get_quota()):
+        raise QuotaExceeded()
+
+
+def file_size(name, storage=default_storage):
+    """
+    size of a stored file, 0 for empty names and missing files.
+    """
+    if not name:
+        return 0
+    try:
+        return storage.size(name)
+    except OSError:
+        return 0
+
+
+def diff_size(name, diff_format, storage=default_storage):
+    """
+    size of a diff file with its offset index
+    """
+    size = file_size(name, storage)
+    if name and diff_format == DIFF_FORMAT_HUNKS:
+        size += file_size(hunk_index_name(name), storage)
+    return size
+
+
+def document_storage_bytes(document_name, versions, sizes=None):
+    """
+    Bytes of the distinct files of a document.
+    document_name[string]: name of the document file
+    versions[list]: (document name, diff name, diff format) of the versions of the document
+    sizes[dict]: cache of the file sizes by name, shared between documents
+    """
+    sizes = {} if sizes is None else sizes
+    names = {document_name} if document_name else set()
+    diffs = set()
+    for version_document, diff_name, diff_format in versions:
+        if version_document:
+            names.add(version_document)
+        if diff_name:
+            diffs.add((diff_name, diff_format))
+
+    total = 0
+    for name in names:
+        if name not in sizes:
+            sizes[name] = file_size(name)
+        total += sizes[name]
+    for name, diff_format in diffs:
+        total += diff_size(name, diff_format)
+    return total
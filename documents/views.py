@@ -1,26 +1,43 @@
 from rest_framework import (response, status, views, exceptions,
                             viewsets, filters, generics)
-from .models import Document, DocumentVersion
+from .models import Document, DocumentVersion, ChangeLogEntry
+from django.db import transaction
 import django_filters
-from rest_framework.pagination import LimitOffsetPagination
+from rest_framework.pagination import LimitOffsetPagination, CursorPagination
+from rest_framework import renderers
+from rest_framework.settings import api_settings
 from .serializers import DocumentCreateSerializer, DocumentListSerializer,\
     DocumentUpdateSerializer, AddCollaboratorSerializer,\
-    DocumentVersionListSerializer, RemoveCollaboratorSerializer, UploadEditedDocumentSerializer
-from django.http import HttpResponse
+    DocumentVersionListSerializer, RemoveCollaboratorSerializer, UploadEditedDocumentSerializer,\
+    DocumentVersionTimelineSerializer, ChangeLogEntrySerializer, BulkDownloadSerializer,\
+    DocumentListValuesSerializer, DocumentVersionListValuesSerializer
+from django.http import HttpResponse, StreamingHttpResponse
+import json
 import mimetypes
 import pathlib
 import uuid
-import difflib
 import filecmp
+import os
 from django.core.files import File
-
-
-class DocumentView(viewsets.ModelViewSet):
+from django.core.files.storage import default_storage
+from django.conf import settings
+from helpers import admission, instrumentation, metrics, signed_urls, zipstream
+from helpers.values_serializers import ValuesListModelMixin
+from . import diffing, events, hunks, usage
+from tempfile import NamedTemporaryFile
+import time
+import base64
+import binascii
+
+
+class DocumentView(ValuesListModelMixin, viewsets.ModelViewSet):
     """
     Basic Document CRUD API
+    The list is serialized from queryset.values() (see helpers.values_serializers)
     """
     model = Document
-    queryset = Document.objects.all()
+    queryset = Document.objects.select_related("owner", "currently_edited_by", "last_updated_by")
+    values_serializer_class = DocumentListValuesSerializer
 
     pagination_class = LimitOffsetPagination
 
@@ -58,23 +75,34 @@ class DocumentView(viewsets.ModelViewSet):
         """
         serializer = self.get_serializer(data=request.data, context={"request": self.request})
         if serializer.is_valid(raise_exception=True):
-            self.perform_create(serializer)
-            instance = serializer.instance
-            """
-            fetching current user from the request that is currently logged in.
-            """
-            instance.owner = self.request.user
-            instance.save()
+            document_size = serializer.validated_data["document"].size
+            if usage.exceeds_quota(self.request.user, document_size):
+                raise exceptions.ValidationError("Storage quota exceeded.")
+            with transaction.atomic():
+                try:
+                    usage.charge(self.request.user.id, document_size)
+                except usage.QuotaExceeded:
+                    raise exceptions.ValidationError("Storage quota exceeded.")
+                self.perform_create(serializer)
+                instance = serializer.instance
+                metrics.UPLOAD_BYTES.inc(instance.document.size)
+                """
+                fetching current user from the request that is currently logged in.
+                """
+                instance.owner = self.request.user
+                instance.save(update_fields=["owner"])
 
-            try:
-                document_version_obj = DocumentVersion(parent_document=instance,
-                                                       updated_by=self.request.user)
-                document_version_obj.document = instance.document
-                document_version_obj.save()
+                try:
+                    document_version_obj = DocumentVersion(parent_document=instance,
+                                                           updated_by=self.request.user)
+                    document_version_obj.document = instance.document
+                    document_version_obj.save()
+                    instance.record_version(document_version_obj, storage_bytes=document_size)
+                    ChangeLogEntry.record(ChangeLogEntry.KIND_CREATED, instance, version=document_version_obj.id)
 
-            except Exception as e:
-                raise exceptions.ValidationError(f"Unknown error occurred while creating document"
-                                                 f" version object. {e.__str__()}")
+                except Exception as e:
+                    raise exceptions.ValidationError(f"Unknown error occurred while creating document"
+                                                     f" version object. {e.__str__()}")
 
             return response.Response(serializer.data, status=status.HTTP_201_CREATED)
 
@@ -85,18 +113,40 @@ class DocumentView(viewsets.ModelViewSet):
         instance = self.get_object()
         if instance.owner != self.request.user and instance.owner != None:
             raise exceptions.ValidationError("Only document owner is allowed to delete document")
-        self.perform_destroy(instance)
+        with transaction.atomic():
+            tombstone = ChangeLogEntry.build(ChangeLogEntry.KIND_DELETED, instance)
+            usage.charge(instance.owner_id, -instance.storage_bytes)
+            self.perform_destroy(instance)
+            ChangeLogEntry.record_many(tombstone)
         return response.Response(status=status.HTTP_204_NO_CONTENT)
 
+    def perform_update(self, serializer):
+        """
+        the storage usage of the document moves with it when the owner is changed.
+        """
+        owner_id = serializer.instance.owner_id
+        with transaction.atomic():
+            super(DocumentView, self).perform_update(serializer)
+            instance = serializer.instance
+            if instance.owner_id != owner_id:
+                try:
+                    usage.charge(owner_id, -instance.storage_bytes)
+                    usage.charge(instance.owner_id, instance.storage_bytes)
+                except usage.QuotaExceeded:
+                    raise exceptions.ValidationError("Storage quota of the new owner exceeded.")
+            ChangeLogEntry.record(ChangeLogEntry.KIND_UPDATED, instance)
 
-class DocumentVersionView(generics.ListAPIView, generics.RetrieveAPIView):
+
+class DocumentVersionView(ValuesListModelMixin, generics.ListAPIView, generics.RetrieveAPIView):
     """
     Document Version supports only GET
+    The list is serialized from queryset.values() (see helpers.values_serializers)
     """
     model = DocumentVersion
     queryset = DocumentVersion.objects.all()
 
     serializer_class = DocumentVersionListSerializer
+    values_serializer_class = DocumentVersionListValuesSerializer
     pagination_class = LimitOffsetPagination
 
     filter_backends = [
@@ -120,6 +170,305 @@ class DocumentVersionView(generics.ListAPIView, generics.RetrieveAPIView):
         return super(DocumentVersionView, self).list(request, *args, **kwargs)
 
 
+class DocumentVersionTimelinePagination(CursorPagination):
+    """
+    Cursor pagination on the (parent_document, created_on) index, so every page costs the same no matter how
+    deep in the history it is.
+    """
+    ordering = "-created_on"
+    page_size_query_param = "page_size"
+    max_page_size = 200
+
+
+class DocumentVersionTimelineView(generics.ListAPIView):
+    """
+    Version history of a single document, newest first. Only supports GET.
+    """
+    model = DocumentVersion
+    serializer_class = DocumentVersionTimelineSerializer
+    pagination_class = DocumentVersionTimelinePagination
+    query_budget = 4
+
+    def get_queryset(self):
+        if getattr(self, "swagger_fake_view", False):
+            return DocumentVersion.objects.none()
+        document_id = self.kwargs.get("pk")
+        if not Document.objects.filter(id=document_id).exists():
+            raise exceptions.ValidationError("Invalid document ID in the URL.")
+        return DocumentVersion.objects.filter(parent_document_id=document_id).select_related("updated_by")\
+            .only("id", "created_on", "parent_document_id", "updated_by__id", "updated_by__email",
+                  "updated_by__username")
+
+
+class DocumentVersionHunksPagination(LimitOffsetPagination):
+    default_limit = 50
+    max_limit = 500
+
+
+class TextDiffRenderer(renderers.BaseRenderer):
+    """
+    Renders the lines of a text diff as is, and the error payloads as JSON.
+    """
+    media_type = "text/plain"
+    charset = "utf-8"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if isinstance(data, list) and all(isinstance(line, str) for line in data):
+            return "".join(data)
+        return json.dumps(data)
+
+
+class UnifiedDiffRenderer(TextDiffRenderer):
+    media_type = "text/x-diff"
+    format = "unified"
+
+
+class NdiffRenderer(TextDiffRenderer):
+    format = "ndiff"
+
+
+class DocumentVersionHunksView(views.APIView):
+    """
+    Hunks of the diff of a document version, page by page. Only supports GET and only for text documents (diffs in
+    the 'hunks' format). Only the owner and the collaborators of the document get the diff.
+    Every page is read from the diff file with a seek through the offset index stored next to it, so large diffs
+    are served without reading the whole file.
+    ?format=unified and ?format=ndiff render the whole diff as text instead (the output of difflib.unified_diff()
+    and difflib.ndiff() for the two revisions), also for the diffs written in the older 'ndiff' format.
+    """
+    model = DocumentVersion
+    queryset = DocumentVersion.objects.select_related("parent_document")\
+        .only("id", "document", "diff_file", "diff_format", "parent_document__id", "parent_document__owner_id",
+              "parent_document__shared_with")
+    pagination_class = DocumentVersionHunksPagination
+    renderer_classes = list(api_settings.DEFAULT_RENDERER_CLASSES) + [UnifiedDiffRenderer, NdiffRenderer]
+    text_formats = (UnifiedDiffRenderer.format, NdiffRenderer.format)
+    query_budget = 2
+
+    def get_object(self, *args, **kwargs):
+        document_version_obj = self.queryset.filter(id=self.kwargs.get("pk")).first()
+        if not document_version_obj:
+            raise exceptions.ValidationError("Invalid document version ID in the URL.")
+        document_obj = document_version_obj.parent_document
+        if document_obj is None or (self.request.user.id not in document_obj.shared_with
+                                    and self.request.user.id != document_obj.owner_id):
+            raise exceptions.ValidationError("Only collaborator and owners are authorized to view this diff.")
+        text_diff_formats = (diffing.DIFF_FORMAT_HUNKS, diffing.DIFF_FORMAT_NDIFF) \
+            if self.request.accepted_renderer.format in self.text_formats else (diffing.DIFF_FORMAT_HUNKS, )
+        if document_version_obj.diff_format not in text_diff_formats or not document_version_obj.diff_file:
+            raise exceptions.ValidationError("Hunks are only available for the diffs of text documents.")
+        return document_version_obj
+
+    def get(self, request, *args, **kwargs):
+        document_version_obj = self.get_object()
+        if request.accepted_renderer.format in self.text_formats:
+            return response.Response(self.render_text(document_version_obj, request.accepted_renderer.format))
+
+        storage = document_version_obj.diff_file.storage
+        index_name = diffing.hunk_index_name(document_version_obj.diff_file.name)
+
+        try:
+            if not storage.exists(index_name):
+                """
+                index missing (eg. lost with a restore of the media), rebuilding it from the diff file.
+                """
+                with instrumentation.timer("file"), document_version_obj.diff_file.open("rb") as diff_file, \
+                        NamedTemporaryFile() as index_file:
+                    hunks.write_index(diff_file, index_file)
+                    index_file.seek(0)
+                    storage.save(index_name, File(index_file))
+
+            with instrumentation.timer("file"), storage.open(document_version_obj.diff_file.name, "rb") as diff_file, \
+                    storage.open(index_name, "rb") as index_file:
+                paginator = self.pagination_class()
+                page = paginator.paginate_queryset(hunks.HunkSequence(diff_file, index_file), request, view=self)
+        except (OSError, ValueError) as e:
+            raise exceptions.ValidationError("Unable to read the document diff file.")
+
+        return paginator.get_paginated_response(page)
+
+    @staticmethod
+    def render_text(document_version_obj, style):
+        """
+        the new revision is only opened for the unchanged lines of a hunks diff rendered as ndiff.
+        """
+        storage = document_version_obj.diff_file.storage
+        needs_new = style == NdiffRenderer.format and document_version_obj.diff_format == diffing.DIFF_FORMAT_HUNKS
+        if needs_new and not document_version_obj.document:
+            raise exceptions.ValidationError("The document of this version is missing.")
+        try:
+            with instrumentation.timer("file"), storage.open(document_version_obj.diff_file.name, "rb") as diff_file:
+                if not needs_new:
+                    return diffing.render_text_diff(document_version_obj.diff_format, diff_file, style=style)
+                with storage.open(document_version_obj.document.name, "rb") as new_file:
+                    return diffing.render_text_diff(document_version_obj.diff_format, diff_file, new_file, style)
+        except (OSError, ValueError) as e:
+            raise exceptions.ValidationError("Unable to read the document diff file.")
+
+
+class DocumentVersionDownloadURLView(views.APIView):
+    """
+    API issuing short lived signed URLs of the files of a document version (the updated document and its diff).
+    The files are then downloaded from those URLs, which are checked without any database query and can be served
+    by the web server directly (see settings.MEDIA_SERVE_MODE).
+    Only the owner and the collaborators of the document get the URLs.
+    """
+    model = DocumentVersion
+    queryset = DocumentVersion.objects.select_related("parent_document")\
+        .only("id", "document", "diff_file", "diff_format", "parent_document__id", "parent_document__owner_id",
+              "parent_document__shared_with")
+    query_budget = 2
+
+    def get_object(self, **kwargs):
+        document_version_obj = self.queryset.filter(id=kwargs.get("pk")).first()
+        if not document_version_obj:
+            raise exceptions.ValidationError("Invalid document version ID in the URL.")
+        return document_version_obj
+
+    def get(self, request, *args, **kwargs):
+        document_version_obj = self.get_object(**kwargs)
+        document_obj = document_version_obj.parent_document
+        if document_obj is None or (request.user.id not in document_obj.shared_with
+                                    and request.user.id != document_obj.owner_id):
+            raise exceptions.ValidationError("Only collaborator and owners are authorized to download this document.")
+
+        data = {"document_url": None, "diff_url": None, "diff_format": document_version_obj.diff_format,
+                "expires": None}
+        for field_name in ("document", "diff_file"):
+            field_file = getattr(document_version_obj, field_name)
+            if field_file:
+                url, data["expires"] = signed_urls.make_signed_url(field_file.name)
+                data["diff_url" if field_name == "diff_file" else "document_url"] = request.build_absolute_uri(url)
+        return response.Response(data, status=status.HTTP_200_OK)
+
+
+class StorageUsageView(views.APIView):
+    """
+    Storage used by the current user (bytes of the files of the documents they own) and their quota (null when
+    quotas are not enforced), with the largest documents. Read from the counters, the files aren't scanned.
+    Only supports GET.
+    """
+    model = Document
+    default_limit = 100
+    max_limit = 1000
+    query_budget = 2
+
+    def get(self, request, *args, **kwargs):
+        try:
+            limit = max(1, min(int(request.query_params.get("limit", self.default_limit)), self.max_limit))
+        except ValueError:
+            raise exceptions.ValidationError("Invalid limit.")
+        documents = Document.objects.filter(owner=request.user).order_by("-storage_bytes", "id")\
+            .values("id", "document_name", "storage_bytes")[:limit]
+        return response.Response({"storage_bytes": request.user.storage_bytes, "quota_bytes": usage.get_quota(),
+                                  "documents": list(documents)}, status=status.HTTP_200_OK)
+
+
+class ChangeFeedView(views.APIView):
+    """
+    Incremental sync of the documents. Returns the changes (documents created/updated/deleted, collaborators, edit
+    locks and new versions) made after an opaque cursor, oldest first, and the cursor of the next request.
+    Without a cursor only the current cursor is returned: a client gets it first and then lists the documents
+    once, from then on it only polls this API.
+    Only supports GET.
+    """
+    model = ChangeLogEntry
+    serializer_class = ChangeLogEntrySerializer
+    default_limit = 100
+    max_limit = 1000
+    query_budget = 2
+
+    @staticmethod
+    def encode_cursor(position):
+        return base64.urlsafe_b64encode(f"c1:{position}".encode()).decode().rstrip("=")
+
+    @staticmethod
+    def decode_cursor(cursor):
+        try:
+            version, position = base64.urlsafe_b64decode(f"{cursor}{'=' * (-len(cursor) % 4)}".encode()).decode()\
+                .split(":")
+            assert version == "c1"
+            return int(position)
+        except (AssertionError, ValueError, UnicodeDecodeError, binascii.Error):
+            raise exceptions.ValidationError("Invalid cursor.")
+
+    def get_limit(self, request):
+        try:
+            limit = int(request.query_params.get("limit", self.default_limit))
+        except ValueError:
+            raise exceptions.ValidationError("Invalid limit.")
+        return max(1, min(limit, self.max_limit))
+
+    def get(self, request, *args, **kwargs):
+        cursor = request.query_params.get("cursor")
+        if not cursor:
+            position = ChangeLogEntry.objects.order_by("-id").values_list("id", flat=True).first() or 0
+            return response.Response({"changes": [], "cursor": self.encode_cursor(position), "has_more": False},
+                                     status=status.HTTP_200_OK)
+
+        position, limit = self.decode_cursor(cursor), self.get_limit(request)
+        changes = list(ChangeLogEntry.objects.filter(id__gt=position).order_by("id")[:limit + 1])
+        has_more = len(changes) > limit
+        changes = changes[:limit]
+        if changes:
+            position = changes[-1].id
+        return response.Response({"changes": self.serializer_class(changes, many=True).data,
+                                  "cursor": self.encode_cursor(position), "has_more": has_more},
+                                 status=status.HTTP_200_OK)
+
+
+class DocumentEventsView(views.APIView):
+    """
+    Server-Sent Events stream of the document changes (edit lock acquired/released, new versions, collaborators,
+    documents created/updated/deleted), so clients don't have to poll the fetch and list APIs. Every event has the
+    id of its change feed entry; reconnecting with the 'Last-Event-ID' header (or ?last_event_id=) resumes after it.
+    Without it only the new events are sent.
+    Optional filters: ?documents=1,2,3 and ?kinds=locked,unlocked,version
+    A stream holds a worker thread while it's open, a user can keep settings.EVENTS_MAX_STREAMS_PER_USER streams
+    open per worker process (and every process settings.EVENTS_MAX_STREAMS), the others get a 429. Run the
+    workers with threads (see the README).
+    Only supports GET.
+    """
+    model = ChangeLogEntry
+    query_budget = 2
+
+    @staticmethod
+    def parse_list(value, cast=str):
+        try:
+            return {cast(item) for item in value.split(",") if item} if value else None
+        except ValueError:
+            raise exceptions.ValidationError("Invalid filter in the query params.")
+
+    def get(self, request, *args, **kwargs):
+        last_event_id = request.META.get("HTTP_LAST_EVENT_ID") or request.query_params.get("last_event_id")
+        if last_event_id:
+            try:
+                last_event_id = int(last_event_id)
+            except ValueError:
+                raise exceptions.ValidationError("Invalid Last-Event-ID.")
+        else:
+            last_event_id = ChangeLogEntry.objects.order_by("-id").values_list("id", flat=True).first() or 0
+
+        kinds = self.parse_list(request.query_params.get("kinds"))
+        if kinds and not kinds <= {kind for kind, _ in ChangeLogEntry.KIND_CHOICES}:
+            raise exceptions.ValidationError("Invalid event kind in the query params.")
+
+        document_ids = self.parse_list(request.query_params.get("documents"), int)
+        user_id = request.user.id
+        if not events.stream_slots.acquire(user_id):
+            retry = admission.retry_after(getattr(settings, "EVENTS_RETRY_MS", 3000) / 1000)
+            return response.Response({"error": "Too many open event streams."},
+                                     status=status.HTTP_429_TOO_MANY_REQUESTS, headers={"Retry-After": retry})
+
+        event_response = StreamingHttpResponse(
+            admission.ReleasingIterator(events.event_stream(last_event_id, document_ids, kinds),
+                                        lambda: events.stream_slots.release(user_id)),
+            content_type="text/event-stream")
+        event_response["Cache-Control"] = "no-cache"
+        event_response["X-Accel-Buffering"] = "no"
+        return event_response
+
+
 class AddCollaboratorView(generics.CreateAPIView, generics.DestroyAPIView):
     """
     API responsible for adding new collaborator to the document.
@@ -145,7 +494,9 @@ class AddCollaboratorView(generics.CreateAPIView, generics.DestroyAPIView):
                 raise exceptions.ValidationError("This user is already added as a collaborator.")
 
             document_obj.add_collaborator(collaborator_obj.id)
-            document_obj.save()
+            with transaction.atomic():
+                document_obj.save(update_fields=["shared_with"])
+                ChangeLogEntry.record(ChangeLogEntry.KIND_COLLABORATORS, document_obj, added=collaborator_obj.id)
 
             return response.Response(DocumentListSerializer(document_obj).data, status=status.HTTP_201_CREATED)
 
@@ -178,7 +529,9 @@ class RemoveCollaboratorView(generics.CreateAPIView, generics.DestroyAPIView):
                 raise exceptions.ValidationError("Cannot remove a collaborator who's currently editing the document.")
 
             document_obj.remove_collaborator(collaborator_obj.id)
-            document_obj.save()
+            with transaction.atomic():
+                document_obj.save(update_fields=["shared_with"])
+                ChangeLogEntry.record(ChangeLogEntry.KIND_COLLABORATORS, document_obj, removed=collaborator_obj.id)
 
             return response.Response(DocumentListSerializer(document_obj).data, status=status.HTTP_201_CREATED)
 
@@ -191,11 +544,13 @@ class FetchDocumentView(views.APIView):
     Note: go through the validation errors below to understand the validation conditions.
     """
     model = Document
-    queryset = Document.objects.all()
+    queryset = Document.objects.select_related("owner", "currently_edited_by", "last_updated_by")
+    query_budget = 6
 
     def get_object(self, **kwargs):
-        if self.model.objects.filter(id=kwargs.get('pk')).exists():
-            return self.model.objects.get(id=kwargs.get('pk'))
+        document_obj = self.queryset.filter(id=kwargs.get('pk')).first()
+        if document_obj:
+            return document_obj
         raise exceptions.ValidationError("Invalid document ID in the URL.")
 
     def is_valid(self, current_user, document_obj):
@@ -203,6 +558,7 @@ class FetchDocumentView(views.APIView):
             raise exceptions.ValidationError("Only collaborator and owners are authorized to download this document.")
         elif document_obj.currently_edited_by:
             if document_obj.currently_edited_by != current_user:
+                metrics.LOCK_CONTENTIONS.inc()
                 raise exceptions.ValidationError("Cannot download a document which is currently being edited by a "
                                                  "collaborator or owner")
         return True
@@ -224,17 +580,130 @@ class FetchDocumentView(views.APIView):
 
             file_name = document_obj.document_name
             file_extension = pathlib.Path(document_obj.document.path).suffix
-            file_content = open(document_obj.document.path, "rb")
+            with instrumentation.timer("file"):
+                file_content = open(document_obj.document.path, "rb")
+                instrumentation.add_bytes_read(document_obj.document.size)
+            metrics.DOWNLOAD_BYTES.inc(document_obj.document.size)
 
             if document_obj.currently_edited_by is None:
                 document_obj.currently_edited_by = current_user
-                document_obj.save()
+                with transaction.atomic():
+                    document_obj.save(update_fields=["currently_edited_by"])
+                    ChangeLogEntry.record(ChangeLogEntry.KIND_LOCKED, document_obj)
+                metrics.LOCK_ACQUISITIONS.inc()
 
             file_response = HttpResponse(file_content, content_type=mime_type)
             file_response['Content-Disposition'] = f'attachment; filename={file_name}{file_extension}'
             return file_response
 
 
+class BulkDownloadView(generics.CreateAPIView):
+    """
+    API responsible for downloading several documents (current revision) and/or document versions as one ZIP
+    archive. The archive is streamed while it's built, it's never staged on disk or in memory.
+    The permissions are checked for all the files with one query per model. The edit locks of the documents are
+    only acquired when 'lock' is true, all or none of them.
+    Note: go through the validation errors below to understand the validation conditions.
+    """
+    model = Document
+    serializer_class = BulkDownloadSerializer
+    query_budget = 7
+
+    def get_files(self, documents, versions):
+        """
+        (name in the archive, storage name) of the files, document names are made unique in the archive.
+        """
+        files, used_names = [], set()
+        entries = [(document_obj.document_name, document_obj.document) for document_obj in documents] + \
+                  [(f"{version_obj.parent_document.document_name}_v{version_obj.id}", version_obj.document)
+                   for version_obj in versions]
+        for base_name, field_file in entries:
+            extension = pathlib.Path(field_file.name).suffix
+            name, counter = f"{base_name}{extension}", 1
+            while name in used_names:
+                counter += 1
+                name = f"{base_name} ({counter}){extension}"
+            used_names.add(name)
+            files.append((name, field_file.name))
+        return files
+
+    def create(self, request, *args, **kwargs):
+        serializer = self.serializer_class(data=request.data, context={"request": request})
+        if serializer.is_valid(raise_exception=True):
+            current_user = self.request.user
+            document_ids = set(serializer.validated_data.get("documents"))
+            version_ids = set(serializer.validated_data.get("versions"))
+
+            documents = list(Document.objects.filter(id__in=document_ids).order_by("id").only(
+                "id", "document_name", "document", "owner_id", "shared_with", "currently_edited_by_id",
+                "version_count", "latest_version_id", "last_updated_by_id", "updated_on")) if document_ids else []
+            versions = list(DocumentVersion.objects.filter(id__in=version_ids).order_by("id")
+                            .select_related("parent_document").only(
+                "id", "document", "parent_document__id", "parent_document__document_name",
+                "parent_document__owner_id", "parent_document__shared_with")) if version_ids else []
+
+            missing = sorted(document_ids - {document_obj.id for document_obj in documents})
+            if missing:
+                raise exceptions.ValidationError(f"Invalid document IDs: {missing}")
+            missing = sorted(version_ids - {version_obj.id for version_obj in versions
+                                            if version_obj.parent_document and version_obj.document})
+            if missing:
+                raise exceptions.ValidationError(f"Invalid document version IDs: {missing}")
+
+            forbidden = sorted({document_obj.id for document_obj in
+                                documents + [version_obj.parent_document for version_obj in versions]
+                                if current_user.id != document_obj.owner_id
+                                and current_user.id not in document_obj.shared_with})
+            if forbidden:
+                raise exceptions.ValidationError(f"Only collaborator and owners are authorized to download the "
+                                                 f"documents {forbidden}.")
+
+            files = self.get_files(documents, versions)
+            try:
+                with instrumentation.timer("file"):
+                    size = sum(default_storage.size(name) for _, name in files)
+            except OSError:
+                raise exceptions.ValidationError("Unable to read the document files. Try downloading later.")
+
+            if serializer.validated_data.get("lock"):
+                self.lock_documents(current_user, documents)
+
+            instrumentation.add_bytes_read(size)
+            metrics.DOWNLOAD_BYTES.inc(size)
+            """
+            read through the storage, old versions can be archived in pack files (see documents.packs).
+            """
+            zip_response = StreamingHttpResponse(zipstream.zip_stream(
+                files, open_file=lambda name: default_storage.open(name, "rb")), content_type="application/zip")
+            zip_response['Content-Disposition'] = 'attachment; filename=documents.zip'
+            return zip_response
+
+    def lock_documents(self, current_user, documents):
+        locked = sorted(document_obj.id for document_obj in documents
+                        if document_obj.currently_edited_by_id not in (None, current_user.id))
+        if locked:
+            metrics.LOCK_CONTENTIONS.inc(len(locked))
+            raise exceptions.ValidationError(f"Cannot lock the documents {locked}, they are currently being edited "
+                                             f"by a collaborator or owner.")
+
+        to_lock = [document_obj for document_obj in documents if document_obj.currently_edited_by_id is None]
+        if not to_lock:
+            return
+        with transaction.atomic():
+            updated = Document.objects.filter(id__in=[document_obj.id for document_obj in to_lock],
+                                              currently_edited_by__isnull=True)\
+                .update(currently_edited_by=current_user)
+            if updated != len(to_lock):
+                metrics.LOCK_CONTENTIONS.inc(len(to_lock) - updated)
+                raise exceptions.ValidationError("Some of the documents have just been locked by a collaborator or "
+                                                 "owner. Try downloading later.")
+            for document_obj in to_lock:
+                document_obj.currently_edited_by = current_user
+            ChangeLogEntry.record_many(*[ChangeLogEntry.build(ChangeLogEntry.KIND_LOCKED, document_obj)
+                                         for document_obj in to_lock])
+        metrics.LOCK_ACQUISITIONS.inc(len(to_lock))
+
+
 class UploadEditedDocumentView(generics.UpdateAPIView):
     """
     API responsible for uploading the edited document and un-locking the document object.
@@ -242,15 +711,17 @@ class UploadEditedDocumentView(generics.UpdateAPIView):
     Note: go through the validation errors below to understand the validation conditions.
     """
     model = Document
-    queryset = Document.objects.all()
+    queryset = Document.objects.select_related("owner", "currently_edited_by", "last_updated_by")
     serializer_class = UploadEditedDocumentSerializer
+    query_budget = 12
 
     def get_object(self, **kwargs):
         """
         Checking whether the pk mentioned in the URL is valid or not.
         """
-        if self.model.objects.filter(id=kwargs.get('pk')).exists():
-            return self.model.objects.get(id=kwargs.get('pk'))
+        document_obj = self.queryset.filter(id=kwargs.get('pk')).first()
+        if document_obj:
+            return document_obj
         raise exceptions.ValidationError("Invalid document ID in the URL.")
 
     def patch(self, request, *args, **kwargs):
@@ -259,6 +730,9 @@ class UploadEditedDocumentView(generics.UpdateAPIView):
             data=request.data, context={"request": request, 'document_obj': document_obj}, partial=True)
         if serializer.is_valid(raise_exception=True):
             new_document = serializer.validated_data.get("document")
+            if usage.exceeds_quota(document_obj.owner, new_document.size):
+                raise exceptions.ValidationError("Storage quota exceeded.")
+            metrics.UPLOAD_BYTES.inc(new_document.size)
             file_ext = pathlib.Path(document_obj.document.path).suffix
 
             try:
@@ -267,8 +741,8 @@ class UploadEditedDocumentView(generics.UpdateAPIView):
                 """
                 temp_file_dir = '/tmp'
                 temp_file_path = f"{temp_file_dir}/document_{uuid.uuid4().__str__()[:8]}{file_ext}"
-                with open(temp_file_path, "wb+") as outfile:
-                    outfile.write(new_document.file.getbuffer())
+                with instrumentation.timer("file"), open(temp_file_path, "wb+") as outfile:
+                    instrumentation.add_bytes_written(outfile.write(new_document.file.getbuffer()))
 
             except Exception as e:
                 raise exceptions.ValidationError("Unable to create temporary document file.")
@@ -278,47 +752,98 @@ class UploadEditedDocumentView(generics.UpdateAPIView):
             in the URL are same are not.
             If the file are same then create a document version and return response.
             """
-            if filecmp.cmp(document_obj.document.path, temp_file_path, shallow=False):
-                try:
-                    document_version_obj = DocumentVersion(parent_document=document_obj, updated_by=self.request.user)
-                    document_version_obj.document = new_document
-                    document_version_obj.save()
+            with instrumentation.timer("file"):
+                is_same_file = filecmp.cmp(document_obj.document.path, temp_file_path, shallow=False)
+                instrumentation.add_bytes_read(document_obj.document.size + new_document.size)
 
+            if is_same_file:
+                try:
+                    with transaction.atomic():
+                        usage.charge(document_obj.owner_id, new_document.size)
+                        document_version_obj = DocumentVersion(parent_document=document_obj,
+                                                               updated_by=self.request.user)
+                        document_version_obj.document = new_document
+                        document_version_obj.save()
+                        document_obj.record_version(document_version_obj, storage_bytes=new_document.size)
+                        ChangeLogEntry.record(ChangeLogEntry.KIND_VERSION, document_obj,
+                                              version=document_version_obj.id)
+
+                except usage.QuotaExceeded:
+                    raise exceptions.ValidationError("Storage quota exceeded.")
                 except Exception as e:
                     raise exceptions.ValidationError("Unknown error occurred while creating document version object.")
 
                 return response.Response(DocumentListSerializer(document_obj).data, status=status.HTTP_200_OK)
 
             else:
-                temp_file_diff_name = f"document_diff_{uuid.uuid4().__str__()[:8]}{file_ext}"
-                temp_file_diff_path = f"{temp_file_dir}/{temp_file_diff_name}"
+                diff_id = uuid.uuid4().__str__()[:8]
+                temp_file_diff_path = f"{temp_file_dir}/document_diff_{diff_id}"
 
-                differ = difflib.Differ()
                 """
-                check line by line and write the file difference in a new file. That will be saved against the
-                'diff_file' filed of the documentVersion model.
+                write the file difference in a new file. That will be saved against the 'diff_file' filed of the
+                documentVersion model. Text documents are diffed line by line, binary documents (eg. pdf) get a
+                binary delta. The format is picked from the MIME type of the document.
                 """
-                with open(document_obj.document.path, "r") as current_file, open(temp_file_path, "r") as new_file,\
-                        open(temp_file_diff_path, "w+") as diff_file:
-                    for line in differ.compare(current_file.readlines(), new_file.readlines()):
-                        diff_file.write(line)
-
-                try:
-                    document_obj.document = new_document
-                    document_obj.remove_file_lock()
-                    document_obj.save()
-                except Exception as e:
-                    raise exceptions.ValidationError("Unknown error occurred while creating document object.")
-
-                try:
-                    diff_file = open(temp_file_diff_path, "rb")
-                    document_version_obj = DocumentVersion(parent_document=document_obj, updated_by=self.request.user)
-                    document_version_obj.diff_file.save(temp_file_diff_name, File(diff_file))
-                    document_version_obj.document = new_document
-                    document_version_obj.save()
-
-                except Exception as e:
-                    raise exceptions.ValidationError("Unknown error occurred while creating document version object.")
+                diff_started = time.perf_counter()
+                with instrumentation.timer("diff"):
+                    try:
+                        diff_format = diffing.detect_diff_format(document_obj.document.path,
+                                                                 document_obj.document.path, temp_file_path)
+                        diff_format = diffing.write_diff(diff_format, document_obj.document.path, temp_file_path,
+                                                         temp_file_diff_path)
+                        if diff_format == diffing.DIFF_FORMAT_HUNKS:
+                            diffing.write_hunk_index(temp_file_diff_path, f"{temp_file_diff_path}.idx")
+                    except Exception as e:
+                        raise exceptions.ValidationError("Unable to create the document diff file.")
+                    diff_size = os.path.getsize(temp_file_diff_path)
+                    instrumentation.add_bytes_read(document_obj.document.size + new_document.size)
+                    instrumentation.add_bytes_written(diff_size)
+                metrics.DIFF_DURATION.observe(time.perf_counter() - diff_started, format=diff_format)
+                metrics.DIFF_SIZE.observe(diff_size, format=diff_format)
+                temp_file_diff_name = f"document_diff_{diff_id}{diffing.diff_file_extension(diff_format, file_ext)}"
+
+                with transaction.atomic():
+                    """
+                    the new revision is stored twice (document and version files) with the diff and its index. The
+                    previous document file is released unless a version references it (eg. the first version).
+                    """
+                    storage_bytes = 2 * new_document.size + diff_size
+                    if diff_format == diffing.DIFF_FORMAT_HUNKS:
+                        storage_bytes += os.path.getsize(f"{temp_file_diff_path}.idx")
+                    if not DocumentVersion.objects.filter(document=document_obj.document.name).exists():
+                        storage_bytes -= document_obj.document.size
+                    try:
+                        usage.charge(document_obj.owner_id, storage_bytes)
+                    except usage.QuotaExceeded:
+                        raise exceptions.ValidationError("Storage quota exceeded.")
+
+                    try:
+                        document_obj.document = new_document
+                        document_obj.remove_file_lock()
+                        document_obj.save(update_fields=["document", "currently_edited_by"])
+                    except Exception as e:
+                        raise exceptions.ValidationError("Unknown error occurred while creating document object.")
+
+                    try:
+                        diff_file = open(temp_file_diff_path, "rb")
+                        document_version_obj = DocumentVersion(parent_document=document_obj,
+                                                               updated_by=self.request.user, diff_format=diff_format)
+                        document_version_obj.diff_file.save(temp_file_diff_name, File(diff_file))
+                        if diff_format == diffing.DIFF_FORMAT_HUNKS:
+                            with open(f"{temp_file_diff_path}.idx", "rb") as index_file:
+                                document_version_obj.diff_file.storage.save(
+                                    diffing.hunk_index_name(document_version_obj.diff_file.name), File(index_file))
+                        document_version_obj.document = new_document
+                        document_version_obj.save()
+                        document_obj.record_version(document_version_obj, storage_bytes=storage_bytes)
+                        ChangeLogEntry.record_many(
+                            ChangeLogEntry.build(ChangeLogEntry.KIND_VERSION, document_obj,
+                                                 version=document_version_obj.id),
+                            ChangeLogEntry.build(ChangeLogEntry.KIND_UNLOCKED, document_obj))
+
+                    except Exception as e:
+                        raise exceptions.ValidationError("Unknown error occurred while creating document version "
+                                                         "object.")
 
                 return response.Response(DocumentListSerializer(document_obj).data, status=status.HTTP_200_OK)
 
@@ -0,0 +1,157 @@
+import math
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+"""
+Admission control of the expensive routes: a token bucket (rate + burst) and a cap of concurrent requests per
+client and route class. The state lives in a small SQLite database on the local disk (settings.ADMISSION_CONTROL_DB)
+so every worker process of the host shares it. Every check is a single 'BEGIN IMMEDIATE' transaction, which
+serializes the workers on the database lock for well under a millisecond.
+When the store fails (eg. the database is locked for longer than the busy timeout) requests are let through.
+"""
+
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS slots (id TEXT PRIMARY KEY, key TEXT NOT NULL, expires REAL NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS slots_key ON slots (key, expires)",
+)
+
+
+class RouteClass:
+    """
+    Limits of a class of routes.
+    name[string]: name of the class, part of the keys of the store
+    routes[set]: url names of the routes in the class
+    methods[set]: HTTP methods the limits apply to (all when empty)
+    rate[float]: tokens added to the bucket per second (no rate limit when None)
+    burst[int]: size of the bucket
+    concurrency[int]: requests of a client in the class running at the same time (no cap when None)
+    """
+
+    def __init__(self, name, routes, methods=(), rate=None, burst=None, concurrency=None):
+        self.name = name
+        self.routes = frozenset(routes)
+        self.methods = frozenset(method.upper() for method in methods)
+        self.rate = rate
+        self.burst = burst if burst is not None else max(int(math.ceil(rate or 1)), 1)
+        self.concurrency = concurrency
+
+    def matches(self, url_name, method):
+        return url_name in self.routes and (not self.methods or method in self.methods)
+
+
+def load_route_classes(config):
+    """
+    RouteClass list from settings.ADMISSION_CONTROL ({name: {"routes": [...], "rate": ..}}), in that order.
+    """
+    return [RouteClass(name, **options) for name, options in (config or {}).items()]
+
+
+class AdmissionStore:
+    """
+    Token buckets and concurrency slots in a SQLite database shared by the worker processes. The connections are
+    opened per thread (and again after a fork).
+    """
+
+    def __init__(self, path, busy_timeout=1.0, slot_timeout=600):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self.slot_timeout = slot_timeout
+        self.local = threading.local()
+
+    def connection(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None or self.local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            for statement in SCHEMA:
+                connection.execute(statement)
+            self.local.connection, self.local.pid = connection, os.getpid()
+        return connection
+
+    def acquire(self, key, route_class, now=None):
+        """
+        Taking a token from the bucket and a concurrency slot of the key.
+        Returns (slot id or None, None, 0) when admitted, (None, limit, seconds to wait) when the request is over
+        the 'rate' or 'concurrency' limit.
+        """
+        now = time.time() if now is None else now
+        connection = self.connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            if route_class.concurrency is not None:
+                connection.execute("DELETE FROM slots WHERE key = ? AND expires < ?", (key, now))
+                running = connection.execute("SELECT COUNT(*) FROM slots WHERE key = ?", (key,)).fetchone()[0]
+                if running >= route_class.concurrency:
+                    connection.execute("COMMIT")
+                    return None, "concurrency", 1
+
+            if route_class.rate is not None:
+                row = connection.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+                tokens = route_class.burst if row is None else \
+                    min(route_class.burst, row[0] + (now - row[1]) * route_class.rate)
+                if tokens < 1:
+                    connection.execute("COMMIT")
+                    return None, "rate", (1 - tokens) / route_class.rate
+                connection.execute("INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)",
+                                   (key, tokens - 1, now))
+
+            slot_id = None
+            if route_class.concurrency is not None:
+                slot_id = uuid.uuid4().hex
+                connection.execute("INSERT INTO slots (id, key, expires) VALUES (?, ?, ?)",
+                                   (slot_id, key, now + self.slot_timeout))
+            connection.execute("COMMIT")
+            return slot_id, None, 0
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+    def release(self, slot_id):
+        self.connection().execute("DELETE FROM slots WHERE id = ?", (slot_id,))
+
+    def cleanup(self, now=None, idle=3600):
+        """
+        removing the expired slots and the buckets that have been full for a while.
+        """
+        now = time.time() if now is None else now
+        connection = self.connection()
+        connection.execute("DELETE FROM slots WHERE expires < ?", (now,))
+        connection.execute("DELETE FROM buckets WHERE updated < ?", (now - idle,))
+
+
+class ReleasingIterator:
+    """
+    Content of a streaming response calling on_close() once when the response is closed (after the last chunk or
+    when the client went away), so a slot is held for as long as the stream and not only until the view returns.
+    """
+
+    def __init__(self, iterable, on_close):
+        self.iterator = iter(iterable)
+        self.on_close = on_close
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.iterator)
+
+    def close(self):
+        on_close, self.on_close = self.on_close, None
+        try:
+            if hasattr(self.iterator, "close"):
+                self.iterator.close()
+        finally:
+            if on_close is not None:
+                on_close()
+
+
+def retry_after(seconds):
+    """
+    value of the Retry-After header, whole seconds rounded up
+    """
+    return str(max(int(math.ceil(seconds)), 1))
@@ -0,0 +1,118 @@
+import json
+import math
+import os
+import platform
+import time
+import tracemalloc
+import datetime
+
+
+def percentile(sorted_values, pct):
+    """
+    Nearest-rank percentile of an already sorted list.
+    sorted_values[list]: values sorted in ascending order
+    pct[float]: percentile between 0 and 100
+    """
+    if not sorted_values:
+        return None
+    rank = max(int(math.ceil(pct / 100.0 * len(sorted_values))), 1)
+    return sorted_values[rank - 1]
+
+
+def summarize_latencies(latencies):
+    """
+    Summary of a list of latencies (in seconds). The summary is returned in milliseconds so it can be read
+    directly in the result files.
+    """
+    values = sorted(latencies)
+    if not values:
+        return {"count": 0}
+
+    def to_ms(value):
+        return round(value * 1000, 3)
+
+    return {
+        "count": len(values),
+        "min_ms": to_ms(values[0]),
+        "mean_ms": to_ms(sum(values) / len(values)),
+        "p50_ms": to_ms(percentile(values, 50)),
+        "p95_ms": to_ms(percentile(values, 95)),
+        "p99_ms": to_ms(percentile(values, 99)),
+        "max_ms": to_ms(values[-1]),
+    }
+
+
+def environment_info():
+    """
+    Basic information of the machine the benchmark ran on, stored with the results so that runs from
+    different machines are not compared blindly.
+    """
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "recorded_on": datetime.datetime.utcnow().isoformat() + "Z",
+    }
+
+
+def write_results(path, results):
+    """
+    Write the benchmark results as JSON. '-' writes to stdout.
+    """
+    payload = json.dumps(results, indent=2, sort_keys=True, default=str)
+    if path == "-":
+        print(payload)
+        return
+    with open(path, "w") as outfile:
+        outfile.write(payload)
+        outfile.write("\n")
+
+
+def load_results(path):
+    with open(path, "r") as infile:
+        return json.load(infile)
+
+
+def measure(func, repeat=5):
+    """
+    Timing func over 'repeat' runs, then one more run under tracemalloc for the peak of the memory allocated by
+    python while it runs (tracing slows the code down, so the timed runs are not traced).
+    Returns the latency summary with 'peak_memory_bytes'.
+    """
+    latencies = []
+    for _ in range(max(repeat, 1)):
+        started = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - started)
+    summary = summarize_latencies(latencies)
+
+    tracemalloc.start()
+    try:
+        func()
+        summary["peak_memory_bytes"] = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return summary
+
+
+def compare_results(baseline, current, threshold, min_ms=1.0, metrics=("p50_ms", "peak_memory_bytes")):
+    """
+    Comparing the cases of two benchmark results ({"cases": {name: summary}}).
+    threshold[float]: relative increase over the baseline reported as a regression, eg. 0.2 for +20%
+    min_ms[float]: timing increases below this many milliseconds are noise, never regressions
+    Returns the list of {"case", "metric", "baseline", "current", "change"}, regressions have "regression": True.
+    """
+    rows = []
+    for name, summary in sorted(current.get("cases", {}).items()):
+        baseline_summary = baseline.get("cases", {}).get(name)
+        if baseline_summary is None:
+            continue
+        for metric in metrics:
+            before, after = baseline_summary.get(metric), summary.get(metric)
+            if not before or after is None:
+                continue
+            change = (after - before) / before
+            regression = change > threshold and not (metric.endswith("_ms") and after - before < min_ms)
+            rows.append({"case": name, "metric": metric, "baseline": before, "current": after,
+                         "change": round(change, 4), "regression": regression})
+    return rows
@@ -0,0 +1,116 @@
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from asgiref.local import Local
+
+"""
+Per request metrics of the request that is currently being processed. It's only set while the
+RequestInstrumentationMiddleware is enabled, every helper below is a no-op otherwise.
+"""
+_state = Local()
+
+
+class RequestMetrics:
+    """
+    Metrics collected for a single request.
+
+    query_count[int]: number of SQL queries executed
+    sql_time[float]: seconds spent executing SQL queries
+    bytes_read[int]: bytes read from document, version and diff files
+    bytes_written[int]: bytes written to document, version, diff and temporary files
+    timings[dict]: seconds spent in named sections of the request. eg. {"diff": 0.2, "file": 0.01}
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.query_count = 0
+        self.sql_time = 0.0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.timings = defaultdict(float)
+
+    def __call__(self, execute, sql, params, many, context):
+        """
+        database execute wrapper, used with connection.execute_wrapper()
+        """
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.query_count += 1
+            self.sql_time += time.perf_counter() - started
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+
+def current():
+    return getattr(_state, "metrics", None)
+
+
+def activate(metrics):
+    """
+    Returns the previously active metrics, to be passed to deactivate().
+    """
+    previous = current()
+    _state.metrics = metrics
+    return previous
+
+
+def deactivate(previous):
+    _state.metrics = previous
+
+
+def add_bytes_read(size):
+    metrics = current()
+    if metrics is not None:
+        metrics.bytes_read += size
+
+
+def add_bytes_written(size):
+    metrics = current()
+    if metrics is not None:
+        metrics.bytes_written += size
+
+
+@contextmanager
+def timer(name):
+    """
+    Add the time spent in the block to the named section of the current request.
+    eg.
+        with instrumentation.timer("diff"):
+            ...
+    """
+    metrics = current()
+    if metrics is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.timings[name] += time.perf_counter() - started
+
+
+def get_query_budget(view_class, method=None):
+    """
+    Query budget declared on a view with the 'query_budget' attribute. The budget is either a number for
+    every method or a dict by HTTP method. eg. query_budget = {"GET": 4, "PATCH": 8}
+    """
+    budget = getattr(view_class, "query_budget", None)
+    if isinstance(budget, dict):
+        return budget.get(method.upper()) if method else None
+    return budget
+
+
+def resolve_view_class(request):
+    """
+    View class of the resolved URL. Works for both APIView(s) and ViewSet(s).
+    """
+    resolver_match = getattr(request, "resolver_match", None)
+    if resolver_match is None:
+        return None
+    view_func = resolver_match.func
+    return getattr(view_func, "cls", None) or getattr(view_func, "view_class", None)
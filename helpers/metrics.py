@@ -0,0 +1,333 @@
+import fcntl
+import glob
+import itertools
+import json
+import os
+import threading
+import time
+import uuid
+import weakref
+
+from django.conf import settings
+
+DEFAULT_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+DEFAULT_SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+
+class ShardOwner:
+    """
+    Kept in the thread local storage of the thread owning a shard, collected when the thread ends.
+    """
+    __slots__ = ("__weakref__", )
+
+
+class Metric:
+    """
+    Base class of the metrics. Every thread updates its own shard of the values so that the hot path doesn't need
+    a lock. Shards are only merged when the metric is collected, and the shard of a thread that ended is folded into
+    the retired values (servers like runserver start a thread per request).
+
+    name[string]: prometheus metric name
+    documentation[string]: help text
+    labelnames[tuple]: names of the labels, values are passed as keyword arguments on update
+    """
+    metric_type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        self._shards = {}
+        self._retired = {}
+        self._tokens = itertools.count()
+        self._shards_lock = threading.Lock()
+
+    def _shard(self):
+        shard = getattr(self._local, "values", None)
+        if shard is None:
+            shard, owner = {}, ShardOwner()
+            with self._shards_lock:
+                token = next(self._tokens)
+                self._shards[token] = shard
+            self._local.values, self._local.owner = shard, owner
+            weakref.finalize(owner, self._retire, token)
+        return shard
+
+    def _retire(self, token):
+        with self._shards_lock:
+            shard = self._shards.pop(token, None)
+            if shard:
+                self._merge(self._retired, shard)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(label, "")) for label in self.labelnames)
+
+    def _merge(self, values, shard):
+        raise NotImplementedError
+
+    def collect(self):
+        values = {}
+        with self._shards_lock:
+            for shard in [self._retired] + list(self._shards.values()):
+                self._merge(values, shard)
+        return values
+
+
+class Counter(Metric):
+    metric_type = "counter"
+
+    def inc(self, amount=1, **labels):
+        shard = self._shard()
+        key = self._key(labels)
+        shard[key] = shard.get(key, 0) + amount
+
+    def _merge(self, values, shard):
+        for key, value in list(shard.items()):
+            values[key] = values.get(key, 0) + value
+
+
+class Histogram(Metric):
+    """
+    Histogram with fixed upper bounds. Values of a label set are stored as [bucket counts..., sum, count] where
+    the bucket counts are not cumulative, they are made cumulative on exposition.
+    """
+    metric_type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        shard = self._shard()
+        key = self._key(labels)
+        values = shard.get(key)
+        if values is None:
+            values = shard[key] = [0] * (len(self.buckets) + 3)
+        index = len(self.buckets)
+        for position, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = position
+                break
+        values[index] += 1
+        values[-2] += value
+        values[-1] += 1
+
+    def _merge(self, values, shard):
+        for key, shard_values in list(shard.items()):
+            merged = values.setdefault(key, [0] * (len(self.buckets) + 3))
+            for position, value in enumerate(list(shard_values)):
+                merged[position] += value
+
+
+class Registry:
+    """
+    All the metrics of this process. When settings.METRICS_DIR is set, the process periodically writes a snapshot
+    of its metrics to its own file in that directory and the exposition merges the snapshots of every worker
+    process, so any worker can answer the scrape.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self._pid = None
+        self._process_id = None
+        self.last_flush = 0.0
+
+    @property
+    def process_id(self):
+        """
+        unique id of this worker process. Regenerated after a fork so that pre-forked workers don't share a file.
+        """
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._process_id = f"{self._pid}_{uuid.uuid4().hex[:8]}"
+        return self._process_id
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_LATENCY_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def snapshot(self):
+        return {
+            name: [[list(key), value] for key, value in metric.collect().items()]
+            for name, metric in self.metrics.items()
+        }
+
+    @property
+    def metrics_dir(self):
+        return getattr(settings, "METRICS_DIR", None)
+
+    def maybe_flush(self):
+        """
+        Write this process' snapshot if it's older than settings.METRICS_FLUSH_INTERVAL seconds.
+        """
+        if self.metrics_dir and time.monotonic() - self.last_flush >= getattr(settings, "METRICS_FLUSH_INTERVAL", 5):
+            self.flush()
+
+    def flush(self):
+        """
+        atomically replace this process' snapshot file.
+        """
+        self.last_flush = time.monotonic()
+        os.makedirs(self.metrics_dir, exist_ok=True)
+        path = os.path.join(self.metrics_dir, f"metrics_{self.process_id}.json")
+        write_snapshot(path, self.snapshot())
+
+    def aggregate(self):
+        """
+        merge the snapshots of every worker process. Falls back to this process' metrics when METRICS_DIR isn't set.
+        """
+        if not self.metrics_dir:
+            return {name: metric.collect() for name, metric in self.metrics.items()}
+
+        self.flush()
+        self.prune()
+        merged = {name: {} for name in self.metrics}
+        for path in glob.glob(os.path.join(self.metrics_dir, "metrics_*.json")):
+            merge_snapshot(merged, read_snapshot(path))
+        return merged
+
+    def prune(self):
+        """
+        Folding the snapshots of the worker processes that exited into the retired snapshot, so their counts are
+        kept without keeping a file per process ever started. Serialized between the workers by a lock file.
+        """
+        with open(os.path.join(self.metrics_dir, "metrics.lock"), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            dead = [path for path in glob.glob(os.path.join(self.metrics_dir, "metrics_*.json"))
+                    if snapshot_pid(path) not in (None, os.getpid()) and not pid_alive(snapshot_pid(path))]
+            if not dead:
+                return
+
+            retired_path = os.path.join(self.metrics_dir, RETIRED_SNAPSHOT)
+            retired = {}
+            merge_snapshot(retired, read_snapshot(retired_path))
+            for path in dead:
+                merge_snapshot(retired, read_snapshot(path))
+            write_snapshot(retired_path, {name: [[list(key), value] for key, value in values.items()]
+                                          for name, values in retired.items()})
+            for path in dead:
+                os.remove(path)
+
+
+    def exposition(self):
+        """
+        metrics in the prometheus text format (version 0.0.4)
+        """
+        lines = []
+        for name, values in self.aggregate().items():
+            metric = self.metrics[name]
+            lines.append(f"# HELP {name} {metric.documentation}")
+            lines.append(f"# TYPE {name} {metric.metric_type}")
+            for key, value in sorted(values.items()):
+                labels = list(zip(metric.labelnames, key))
+                if metric.metric_type == "histogram":
+                    cumulative = 0
+                    for bound, count in zip(list(metric.buckets) + ["+Inf"], value[:-2]):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{format_labels(labels + [('le', bound)])} {cumulative}")
+                    lines.append(f"{name}_sum{format_labels(labels)} {value[-2]}")
+                    lines.append(f"{name}_count{format_labels(labels)} {value[-1]}")
+                else:
+                    lines.append(f"{name}{format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+RETIRED_SNAPSHOT = "metrics_retired.json"
+
+
+def write_snapshot(path, snapshot):
+    """
+    atomically replacing a snapshot file.
+    """
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as outfile:
+        json.dump(snapshot, outfile)
+    os.replace(temp_path, path)
+
+
+def read_snapshot(path):
+    """
+    snapshot of a file, empty when it's unreadable (eg. removed by a prune).
+    """
+    try:
+        with open(path, "r") as infile:
+            return json.load(infile)
+    except (OSError, ValueError):
+        return {}
+
+
+def merge_snapshot(merged, snapshot):
+    """
+    adding a snapshot ({name: [[key, value]...]}) to the merged values ({name: {key: value}}). When merged has
+    names already, the metrics of the other names are skipped (eg. metrics removed since the snapshot was written).
+    """
+    names = set(merged)
+    for name, entries in snapshot.items():
+        if names and name not in names:
+            continue
+        values = merged.setdefault(name, {})
+        for key, value in entries:
+            key = tuple(key)
+            if isinstance(value, list):
+                current = values.setdefault(key, [0] * len(value))
+                for position, item in enumerate(value):
+                    current[position] += item
+            else:
+                values[key] = values.get(key, 0) + value
+
+
+def snapshot_pid(path):
+    """
+    pid of the worker process of a snapshot file (metrics_<pid>_<id>.json), None for the retired snapshot.
+    """
+    pid = os.path.basename(path)[len("metrics_"):].split("_")[0]
+    return int(pid) if pid.isdigit() else None
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label_value(value)}"' for name, value in labels) + "}"
+
+
+registry = Registry()
+
+REQUESTS = registry.counter("http_requests_total", "HTTP responses by route, method and status code.",
+                            ("route", "method", "status"))
+REQUEST_LATENCY = registry.histogram("http_request_duration_seconds", "HTTP request latency by route.",
+                                     ("route", "method"))
+UPLOAD_BYTES = registry.counter("document_upload_bytes_total", "Bytes of uploaded documents.")
+DOWNLOAD_BYTES = registry.counter("document_download_bytes_total", "Bytes of downloaded documents.")
+DIFF_DURATION = registry.histogram("document_diff_duration_seconds", "Time spent diffing document revisions.",
+                                   ("format",))
+DIFF_SIZE = registry.histogram("document_diff_size_bytes", "Size of the stored diff files.", ("format",),
+                               buckets=DEFAULT_SIZE_BUCKETS)
+LOCK_ACQUISITIONS = registry.counter("document_lock_acquisitions_total", "Document edit locks acquired.")
+LOCK_CONTENTIONS = registry.counter("document_lock_contention_total",
+                                    "Document fetches refused because another user holds the edit lock.")
+CACHE_REQUESTS = registry.counter("cache_requests_total", "Cache lookups by cache and result (hit or miss).",
+                                  ("cache", "result"))
+ADMISSION_REJECTIONS = registry.counter("admission_rejections_total",
+                                        "Requests refused with a 429 by route class and limit (rate or concurrency).",
+                                        ("route_class", "limit"))
@@ -1,10 +1,24 @@
 from calendar import timegm
 import jwt
+import json
+import logging
+from contextlib import ExitStack
 from django.utils.deprecation import MiddlewareMixin
 from django.conf import LazySettings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
 import datetime
 from django.http import JsonResponse
 from documents.models import Document, DocumentVersion
+from helpers import admission, instrumentation, metrics
+import time
+import cProfile
+import hmac
+import os
+import random
+import re
+import sqlite3
+import uuid
 
 settings = LazySettings()
 
@@ -14,32 +28,41 @@ class RestTokenDecoderMiddleware(MiddlewareMixin):
     Custom authentication middleware for JWT
     """
 
+    """
+    endpoints that don't require authentication token.
+    """
+    public_paths = frozenset(['/swagger/',
+                              '/redoc/',
+                              '/metrics',
+                              '/api/v1/login/',
+                              '/api/v1/token-refresh/',
+                              '/api/v1/register/',
+                              '/api/v1/reset-password/'])
+
+    """
+    the signed media URLs carry their own signature.
+    """
+    public_prefixes = (settings.SIGNED_MEDIA_URL, )
+
+    """
+    the media directories aren't served, the files are downloaded with '/api/v1/fetch_document/' or the signed URLs
+    (the diff URLs of the version list, '/api/v1/document_version/<id>/download_urls/').
+    """
+    protected_media_prefixes = (settings.MEDIA_URL, )
+
     def process_request(self, request):
-        
-        """
-        disabling the any user to view the document file from the django media URL.
-        only documentVersion diff_file can be viewed with django media URL.
-        """
-        if "/media/document_version_files/" in request.path or "/media/document/" in request.path:
-            return JsonResponse({"error": "Use '/api/v1/fetch_document/' api to fetch or view a media document."},
-                                status=401)
-        elif "/media/document_diff_files/" in request.path:
-            return
+        path = request.path
+        if path.startswith(self.protected_media_prefixes):
+            return JsonResponse({"error": "Use '/api/v1/fetch_document/' api or the signed URLs to fetch or view a "
+                                          "media file."}, status=401)
 
-        """
-        Bypassing few API endpoints with doesn't require authentication token.
-        """
-        if request.path not in ['/swagger/',
-                                '/redoc/',
-                                '/api/v1/login/',
-                                '/api/v1/register/',
-                                '/api/v1/reset-password/']:
-            request.user_val = self.get_jwt_user(request)
-            if not request.user_val:
-                return JsonResponse({'error': 'Invalid token in header.'}, status=401)
-        else:
+        if path in self.public_paths or path.startswith(self.public_prefixes):
             return
 
+        request.user_val = self.get_jwt_user(request)
+        if not request.user_val:
+            return JsonResponse({'error': 'Invalid token in header.'}, status=401)
+
     def get_jwt_user(self, request):
 
         try:
@@ -64,3 +87,217 @@ class RestTokenDecoderMiddleware(MiddlewareMixin):
             except Exception as e:
                 return False
         return user_jwt
+
+
+class RequestInstrumentationMiddleware:
+    """
+    Opt-in middleware (settings.REQUEST_INSTRUMENTATION) that records the query count, SQL time, file bytes
+    read/written and the time spent in named sections (eg. diff) of every request.
+    The numbers are returned in the 'Server-Timing' header and logged as JSON on the 'signeasy.requests' logger.
+    Requests that run more queries than the 'query_budget' declared on their view are logged as warnings.
+    """
+
+    logger = logging.getLogger("signeasy.requests")
+
+    def __init__(self, get_response):
+        if not getattr(settings, "REQUEST_INSTRUMENTATION", False):
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+
+    def __call__(self, request):
+        metrics = instrumentation.RequestMetrics()
+        token = instrumentation.activate(metrics)
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(metrics))
+                response = self.get_response(request)
+        finally:
+            instrumentation.deactivate(token)
+
+        total = metrics.elapsed
+        response["Server-Timing"] = self.server_timing(metrics, total)
+        self.log(request, response, metrics, total)
+        return response
+
+    @staticmethod
+    def server_timing(metrics, total):
+        """
+        eg. db;dur=3.1;desc="4 queries", diff;dur=10.2, file;dur=0.8;desc="read=1024 written=2048", app;dur=1.0, total;dur=15.1
+        'app' is whatever is not accounted by the other sections (serialization, permissions, middlewares etc).
+        """
+        entries = [f'db;dur={metrics.sql_time * 1000:.2f};desc="{metrics.query_count} queries"']
+        accounted = metrics.sql_time
+        for name, duration in sorted(metrics.timings.items()):
+            entry = f"{name};dur={duration * 1000:.2f}"
+            if name == "file":
+                entry += f';desc="read={metrics.bytes_read} written={metrics.bytes_written}"'
+            entries.append(entry)
+            accounted += duration
+        entries.append(f"app;dur={max(total - accounted, 0) * 1000:.2f}")
+        entries.append(f"total;dur={total * 1000:.2f}")
+        return ", ".join(entries)
+
+    def log(self, request, response, metrics, total):
+        view_class = instrumentation.resolve_view_class(request)
+        query_budget = instrumentation.get_query_budget(view_class, request.method)
+        record = {
+            "method": request.method,
+            "path": request.path,
+            "view": view_class.__name__ if view_class else None,
+            "status": response.status_code,
+            "duration_ms": round(total * 1000, 2),
+            "query_count": metrics.query_count,
+            "sql_ms": round(metrics.sql_time * 1000, 2),
+            "bytes_read": metrics.bytes_read,
+            "bytes_written": metrics.bytes_written,
+            "timings_ms": {name: round(duration * 1000, 2) for name, duration in metrics.timings.items()},
+            "query_budget": query_budget,
+        }
+        if query_budget is not None and metrics.query_count > query_budget:
+            self.logger.warning(json.dumps(record))
+        else:
+            self.logger.info(json.dumps(record))
+
+
+class MetricsMiddleware(MiddlewareMixin):
+    """
+    Records the latency and the status code of every request by route for the '/metrics' endpoint.
+    """
+
+    def process_request(self, request):
+        request.metrics_started = time.perf_counter()
+
+    def process_response(self, request, response):
+        started = getattr(request, "metrics_started", None)
+        if started is not None:
+            resolver_match = getattr(request, "resolver_match", None)
+            route = resolver_match.view_name if resolver_match else "unmatched"
+            metrics.REQUEST_LATENCY.observe(time.perf_counter() - started, route=route, method=request.method)
+            metrics.REQUESTS.inc(route=route, method=request.method, status=response.status_code)
+            metrics.registry.maybe_flush()
+        return response
+
+
+class RequestProfilingMiddleware:
+    """
+    Opt-in profiler (settings.REQUEST_PROFILING_DIR). A request is profiled with cProfile when it carries the
+    'X-Profile-Request' header with the value of settings.REQUEST_PROFILING_SECRET, or when it's picked by
+    settings.REQUEST_PROFILING_SAMPLE_RATE (0 to 1). The profile is written as a pstats file tagged with the route
+    and the document id of the URL, eg. 20221019T101010_re-upload-document_42_1a2b3c4d.pstats
+    The middleware removes itself when profiling isn't configured, so it doesn't cost anything when disabled.
+    """
+
+    header = "HTTP_X_PROFILE_REQUEST"
+
+    def __init__(self, get_response):
+        self.profile_dir = getattr(settings, "REQUEST_PROFILING_DIR", None)
+        if not self.profile_dir:
+            raise MiddlewareNotUsed()
+        self.secret = getattr(settings, "REQUEST_PROFILING_SECRET", None)
+        self.sample_rate = float(getattr(settings, "REQUEST_PROFILING_SAMPLE_RATE", 0) or 0)
+        os.makedirs(self.profile_dir, exist_ok=True)
+        self.get_response = get_response
+
+    def should_profile(self, request):
+        requested = request.META.get(self.header)
+        if requested and self.secret and hmac.compare_digest(requested, self.secret):
+            return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def __call__(self, request):
+        if not self.should_profile(request):
+            return self.get_response(request)
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            response = self.get_response(request)
+        finally:
+            profiler.disable()
+
+        profile_name = self.profile_name(request)
+        profiler.dump_stats(os.path.join(self.profile_dir, profile_name))
+        response["X-Profile-Id"] = profile_name
+        return response
+
+    @staticmethod
+    def profile_name(request):
+        resolver_match = getattr(request, "resolver_match", None)
+        route = resolver_match.view_name if resolver_match else "unmatched"
+        document_id = resolver_match.kwargs.get("pk", "-") if resolver_match else "-"
+        route = re.sub(r"[^A-Za-z0-9_.-]", "_", route)
+        timestamp = datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%S")
+        return f"{timestamp}_{route}_{document_id}_{uuid.uuid4().hex[:8]}.pstats"
+
+
+class AdmissionControlMiddleware(MiddlewareMixin):
+    """
+    Opt-in admission control (settings.ADMISSION_CONTROL_DB) of the route classes of settings.ADMISSION_CONTROL.
+    Every client (the user of the token, or the IP address of anonymous requests eg. logins) gets a token bucket and
+    a cap of concurrent requests per route class, shared by all the worker processes (see helpers.admission).
+    Requests over a limit are refused with a 429 and a 'Retry-After' header before the view runs, so a single
+    client can't hold every worker.
+    """
+
+    logger = logging.getLogger("signeasy.admission")
+
+    def __init__(self, get_response):
+        path = getattr(settings, "ADMISSION_CONTROL_DB", None)
+        if not path:
+            raise MiddlewareNotUsed()
+        super(AdmissionControlMiddleware, self).__init__(get_response)
+        self.store = admission.AdmissionStore(path, slot_timeout=getattr(settings, "ADMISSION_SLOT_TIMEOUT", 600))
+        self.route_classes = admission.load_route_classes(getattr(settings, "ADMISSION_CONTROL", {}))
+        self.cleanup_interval = getattr(settings, "ADMISSION_CLEANUP_INTERVAL", 60)
+        self.cleaned_on = 0
+
+    @staticmethod
+    def client_key(request):
+        user_val = getattr(request, "user_val", None)
+        if user_val and user_val.get("user_id") is not None:
+            return f"user:{user_val['user_id']}"
+        return f"ip:{request.META.get('REMOTE_ADDR', '-')}"
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        url_name = request.resolver_match.url_name if request.resolver_match else None
+        route_class = next((route_class for route_class in self.route_classes
+                            if route_class.matches(url_name, request.method)), None)
+        if route_class is None:
+            return None
+
+        try:
+            if time.monotonic() - self.cleaned_on > self.cleanup_interval:
+                self.cleaned_on = time.monotonic()
+                self.store.cleanup()
+            slot_id, limit, wait = self.store.acquire(f"{route_class.name}:{self.client_key(request)}", route_class)
+        except sqlite3.Error as e:
+            self.logger.warning(f"Admission control store unavailable, letting the request through: {e}")
+            return None
+
+        if limit is not None:
+            metrics.ADMISSION_REJECTIONS.inc(route_class=route_class.name, limit=limit)
+            response = JsonResponse({"error": "Too many requests. Retry later."}, status=429)
+            response["Retry-After"] = admission.retry_after(wait)
+            return response
+        request.admission_slot = slot_id
+        return None
+
+    def process_response(self, request, response):
+        """
+        the slot of a streaming response (eg. event streams, ZIP downloads) is released when the stream is closed.
+        """
+        slot_id = getattr(request, "admission_slot", None)
+        if slot_id is not None:
+            if response.streaming:
+                response.streaming_content = admission.ReleasingIterator(response.streaming_content,
+                                                                         lambda: self.release(slot_id))
+            else:
+                self.release(slot_id)
+        return response
+
+    def release(self, slot_id):
+        try:
+            self.store.release(slot_id)
+        except sqlite3.Error as e:
+            self.logger.warning(f"Unable to release the admission slot {slot_id}: {e}")
@@ -0,0 +1,68 @@
+import base64
+import hashlib
+import hmac
+import time
+from urllib.parse import quote, urlencode
+
+from django.conf import settings
+from rest_framework import serializers
+
+
+def get_signing_key():
+    return (getattr(settings, "SIGNED_MEDIA_KEY", None) or settings.SECRET_KEY).encode()
+
+
+def sign(name, expires):
+    """
+    HMAC-SHA256 signature of a media file name and its expiry (unix timestamp), url safe base64 without padding.
+    """
+    digest = hmac.new(get_signing_key(), f"{name}\n{expires}".encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b"=").decode()
+
+
+def make_signed_url(name, ttl=None, now=None):
+    """
+    Short lived URL of a media file, served by helpers.views.signed_media_view without a database query.
+    name[string]: name of the file in the default storage (FieldFile.name)
+    ttl[int]: seconds the URL stays valid, settings.SIGNED_MEDIA_TTL by default
+    Returns the URL (path + query string) and its expiry timestamp.
+    """
+    ttl = ttl or getattr(settings, "SIGNED_MEDIA_TTL", 300)
+    expires = int(now or time.time()) + int(ttl)
+    query = urlencode({"expires": expires, "signature": sign(name, expires)})
+    return f"{settings.SIGNED_MEDIA_URL}{quote(name)}?{query}", expires
+
+
+def verify(name, expires, signature, now=None):
+    """
+    True when the signature matches the name and the expiry hasn't passed.
+    """
+    try:
+        expires = int(expires)
+    except (TypeError, ValueError):
+        return False
+    if expires < int(now or time.time()):
+        return False
+    return hmac.compare_digest(sign(name, expires), signature or "")
+
+
+class SignedFileField(serializers.FileField):
+    """
+    Read only file field rendered as a short lived signed URL (see make_signed_url) instead of its media URL, for
+    the files the API hands out to every authenticated user (eg. the diff files of the version list).
+    """
+
+    def __init__(self, **kwargs):
+        kwargs["read_only"] = True
+        super().__init__(**kwargs)
+
+    @staticmethod
+    def url(name):
+        return make_signed_url(name)[0]
+
+    def to_representation(self, value):
+        if not value:
+            return None
+        url = self.url(value.name)
+        request = self.context.get("request")
+        return request.build_absolute_uri(url) if request is not None else url
@@ -0,0 +1,70 @@
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+
+from helpers.instrumentation import get_query_budget
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+@contextmanager
+def assert_query_budget(view_class, method=None, budget=None):
+    """
+    Fail when the block runs more queries than the 'query_budget' declared on the view (or the budget passed).
+    eg.
+        with assert_query_budget(FetchDocumentView, "GET"):
+            self.client.get(f"/api/v1/fetch_document/{document.id}/", **auth_header)
+    """
+    if budget is None:
+        budget = get_query_budget(view_class, method)
+    if budget is None:
+        raise ValueError(f"{view_class.__name__} doesn't declare a query budget for {method or 'any method'}.")
+
+    with CaptureQueriesContext(connection) as queries:
+        yield queries
+
+    if len(queries) > budget:
+        executed = "\n".join(f"{index}. {query['sql']}" for index, query in enumerate(queries.captured_queries, 1))
+        raise QueryBudgetExceeded(f"{view_class.__name__} ran {len(queries)} queries, budget is {budget}.\n"
+                                  f"{executed}")
+
+
+class QueryBudgetMixin:
+    """
+    TestCase mixin exposing assert_query_budget as an assertion method.
+    """
+
+    def assertWithinQueryBudget(self, view_class, method=None, budget=None):
+        return assert_query_budget(view_class, method, budget)
+
+
+class MediaTestMixin:
+    """
+    TestCase mixin writing the media files of the tests to a temporary MEDIA_ROOT, removed after the test class.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.media_root = tempfile.mkdtemp(prefix="signeasy_test_media_")
+        cls.media_settings = override_settings(MEDIA_ROOT=cls.media_root)
+        cls.media_settings.enable()
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.media_settings.disable()
+        shutil.rmtree(cls.media_root, ignore_errors=True)
+
+
+def auth_header(user):
+    """
+    Authorization header of the test client requests made as the user.
+    """
+    return {"HTTP_AUTHORIZATION": f"Token {user.get_jwt_token_for_user()}"}
@@ -0,0 +1,199 @@
+import gc
+import glob
+import os
+import subprocess
+import tempfile
+import threading
+import types
+from unittest import mock
+
+from django.conf import settings
+from django.http import HttpResponse, StreamingHttpResponse
+from django.test import RequestFactory, SimpleTestCase, override_settings
+
+from helpers import admission, metrics, middlewares
+
+
+def run_threads(target, count):
+    threads = [threading.Thread(target=target, args=(index, )) for index in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    gc.collect()
+
+
+class MetricsTestCase(SimpleTestCase):
+    """
+    Metrics updated from many threads: aggregation, retirement of the shards of the threads that ended, the
+    exposition format and the merge of the snapshots of the worker processes.
+    """
+
+    def setUp(self):
+        self.registry = metrics.Registry()
+        self.requests = self.registry.counter("test_requests_total", "Requests.", ("route", "status"))
+        self.latency = self.registry.histogram("test_latency_seconds", "Latency.", ("route", ), buckets=(0.1, 1))
+
+    def test_counter_across_threads(self):
+        def work(index):
+            for _ in range(10):
+                self.requests.inc(route="list", status=200 if index % 2 else 500)
+            self.requests.inc(5, route="fetch", status=200)
+
+        run_threads(work, 40)
+        self.assertEqual(self.requests.collect(), {("list", "200"): 200, ("list", "500"): 200, ("fetch", "200"): 200})
+
+    def test_histogram_across_threads(self):
+        def work(index):
+            for value in (0.05, 0.5, 5):
+                self.latency.observe(value, route="list")
+
+        run_threads(work, 20)
+        self.latency.observe(1, route="list")
+        value = self.latency.collect()[("list", )]
+        self.assertEqual(value[:-2], [20, 21, 20])
+        self.assertAlmostEqual(value[-2], 20 * 5.55 + 1)
+        self.assertEqual(value[-1], 61)
+
+    def test_shards_of_ended_threads_retired(self):
+        run_threads(lambda index: self.requests.inc(route="list", status=200), 1000)
+        self.assertLessEqual(len(self.requests._shards), 1)
+        self.assertEqual(self.requests.collect(), {("list", "200"): 1000})
+
+        self.requests.inc(route="list", status=200)
+        self.assertEqual(len(self.requests._shards), 1)
+        self.assertEqual(self.requests.collect(), {("list", "200"): 1001})
+
+    def test_exposition(self):
+        self.requests.inc(2, route='say "hi"\n', status=200)
+        self.latency.observe(0.5, route="list")
+        self.latency.observe(3, route="list")
+        self.assertEqual(self.registry.exposition(), "\n".join([
+            "# HELP test_requests_total Requests.",
+            "# TYPE test_requests_total counter",
+            'test_requests_total{route="say \\"hi\\"\\n",status="200"} 2',
+            "# HELP test_latency_seconds Latency.",
+            "# TYPE test_latency_seconds histogram",
+            'test_latency_seconds_bucket{route="list",le="0.1"} 0',
+            'test_latency_seconds_bucket{route="list",le="1"} 1',
+            'test_latency_seconds_bucket{route="list",le="+Inf"} 2',
+            'test_latency_seconds_sum{route="list"} 3.5',
+            'test_latency_seconds_count{route="list"} 2',
+        ]) + "\n")
+
+    def test_snapshots_of_exited_workers(self):
+        """
+        the snapshot of a worker that exited is folded into the retired snapshot, its counts are kept.
+        """
+        exited = subprocess.Popen(["true"])
+        exited.wait()
+        with tempfile.TemporaryDirectory() as directory, override_settings(METRICS_DIR=directory):
+            metrics.write_snapshot(os.path.join(directory, f"metrics_{exited.pid}_abcd1234.json"),
+                                   {"test_requests_total": [[["list", "200"], 3]],
+                                    "test_latency_seconds": [[["list"], [1, 0, 0, 0.05, 1]]],
+                                    "removed_metric_total": [[[], 1]]})
+            self.requests.inc(route="list", status=200)
+
+            for _ in range(2):
+                merged = self.registry.aggregate()
+                self.assertEqual(merged["test_requests_total"], {("list", "200"): 4})
+                self.assertEqual(merged["test_latency_seconds"], {("list", ): [1, 0, 0, 0.05, 1]})
+                self.assertNotIn("removed_metric_total", merged)
+            self.assertEqual(sorted(os.path.basename(path) for path in glob.glob(os.path.join(directory, "*.json"))),
+                             sorted([metrics.RETIRED_SNAPSHOT, f"metrics_{self.registry.process_id}.json"]))
+
+
+class AdmissionTestCase(SimpleTestCase):
+    """
+    Token buckets and concurrency slots of the admission store, and the release of the slots by the middleware.
+    """
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "admission.sqlite3")
+        self.store = admission.AdmissionStore(self.path)
+
+    def test_token_bucket(self):
+        route_class = admission.RouteClass("exports", {"export"}, rate=0.5, burst=2)
+        self.assertEqual(self.store.acquire("exports:user:1", route_class, now=100), (None, None, 0))
+        self.assertEqual(self.store.acquire("exports:user:1", route_class, now=100), (None, None, 0))
+        slot_id, limit, wait = self.store.acquire("exports:user:1", route_class, now=100)
+        self.assertEqual((slot_id, limit, wait), (None, "rate", 2))
+        self.assertEqual(admission.retry_after(wait), "2")
+        self.assertEqual(self.store.acquire("exports:user:2", route_class, now=100), (None, None, 0))
+
+        """
+        refilled at 'rate' tokens per second, never above 'burst'
+        """
+        self.assertEqual(self.store.acquire("exports:user:1", route_class, now=101)[1:], ("rate", 1))
+        self.assertEqual(self.store.acquire("exports:user:1", route_class, now=102), (None, None, 0))
+        self.assertEqual(self.store.acquire("exports:user:1", route_class, now=102.5)[1], "rate")
+        for _ in range(2):
+            self.assertEqual(self.store.acquire("exports:user:1", route_class, now=1000), (None, None, 0))
+        self.assertEqual(self.store.acquire("exports:user:1", route_class, now=1000)[1], "rate")
+
+    def test_concurrency_slots(self):
+        route_class = admission.RouteClass("diffs", {"diff"}, concurrency=2)
+        first, _, _ = self.store.acquire("diffs:user:1", route_class, now=100)
+        second, _, _ = self.store.acquire("diffs:user:1", route_class, now=100)
+        self.assertTrue(first and second and first != second)
+        self.assertEqual(self.store.acquire("diffs:user:1", route_class, now=100), (None, "concurrency", 1))
+
+        self.store.release(first)
+        self.assertIsNotNone(self.store.acquire("diffs:user:1", route_class, now=100)[0])
+        self.assertIsNotNone(self.store.acquire("diffs:user:1", route_class, now=100 + 601)[0])
+
+    def middleware(self, **route_class):
+        patch = mock.patch.object(middlewares, "settings", settings)
+        patch.start()
+        self.addCleanup(patch.stop)
+        config = {"diffs": dict({"routes": ["diff"], "concurrency": 1}, **route_class)}
+        with override_settings(ADMISSION_CONTROL_DB=self.path, ADMISSION_CONTROL=config):
+            return middlewares.AdmissionControlMiddleware(lambda request: HttpResponse())
+
+    def admit(self, middleware, user_id=1):
+        request = RequestFactory().get("/documents/1/versions/2/diff/")
+        request.resolver_match = types.SimpleNamespace(url_name="diff")
+        request.user_val = {"user_id": user_id}
+        return request, middleware.process_view(request, None, (), {})
+
+    def test_slot_released_with_response(self):
+        middleware = self.middleware()
+        request, rejected = self.admit(middleware)
+        self.assertIsNone(rejected)
+        self.assertEqual(self.admit(middleware)[1].status_code, 429)
+        self.assertEqual(self.admit(middleware, user_id=2)[1], None)
+
+        middleware.process_response(request, HttpResponse())
+        request, rejected = self.admit(middleware)
+        self.assertIsNone(rejected)
+
+    def test_slot_released_with_stream(self):
+        """
+        the slot is held until the stream is closed, whether it was read to the end or not.
+        """
+        middleware = self.middleware()
+        for chunks in (2, 0):
+            request, rejected = self.admit(middleware)
+            self.assertIsNone(rejected)
+            response = middleware.process_response(request, StreamingHttpResponse(iter([b"a", b"b"])))
+            self.assertEqual(list(zip(range(chunks), response)), list(zip(range(chunks), [b"a", b"b"])))
+            rejected = self.admit(middleware)[1]
+            self.assertEqual(rejected.status_code, 429)
+            self.assertEqual(rejected["Retry-After"], "1")
+
+            response.close()
+            response.close()
+            request, rejected = self.admit(middleware)
+            self.assertIsNone(rejected)
+            middleware.process_response(request, HttpResponse())
+
+    def test_releasing_iterator(self):
+        released = []
+        iterator = admission.ReleasingIterator((chunk for chunk in [b"a", b"b"]), lambda: released.append(True))
+        self.assertEqual(next(iterator), b"a")
+        iterator.close()
+        iterator.close()
+        self.assertEqual(released, [True])
+        self.assertEqual(list(iterator), [])
@@ -0,0 +1,165 @@
+from django.core.exceptions import ImproperlyConfigured
+from rest_framework import response, serializers
+from rest_framework.relations import PrimaryKeyRelatedField
+
+from helpers.signed_urls import SignedFileField
+
+"""
+Read only serializers of the list APIs. A ValuesSerializer produces the same data as its 'serializer_class' (a
+ModelSerializer, nested serializers included) from the rows of queryset.values(), with a single query for the page
+instead of building model instances and a serializer tree for every row.
+The field map (output key, values() column and conversion) is computed once from the fields of 'serializer_class',
+so the keys come out in the same order and every value goes through the same DRF field conversion.
+"""
+FIELD_PLAIN = "plain"
+FIELD_IDENTITY = "identity"
+FIELD_FILE = "file"
+FIELD_NESTED = "nested"
+FIELD_METHOD = "method"
+
+
+def build_field_map(serializer, prefix=""):
+    """
+    list of (key, column, kind, extra) for the readable fields of the serializer, columns of nested serializers
+    are prefixed by the path of their relation. extra is the DRF field (plain), the storage or the SignedFileField
+    building the URLs (file) or the field map of the nested serializer (nested).
+    """
+    model = serializer.Meta.model
+    field_map = []
+    for name, field in serializer.fields.items():
+        if field.write_only:
+            continue
+        column = prefix + field.source.replace(".", "__")
+        if isinstance(field, serializers.SerializerMethodField):
+            field_map.append((name, None, FIELD_METHOD, field.method_name))
+        elif isinstance(field, serializers.BaseSerializer):
+            if getattr(field, "many", False):
+                raise ImproperlyConfigured(f"'{name}' is a nested list, use a SerializerMethodField instead.")
+            field_map.append((name, column, FIELD_NESTED, build_field_map(field, f"{column}__")))
+        elif isinstance(field, SignedFileField):
+            field_map.append((name, column, FIELD_FILE, field))
+        elif isinstance(field, serializers.FileField):
+            field_map.append((name, column, FIELD_FILE, model._meta.get_field(field.source).storage))
+        elif isinstance(field, PrimaryKeyRelatedField):
+            field_map.append((name, column, FIELD_IDENTITY, None))
+        elif isinstance(field, serializers.RelatedField):
+            raise ImproperlyConfigured(f"'{name}' of {type(serializer).__name__} is not supported.")
+        elif type(field) in (serializers.CharField, serializers.EmailField, serializers.IntegerField):
+            """
+            values() already returns str and int for these, to_representation would only copy them.
+            """
+            field_map.append((name, column, FIELD_IDENTITY, None))
+        else:
+            field_map.append((name, column, FIELD_PLAIN, field))
+    return field_map
+
+
+def field_map_columns(field_map):
+    columns = []
+    for key, column, kind, extra in field_map:
+        if kind == FIELD_NESTED:
+            columns.append(column)
+            columns.extend(field_map_columns(extra))
+        elif kind != FIELD_METHOD:
+            columns.append(column)
+    return columns
+
+
+class ValuesSerializer:
+    """
+    Base class of the values() serializers.
+    serializer_class[class]: ModelSerializer whose output is reproduced
+    method_columns[dict]: values() columns needed by the SerializerMethodFields, get_<field>(row) is called
+                          with the row dict instead of the model instance. prepare(rows) is called once before
+                          with all the rows of the page to load what they need in bulk.
+    Only supports many=True, use the serializer_class for single objects.
+    """
+    serializer_class = None
+    method_columns = {}
+    _field_maps = {}
+
+    def __init__(self, rows, context=None):
+        self.rows = rows
+        self.context = context or {}
+
+    @classmethod
+    def get_field_map(cls):
+        if cls not in ValuesSerializer._field_maps:
+            ValuesSerializer._field_maps[cls] = build_field_map(cls.serializer_class())
+        return ValuesSerializer._field_maps[cls]
+
+    @classmethod
+    def values(cls, queryset):
+        columns = field_map_columns(cls.get_field_map()) + list(cls.method_columns.values())
+        return queryset.values(*dict.fromkeys(columns))
+
+    def prepare(self, rows):
+        pass
+
+    def compile(self, field_map):
+        """
+        (key, column, convert, nested plan) of every field, convert is None when the value is returned as it is.
+        """
+        request = self.context.get("request")
+        plan = []
+        for key, column, kind, extra in field_map:
+            if kind == FIELD_METHOD:
+                plan.append((key, None, getattr(self, extra), None))
+            elif kind == FIELD_NESTED:
+                plan.append((key, column, None, self.compile(extra)))
+            elif kind == FIELD_FILE:
+                plan.append((key, column, self.file_url(extra, request), None))
+            elif kind == FIELD_PLAIN:
+                plan.append((key, column, extra.to_representation, None))
+            else:
+                plan.append((key, column, None, None))
+        return plan
+
+    @staticmethod
+    def file_url(url_builder, request):
+        def convert(name):
+            if not name:
+                return None
+            url = url_builder.url(name)
+            return request.build_absolute_uri(url) if request is not None else url
+        return convert
+
+    def represent(self, row, plan):
+        data = {}
+        for key, column, convert, nested in plan:
+            if column is None:
+                data[key] = convert(row)
+                continue
+            value = row[column]
+            if nested is not None:
+                data[key] = None if value is None else self.represent(row, nested)
+            elif convert is None:
+                data[key] = value
+            else:
+                data[key] = None if value is None else convert(value)
+        return data
+
+    @property
+    def data(self):
+        rows = list(self.rows)
+        self.prepare(rows)
+        plan = self.compile(self.get_field_map())
+        return [self.represent(row, plan) for row in rows]
+
+
+class ValuesListModelMixin:
+    """
+    list() of a ListModelMixin view serialized by 'values_serializer_class' (a ValuesSerializer). Filtering,
+    ordering and pagination are unchanged.
+    """
+    values_serializer_class = None
+
+    def list(self, request, *args, **kwargs):
+        serializer_class = self.values_serializer_class
+        queryset = serializer_class.values(self.filter_queryset(self.get_queryset()))
+        context = self.get_serializer_context()
+
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(serializer_class(page, context=context).data)
+        return response.Response(serializer_class(queryset, context=context).data)
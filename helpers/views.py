@@ -0,0 +1,61 @@
+import os
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.http import FileResponse, HttpResponse, JsonResponse
+
+from helpers import metrics, signed_urls
+
+
+def metrics_view(request):
+    """
+    Prometheus scrape endpoint. Merges the metrics of every worker process when settings.METRICS_DIR is set.
+    """
+    return HttpResponse(metrics.registry.exposition(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+def signed_media_view(request, name):
+    """
+    Serves a media file from a URL created by helpers.signed_urls.make_signed_url(). Only the signature and the
+    expiry are checked, no database query is made (except to find the files archived in pack files).
+    Depending on settings.MEDIA_SERVE_MODE the file is handed over to the web server ('x-accel-redirect' for nginx,
+    'x-sendfile' for apache/lighttpd) so the worker doesn't carry the bytes, or streamed by django ('').
+    Files archived in pack files are always streamed by django.
+    """
+    if request.method not in ("GET", "HEAD"):
+        return JsonResponse({"error": "Method not allowed."}, status=405)
+    if not signed_urls.verify(name, request.GET.get("expires"), request.GET.get("signature")):
+        return JsonResponse({"error": "Invalid or expired download URL."}, status=403)
+
+    try:
+        path = default_storage.path(name)
+    except Exception:
+        return JsonResponse({"error": "File not found."}, status=404)
+    is_loose = os.path.isfile(path)
+    if not is_loose and not default_storage.exists(name):
+        return JsonResponse({"error": "File not found."}, status=404)
+
+    serve_mode = getattr(settings, "MEDIA_SERVE_MODE", "")
+    file_name = os.path.basename(name)
+    if not is_loose:
+        """
+        archived in a pack file (see documents.packs), the web server can't serve it, it's streamed from the pack.
+        """
+        file_obj = default_storage.open(name, "rb")
+        response = FileResponse(file_obj.file)
+        response["Content-Length"] = file_obj.size
+        metrics.DOWNLOAD_BYTES.inc(file_obj.size)
+    elif serve_mode == "x-accel-redirect":
+        response = HttpResponse()
+        response["X-Accel-Redirect"] = f"{settings.MEDIA_ACCEL_REDIRECT_PREFIX}{name}"
+        del response["Content-Type"]
+    elif serve_mode == "x-sendfile":
+        response = HttpResponse()
+        response["X-Sendfile"] = path
+        del response["Content-Type"]
+    else:
+        response = FileResponse(open(path, "rb"))
+        metrics.DOWNLOAD_BYTES.inc(os.path.getsize(path))
+    response["Content-Disposition"] = f"attachment; filename={file_name}"
+    response["Cache-Control"] = "private, max-age=0"
+    return response
@@ -0,0 +1,54 @@
+import io
+import zipfile
+
+CHUNK_SIZE = 64 * 1024
+
+
+class StreamBuffer(io.RawIOBase):
+    """
+    Unseekable file object collecting what zipfile writes, emptied by the generator after every chunk. zipfile
+    writes a data descriptor after every entry when the output isn't seekable, so nothing has to be rewritten.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def pop(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def zip_stream(files, compression=zipfile.ZIP_DEFLATED, open_file=None):
+    """
+    Generator of a ZIP archive of the files, built while it's sent. Only one chunk of a file is held in memory at
+    a time and nothing is staged on disk.
+    files[iterable]: (name in the archive, path) tuples
+    open_file[callable]: opens the second item of the tuples in binary mode (eg. storage.open with storage names),
+                         the paths are opened with open() by default
+    """
+    open_file = open_file or (lambda path: open(path, "rb"))
+    buffer = StreamBuffer()
+    with zipfile.ZipFile(buffer, "w", compression=compression, allowZip64=True) as archive:
+        for name, path in files:
+            with open_file(path) as infile, archive.open(name, "w", force_zip64=True) as entry:
+                for chunk in iter(lambda: infile.read(CHUNK_SIZE), b""):
+                    entry.write(chunk)
+                    if buffer.chunks:
+                        yield buffer.pop()
+            if buffer.chunks:
+                yield buffer.pop()
+    if buffer.chunks:
+        yield buffer.pop()
@@ -0,0 +1,240 @@
+import csv
+import io
+import json
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.conf import settings
+from django.contrib.auth.base_user import BaseUserManager
+from django.contrib.auth.hashers import make_password
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+
+from users.models import User
+from users.serializers import RegisterSerializer
+
+"""
+Bulk import of users from CSV (header: username,email,first_name,last_name,password) or NDJSON (one object with
+the same keys per line).
+Rows are validated like the registration API, but the uniqueness of the usernames and emails is checked with one
+query per batch, the passwords are hashed in a process pool and the users are inserted with bulk_create.
+Every row gets an entry in the report: {"row": 1, "username": "...", "status": "created" | "invalid" | "duplicate",
+"errors": {...}}.
+"""
+FORMAT_CSV = "csv"
+FORMAT_NDJSON = "ndjson"
+
+STATUS_CREATED = "created"
+STATUS_INVALID = "invalid"
+STATUS_DUPLICATE = "duplicate"
+STATUS_VALID = "valid"
+
+
+class ImportRowSerializer(RegisterSerializer):
+    """
+    Registration serializer without the uniqueness queries, they're run for the whole batch.
+    """
+
+    def validate_username(self, username):
+        return username
+
+    def validate_email(self, email):
+        return email
+
+
+def detect_format(file_name):
+    return FORMAT_NDJSON if file_name.lower().endswith((".ndjson", ".jsonl", ".json")) else FORMAT_CSV
+
+
+def read_rows(stream, file_format):
+    """
+    Iterator over the (row number, row dict) of a text stream. Rows that can't be parsed are returned as None.
+    """
+    if file_format == FORMAT_CSV:
+        for number, row in enumerate(csv.DictReader(stream), 1):
+            yield number, row
+        return
+    for number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+        yield number, row if isinstance(row, dict) else None
+
+
+def get_executor(workers):
+    """
+    Process pool hashing the passwords. The workers are spawned (python 3.7+) so they don't inherit the database
+    connections and threads of the caller, and set django up to read the password hasher settings.
+    """
+    if sys.version_info < (3, 7):
+        return ProcessPoolExecutor(max_workers=workers)
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                               initializer=django.setup)
+
+
+class UserImporter:
+    """
+    Importing the rows in batches of batch_size.
+    workers[int]: processes hashing the passwords (settings.USER_IMPORT_HASH_WORKERS or the cpu count by default)
+    dry_run[bool]: only validate the rows, nothing is inserted
+    """
+
+    def __init__(self, batch_size=1000, workers=None, dry_run=False):
+        self.batch_size = batch_size
+        self.workers = workers or getattr(settings, "USER_IMPORT_HASH_WORKERS", None) or os.cpu_count() or 1
+        self.dry_run = dry_run
+        self.report = []
+        self.seen_usernames = set()
+        self.seen_emails = set()
+
+    def import_rows(self, rows):
+        """
+        rows[iterable]: (row number, row dict) tuples, eg. from read_rows()
+        Returns the report.
+        """
+        executor = get_executor(self.workers) if not self.dry_run else None
+        try:
+            batch = []
+            for number, row in rows:
+                batch.append((number, row))
+                if len(batch) >= self.batch_size:
+                    self.import_batch(batch, executor)
+                    batch = []
+            if batch:
+                self.import_batch(batch, executor)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        return self.report
+
+    def summary(self):
+        counts = {}
+        for entry in self.report:
+            counts[entry["status"]] = counts.get(entry["status"], 0) + 1
+        return counts
+
+    def validate_batch(self, batch):
+        """
+        Returns the report entries of the batch and the validated data of the valid rows (by report entry index).
+        """
+        entries, valid = [], {}
+        for number, row in batch:
+            entry = {"row": number, "username": (row or {}).get("username"), "status": STATUS_VALID, "errors": {}}
+            entries.append(entry)
+            if row is None:
+                entry.update(status=STATUS_INVALID, errors={"row": ["Unable to parse the row."]})
+                continue
+            serializer = ImportRowSerializer(data=row)
+            if not serializer.is_valid():
+                entry.update(status=STATUS_INVALID, errors=serializer.errors)
+                continue
+            data = dict(serializer.validated_data)
+            data["email"] = BaseUserManager.normalize_email(data["email"])
+            valid[len(entries) - 1] = data
+
+        """
+        duplicates within the file and then with the existing users, with a single query.
+        """
+        for index, data in list(valid.items()):
+            errors = {}
+            if data["username"] in self.seen_usernames:
+                errors["username"] = ["Username is repeated in the file."]
+            if data["email"] in self.seen_emails:
+                errors["email"] = ["Email is repeated in the file."]
+            self.seen_usernames.add(data["username"])
+            self.seen_emails.add(data["email"])
+            if errors:
+                entries[index].update(status=STATUS_DUPLICATE, errors=errors)
+                del valid[index]
+        self.mark_existing(entries, valid)
+        return entries, valid
+
+    @staticmethod
+    def mark_existing(entries, valid):
+        if not valid:
+            return
+        usernames = {data["username"] for data in valid.values()}
+        emails = {data["email"] for data in valid.values()}
+        existing_usernames, existing_emails = set(), set()
+        for username, email in User.objects.filter(Q(username__in=usernames) | Q(email__in=emails))\
+                .values_list("username", "email"):
+            existing_usernames.add(username)
+            existing_emails.add(email)
+
+        for index, data in list(valid.items()):
+            errors = {}
+            if data["username"] in existing_usernames:
+                errors["username"] = ["Username already exists."]
+            if data["email"] in existing_emails:
+                errors["email"] = ["Email already exists"]
+            if errors:
+                entries[index].update(status=STATUS_DUPLICATE, errors=errors)
+                del valid[index]
+
+    def import_batch(self, batch, executor):
+        entries, valid = self.validate_batch(batch)
+        self.report.extend(entries)
+        if self.dry_run or not valid:
+            return
+
+        indexes = list(valid)
+        passwords = executor.map(make_password, [valid[index].pop("password") for index in indexes],
+                                 chunksize=max(len(indexes) // (self.workers * 4), 1))
+        users = [User(password=password, **valid[index]) for index, password in zip(indexes, passwords)]
+        try:
+            with transaction.atomic():
+                User.objects.bulk_create(users)
+        except IntegrityError:
+            """
+            a user with the same username was created meanwhile, checking the batch again and inserting the rest.
+            """
+            self.mark_existing(entries, valid)
+            users = [user for index, user in zip(indexes, users) if index in valid]
+            indexes = [index for index in indexes if index in valid]
+            try:
+                with transaction.atomic():
+                    User.objects.bulk_create(users)
+            except IntegrityError:
+                """
+                still racing with other inserts, inserting the users one by one and marking the ones that conflict.
+                """
+                indexes, users = self.insert_one_by_one(entries, valid, indexes, users)
+
+        for index, user in zip(indexes, users):
+            entries[index].update(status=STATUS_CREATED, id=user.id)
+
+    @staticmethod
+    def insert_one_by_one(entries, valid, indexes, users):
+        """
+        Returns the indexes and the users that were inserted.
+        """
+        inserted = []
+        for index, user in zip(indexes, users):
+            try:
+                with transaction.atomic():
+                    user.save(force_insert=True)
+            except IntegrityError:
+                entries[index].update(status=STATUS_DUPLICATE, errors={"username": ["Username already exists."]})
+                del valid[index]
+                continue
+            inserted.append((index, user))
+        return [index for index, _ in inserted], [user for _, user in inserted]
+
+
+def import_file(stream, file_format, **options):
+    """
+    Importing a text stream, returns the importer (report and summary).
+    """
+    importer = UserImporter(**options)
+    importer.import_rows(read_rows(stream, file_format))
+    return importer
+
+
+def text_stream(uploaded_file):
+    return io.TextIOWrapper(uploaded_file, encoding="utf-8-sig", newline="")
@@ -0,0 +1,50 @@
+import json
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from users import importer
+
+
+class Command(BaseCommand):
+    help = "Import users from a CSV (username,email,first_name,last_name,password) or NDJSON file. Uniqueness is " \
+           "checked per batch, passwords are hashed in a process pool and users are inserted with bulk_create."
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="CSV or NDJSON file ('-' for stdin)")
+        parser.add_argument("--format", choices=(importer.FORMAT_CSV, importer.FORMAT_NDJSON),
+                            help="file format, guessed from the extension by default")
+        parser.add_argument("--batch-size", type=int, default=1000, help="users inserted per batch")
+        parser.add_argument("--workers", type=int, help="password hashing processes (cpu count by default)")
+        parser.add_argument("--report", help="write the per row report as NDJSON to this path")
+        parser.add_argument("--dry-run", action="store_true", help="only validate the rows")
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        file_format = options["format"] or importer.detect_format(path)
+        started = time.perf_counter()
+        try:
+            if path == "-":
+                result = importer.import_file(sys.stdin, file_format, batch_size=options["batch_size"],
+                                              workers=options["workers"], dry_run=options["dry_run"])
+            else:
+                with open(path, "r", encoding="utf-8-sig", newline="") as infile:
+                    result = importer.import_file(infile, file_format, batch_size=options["batch_size"],
+                                                  workers=options["workers"], dry_run=options["dry_run"])
+        except OSError as e:
+            raise CommandError(f"Unable to read {path}: {e}")
+
+        if options["report"]:
+            with open(options["report"], "w") as outfile:
+                for entry in result.report:
+                    outfile.write(json.dumps(entry) + "\n")
+        else:
+            for entry in result.report:
+                if entry["status"] not in (importer.STATUS_CREATED, importer.STATUS_VALID):
+                    self.stderr.write(f"row {entry['row']} ({entry['username']}): {entry['status']} "
+                                      f"{json.dumps(entry['errors'])}")
+
+        summary = ", ".join(f"{status}: {count}" for status, count in sorted(result.summary().items()))
+        self.stdout.write(f"Processed {len(result.report)} rows in {time.perf_counter() - started:.2f}s "
+                          f"({summary or 'no rows'}).")
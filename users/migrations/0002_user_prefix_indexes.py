@@ -0,0 +1,38 @@
+from django.db import migrations
+
+"""
+Prefix indexes of the user autocomplete (istartswith on username, email, first_name and last_name). Django runs
+istartswith as UPPER(column::text) LIKE UPPER('prefix%') on postgresql, which can only use an expression index with
+text_pattern_ops. The other databases don't need them.
+"""
+PREFIX_INDEX_COLUMNS = ('username', 'email', 'first_name', 'last_name')
+
+
+def create_prefix_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for column in PREFIX_INDEX_COLUMNS:
+        schema_editor.execute(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS users_user_{column}_upper_prefix_idx '
+                              f'ON users_user (UPPER({column}::text) text_pattern_ops)')
+
+
+def drop_prefix_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for column in PREFIX_INDEX_COLUMNS:
+        schema_editor.execute(f'DROP INDEX CONCURRENTLY IF EXISTS users_user_{column}_upper_prefix_idx')
+
+
+class Migration(migrations.Migration):
+    """
+    not atomic, indexes are created CONCURRENTLY so the users table isn't locked.
+    """
+    atomic = False
+
+    dependencies = [
+        ('users', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_prefix_indexes, drop_prefix_indexes),
+    ]
@@ -1,4 +1,5 @@
 from django.db import models
+from django.db.models import F
 from django.contrib.auth.models import AbstractBaseUser
 from rest_framework_jwt.settings import api_settings
 from users.managers import UserManager
@@ -13,12 +14,15 @@ class User(AbstractBaseUser):
     username[string]:
     email[email]:
     created_on[datetime]: datetime when this object is created
+    storage_bytes[int]: bytes of the files of the documents owned by the user, maintained with the document
+                        counters (see documents.usage)
     """
     first_name = models.CharField(max_length=56)
     last_name = models.CharField(max_length=56)
     username = models.CharField(max_length=56, unique=True)
     email = models.EmailField(max_length=128)
     created_on = models.DateTimeField(auto_now_add=True)
+    storage_bytes = models.BigIntegerField(default=0)
 
     USERNAME_FIELD = 'username'
 
@@ -39,6 +43,21 @@ class User(AbstractBaseUser):
         user_info["full_name"] = self.fullname
         return user_info
 
+    @staticmethod
+    def add_storage_bytes(user_id, storage_bytes, quota=None):
+        """
+        Adding storage_bytes (negative to release) to the storage usage of the user, with a single UPDATE.
+        quota[int]: the bytes are only added if the usage stays within the quota, checked by the UPDATE itself so
+                    concurrent uploads can't go over it together.
+        Returns False when the quota would be exceeded.
+        """
+        if user_id is None or not storage_bytes:
+            return True
+        users = User.objects.filter(id=user_id)
+        if quota is not None and storage_bytes > 0:
+            users = users.filter(storage_bytes__lte=quota - storage_bytes)
+        return users.update(storage_bytes=F("storage_bytes") + storage_bytes) == 1
+
     @property
     def fullname(self):
         """
@@ -46,9 +65,11 @@ class User(AbstractBaseUser):
         """
         return f"{self.first_name} {self.last_name}"
 
-    def get_jwt_token_for_user(self):
+    def get_jwt_token_for_user(self, orig_iat=None):
         """
         get jwt token for the user
+        orig_iat[int]: issue time of the first token of the session, kept when a token is refreshed so that the
+                       session can't be refreshed forever.
         """
         jwt_payload_handler = api_settings.JWT_PAYLOAD_HANDLER
         jwt_encode_handler = api_settings.JWT_ENCODE_HANDLER
@@ -57,6 +78,8 @@ class User(AbstractBaseUser):
             "user_id": self.id,
             "user_email": self.email,
         })
+        if orig_iat is not None:
+            payload["orig_iat"] = orig_iat
 
         token = jwt_encode_handler(payload)
         return token
@@ -1,6 +1,10 @@
+from calendar import timegm
+import datetime
+import jwt
 from rest_framework import serializers
+from rest_framework_jwt.settings import api_settings
+from helpers.values_serializers import ValuesSerializer
 from .models import User
-from django.contrib.auth import authenticate
 
 
 class UserCreateSerializer(serializers.ModelSerializer):
@@ -10,6 +14,7 @@ class UserCreateSerializer(serializers.ModelSerializer):
     class Meta:
         model = User
         exclude = ("created_on", "last_login",)
+        read_only_fields = ("storage_bytes",)
 
 
 class UserUpdateSerializer(serializers.ModelSerializer):
@@ -18,7 +23,7 @@ class UserUpdateSerializer(serializers.ModelSerializer):
     """
     class Meta:
         model = User
-        exclude = ("password", "last_login", "created_on")
+        exclude = ("password", "last_login", "created_on", "storage_bytes")
 
 
 class UserListSerializer(serializers.ModelSerializer):
@@ -40,6 +45,20 @@ class UserMinimalListSerializer(serializers.ModelSerializer):
         fields = ('id', 'email', 'username')
 
 
+class UserListValuesSerializer(ValuesSerializer):
+    """
+    values() serializer of the user list, same output as UserListSerializer
+    """
+    serializer_class = UserListSerializer
+
+
+class UserMinimalListValuesSerializer(ValuesSerializer):
+    """
+    values() serializer with the same output as UserMinimalListSerializer
+    """
+    serializer_class = UserMinimalListSerializer
+
+
 class PasswordResetSerializer(serializers.Serializer):
     """
     Password reset serializer for the POST action
@@ -75,19 +94,53 @@ class LoginSerializer(serializers.Serializer):
 
     def validate(self, attrs):
         """
-        Check whether the username is valid or not.
+        Check whether the username and the password are valid or not. The user is fetched once and returned in
+        the validated data, so the view doesn't need to fetch it again.
         """
-        try:
-            user_obj = User.objects.filter(username=attrs.get('username'))
-            assert user_obj
-        except AssertionError:
+        user_obj = User.objects.filter(username=attrs.get('username')).first()
+        if not user_obj:
             raise serializers.ValidationError("Invalid Username.")
 
-        user_obj = authenticate(username=attrs.get('username'), password=attrs.get('password'))
+        if not user_obj.is_active or not user_obj.check_password(attrs.get('password')):
+            raise serializers.ValidationError("Invalid username/password or user doesn't exist")
 
-        if not user_obj:
+        attrs['user'] = user_obj
+        return attrs
+
+
+class TokenRefreshSerializer(serializers.Serializer):
+    """
+    Token refresh serializer used for the POST action
+    """
+
+    token = serializers.CharField()
+
+    def validate(self, attrs):
+        """
+        Check whether the token is valid and whether it's still inside its refresh window, which starts when the
+        user logged in with the password (orig_iat) and lasts JWT_REFRESH_EXPIRATION_DELTA.
+        """
+        try:
+            payload = api_settings.JWT_DECODE_HANDLER(attrs.get('token'))
+        except jwt.ExpiredSignature:
+            raise serializers.ValidationError("Token has expired.")
+        except jwt.InvalidTokenError:
+            raise serializers.ValidationError("Invalid token.")
+
+        orig_iat = payload.get('orig_iat')
+        if not orig_iat:
+            raise serializers.ValidationError("Token can't be refreshed.")
+
+        refresh_limit = orig_iat + int(api_settings.JWT_REFRESH_EXPIRATION_DELTA.total_seconds())
+        if timegm(datetime.datetime.utcnow().utctimetuple()) > refresh_limit:
+            raise serializers.ValidationError("Refresh has expired. Login again.")
+
+        user_obj = User.objects.filter(id=payload.get('user_id')).first()
+        if not user_obj or not user_obj.is_active:
             raise serializers.ValidationError("Invalid username/password or user doesn't exist")
 
+        attrs['user'] = user_obj
+        attrs['orig_iat'] = orig_iat
         return attrs
 
 
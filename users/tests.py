@@ -1,3 +1,242 @@
+import datetime
+import io
+from calendar import timegm
+from unittest import mock
+
+import jwt
 from django.test import TestCase
+from rest_framework_jwt.settings import api_settings
+from rest_framework.renderers import JSONRenderer
+
+from helpers.testing import QueryBudgetMixin, auth_header
+from users import importer, views
+from users.models import User
+from users.serializers import UserListSerializer, UserListValuesSerializer, UserMinimalListSerializer,\
+    UserMinimalListValuesSerializer
+
+
+class ValuesSerializerTestCase(TestCase):
+    """
+    The values() serializers of the users must render the same JSON as the serializers they replace.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        user = User.objects.create_user(username="first_user", email="first@example.com", first_name="First",
+                                        last_name="User", password="password")
+        User.objects.filter(id=user.id).update(last_login=user.created_on)
+        User.objects.create_user(username="second_user", email="second@example.com", first_name="Second",
+                                 last_name="Üser", password="password")
+
+    def render(self, data):
+        return JSONRenderer().render(data)
+
+    def test_user_list(self):
+        queryset = User.objects.order_by("-created_on")
+        with self.assertNumQueries(1):
+            data = UserListValuesSerializer(UserListValuesSerializer.values(queryset)).data
+        self.assertEqual(self.render(data), self.render(UserListSerializer(queryset, many=True).data))
+
+    def test_user_minimal_list(self):
+        queryset = User.objects.order_by("username")
+        self.assertEqual(self.render(UserMinimalListValuesSerializer(UserMinimalListValuesSerializer.values(queryset))
+                                     .data),
+                         self.render(UserMinimalListSerializer(queryset, many=True).data))
+
+
+class QueryBudgetTestCase(QueryBudgetMixin, TestCase):
+    """
+    The user APIs must stay within the query budgets declared on their views.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username="budget_user", email="budget@example.com", first_name="Budget",
+                                            last_name="User", password="password")
+        for index in range(5):
+            User.objects.create_user(username=f"budget_other_{index}", email=f"other_{index}@example.com",
+                                     first_name="Other", last_name="User", password="password")
+
+    def test_autocomplete(self):
+        with self.assertWithinQueryBudget(views.UserAutocompleteView, "GET"):
+            api_response = self.client.get("/api/v1/user-autocomplete/", {"q": "budget_"}, **auth_header(self.user))
+        self.assertEqual(len(api_response.json()), 6)
+
+    def test_login_and_token_refresh(self):
+        with self.assertWithinQueryBudget(views.LoginView, "POST"):
+            api_response = self.client.post("/api/v1/login/", {"username": "budget_user", "password": "password"})
+        self.assertEqual(api_response.status_code, 200, api_response.content)
+
+        with self.assertWithinQueryBudget(views.TokenRefreshView, "POST"):
+            api_response = self.client.post("/api/v1/token-refresh/", {"token": api_response.json()["auth_token"]})
+        self.assertEqual(api_response.status_code, 200, api_response.content)
+
+
+class TokenRefreshTestCase(TestCase):
+    """
+    Login with a single user lookup, and the token refresh window: JWT_REFRESH_EXPIRATION_DELTA after the login
+    (orig_iat), kept by every refreshed token.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username="refresh_user", email="refresh@example.com", first_name="Refresh",
+                                            last_name="User", password="password")
+
+    @staticmethod
+    def now():
+        return timegm(datetime.datetime.utcnow().utctimetuple())
+
+    @staticmethod
+    def decode(token):
+        return api_settings.JWT_DECODE_HANDLER(token)
+
+    def refresh(self, token):
+        return self.client.post("/api/v1/token-refresh/", {"token": token})
+
+    def test_login(self):
+        api_response = self.client.post("/api/v1/login/", {"username": "refresh_user", "password": "password"})
+        self.assertEqual(api_response.status_code, 200, api_response.content)
+        payload = self.decode(api_response.json()["auth_token"])
+        self.assertEqual(payload["user_id"], self.user.id)
+        self.assertAlmostEqual(payload["orig_iat"], self.now(), delta=5)
+        self.user.refresh_from_db()
+        self.assertIsNotNone(self.user.last_login)
+
+        for username, password in (("refresh_user", "wrong"), ("nobody", "password")):
+            self.assertEqual(self.client.post("/api/v1/login/", {"username": username, "password": password})
+                             .status_code, 400)
+
+    def test_refresh_keeps_orig_iat(self):
+        orig_iat = self.now() - 3600
+        api_response = self.refresh(self.user.get_jwt_token_for_user(orig_iat=orig_iat))
+        self.assertEqual(api_response.status_code, 200, api_response.content)
+        token = api_response.json()["auth_token"]
+        self.assertEqual(self.decode(token)["orig_iat"], orig_iat)
+        self.assertEqual(self.decode(token)["user_id"], self.user.id)
+
+        api_response = self.refresh(token)
+        self.assertEqual(api_response.status_code, 200, api_response.content)
+        self.assertEqual(self.decode(api_response.json()["auth_token"])["orig_iat"], orig_iat)
+
+    def test_refresh_window(self):
+        window = int(api_settings.JWT_REFRESH_EXPIRATION_DELTA.total_seconds())
+        inside = self.user.get_jwt_token_for_user(orig_iat=self.now() - window + 60)
+        self.assertEqual(self.refresh(inside).status_code, 200)
+
+        api_response = self.refresh(self.user.get_jwt_token_for_user(orig_iat=self.now() - window - 60))
+        self.assertEqual(api_response.status_code, 400)
+        self.assertIn("Refresh has expired. Login again.", api_response.json()["non_field_errors"])
+
+    def test_invalid_tokens(self):
+        payload = api_settings.JWT_PAYLOAD_HANDLER(self.user)
+        payload["exp"] = datetime.datetime.utcnow() - datetime.timedelta(seconds=60)
+        expired = api_settings.JWT_ENCODE_HANDLER(payload)
+        self.assertIn("Token has expired.", self.refresh(expired).json()["non_field_errors"])
+
+        payload = api_settings.JWT_PAYLOAD_HANDLER(self.user)
+        del payload["orig_iat"]
+        self.assertIn("Token can't be refreshed.",
+                      self.refresh(api_settings.JWT_ENCODE_HANDLER(payload)).json()["non_field_errors"])
+
+        forged = jwt.encode(api_settings.JWT_PAYLOAD_HANDLER(self.user), "another secret", algorithm="HS256")
+        forged = forged.decode() if isinstance(forged, bytes) else forged
+        self.assertIn("Invalid token.", self.refresh(forged).json()["non_field_errors"])
+        self.assertEqual(self.refresh("not a token").status_code, 400)
+
+        deleted = User.objects.create_user(username="deleted_user", email="deleted@example.com", first_name="Deleted",
+                                           last_name="User", password="password")
+        token = deleted.get_jwt_token_for_user()
+        deleted.delete()
+        self.assertEqual(self.refresh(token).status_code, 400)
+
+
+class UserImportTestCase(TestCase):
+    """
+    Bulk user import: invalid rows, duplicates within the file and with the existing users, and the users created
+    by another request while a batch is imported.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        User.objects.create_user(username="existing_user", email="existing@example.com", first_name="Existing",
+                                 last_name="User", password="password")
+
+    @staticmethod
+    def csv(*usernames, **overrides):
+        lines = ["username,email,first_name,last_name,password"]
+        for username in usernames:
+            row = {"email": f"{username}@example.com", "first_name": "Imported", "last_name": "User",
+                   "password": "secret password"}
+            row.update(overrides.get(username, {}))
+            lines.append(",".join([username, row["email"], row["first_name"], row["last_name"], row["password"]]))
+        return io.StringIO("\n".join(lines) + "\n")
+
+    def import_csv(self, stream, **options):
+        result = importer.import_file(stream, importer.FORMAT_CSV, workers=1, **options)
+        return {entry["username"]: entry for entry in result.report}, result
+
+    def test_import(self):
+        stream = self.csv("first_user", "second_user", "first_user", "existing_user", "third_user", "short",
+                          "fourth_user", "fifth_user", "sixth_user",
+                          third_user={"email": "second_user@example.com"}, fourth_user={"email": "not an email"},
+                          fifth_user={"password": "123"}, sixth_user={"email": "existing@example.com"})
+        report, result = self.import_csv(stream)
+        self.assertEqual(result.summary(), {"created": 2, "duplicate": 4, "invalid": 3})
+
+        self.assertEqual(report["first_user"]["status"], "duplicate")
+        self.assertEqual(report["first_user"]["errors"], {"username": ["Username is repeated in the file."],
+                                                          "email": ["Email is repeated in the file."]})
+        self.assertEqual(report["third_user"]["errors"], {"email": ["Email is repeated in the file."]})
+        self.assertEqual(report["existing_user"]["errors"], {"username": ["Username already exists."]})
+        self.assertEqual(report["sixth_user"]["errors"], {"email": ["Email already exists"]})
+        for username, field in (("short", "username"), ("fourth_user", "email"), ("fifth_user", "password")):
+            self.assertEqual(report[username]["status"], "invalid")
+            self.assertIn(field, report[username]["errors"])
+
+        self.assertEqual([entry["row"] for entry in result.report], list(range(1, 10)))
+        self.assertEqual(set(User.objects.filter(last_name="User", first_name="Imported")
+                             .values_list("username", flat=True)), {"first_user", "second_user"})
+        self.assertTrue(User.objects.get(username="second_user").check_password("secret password"))
+
+    def test_dry_run_and_unparsable_rows(self):
+        _, result = self.import_csv(self.csv("dry_run_user", "existing_user"), dry_run=True)
+        self.assertEqual(result.summary(), {"valid": 1, "duplicate": 1})
+        self.assertFalse(User.objects.filter(username="dry_run_user").exists())
+
+        stream = io.StringIO('{"username": "ndjson_user", "email": "ndjson@example.com", "first_name": "N", '
+                             '"last_name": "J", "password": "secret password"}\nnot json\n[1, 2]\n')
+        result = importer.import_file(stream, importer.FORMAT_NDJSON, workers=1)
+        self.assertEqual([entry["status"] for entry in result.report], ["created", "invalid", "invalid"])
+
+    def racing_inserts(self, *usernames_by_call):
+        """
+        mark_existing creating the users of usernames_by_call[n] right after its n-th call, like concurrent imports.
+        """
+        mark_existing = importer.UserImporter.mark_existing
+        calls = iter(usernames_by_call)
+
+        def racing(entries, valid):
+            mark_existing(entries, valid)
+            for username in next(calls, ()):
+                User.objects.create_user(username=username, email=f"other_{username}@example.com",
+                                         first_name="Racing", last_name="User", password="password")
+        return mock.patch.object(importer.UserImporter, "mark_existing", side_effect=racing)
+
+    def test_retry_after_concurrent_insert(self):
+        with self.racing_inserts(["racer_one"]):
+            report, result = self.import_csv(self.csv("racer_one", "calm_user_1", "calm_user_2"))
+        self.assertEqual(result.summary(), {"created": 2, "duplicate": 1})
+        self.assertEqual(report["racer_one"]["errors"], {"username": ["Username already exists."]})
+        self.assertEqual(User.objects.get(username="racer_one").first_name, "Racing")
+        self.assertTrue(User.objects.filter(username="calm_user_2").exists())
 
-# Create your tests here.
+    def test_row_by_row_after_second_conflict(self):
+        with self.racing_inserts(["racer_one"], ["racer_two"]):
+            report, result = self.import_csv(self.csv("racer_one", "calm_user_1", "racer_two", "calm_user_2"))
+        self.assertEqual(result.summary(), {"created": 2, "duplicate": 2})
+        self.assertEqual(report["racer_two"]["status"], "duplicate")
+        self.assertEqual(report["calm_user_2"]["status"], "created")
+        self.assertIsNotNone(report["calm_user_2"]["id"])
+        self.assertEqual(User.objects.get(username="racer_two").first_name, "Racing")
+        self.assertTrue(User.objects.get(username="calm_user_1").check_password("secret password"))
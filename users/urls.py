@@ -10,5 +10,8 @@ urlpatterns = [
     url(r'^', include(router.urls)),
     url(r'^register/$', apis.UserRegistrationView.as_view(), name="user-registration"),
     url(r'^login/$', apis.LoginView.as_view(), name="user-login"),
+    url(r'^token-refresh/$', apis.TokenRefreshView.as_view(), name="token-refresh"),
+    url(r'^user-autocomplete/$', apis.UserAutocompleteView.as_view(), name="user-autocomplete"),
+    url(r'^user-import/$', apis.UserImportView.as_view(), name="user-import"),
     url(r'^reset-password/$', apis.PasswordResetView.as_view(), name="change-password"),
 ]
\ No newline at end of file
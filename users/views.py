@@ -1,20 +1,26 @@
 from rest_framework import (response, status, views, exceptions,
                             viewsets, filters, generics)
+from django.conf import settings
 from django.utils import timezone
 import django_filters
+from . import importer
 from .models import User
+from django.db.models import Q
 from rest_framework.pagination import LimitOffsetPagination
+from helpers.values_serializers import ValuesListModelMixin
 from .serializers import UserListSerializer, UserUpdateSerializer,\
     UserCreateSerializer, PasswordResetSerializer, RegisterSerializer,\
-    LoginSerializer
+    LoginSerializer, TokenRefreshSerializer, UserListValuesSerializer
 
 
-class UserView(viewsets.ModelViewSet):
+class UserView(ValuesListModelMixin, viewsets.ModelViewSet):
     """
     Basic User CRUD API
+    The list is serialized from queryset.values() (see helpers.values_serializers)
     """
     model = User
     queryset = User.objects.all()
+    values_serializer_class = UserListValuesSerializer
 
     pagination_class = LimitOffsetPagination
 
@@ -54,6 +60,56 @@ class UserView(viewsets.ModelViewSet):
             return response.Response(response_dict, status=status.HTTP_201_CREATED)
 
 
+class UserAutocompleteView(views.APIView):
+    """
+    User autocomplete API used to pick collaborators, meant to be called on every keystroke.
+    Returns the users whose username, email, first name or last name starts with ?q= (case insensitive), with
+    the UserMinimalListSerializer fields only. The lookups are served by the prefix indexes of the users table.
+    """
+    model = User
+    default_limit = 10
+    max_limit = 50
+    query_budget = 2
+
+    def get(self, request, *args, **kwargs):
+        prefix = request.query_params.get("q", "").strip()
+        try:
+            limit = max(1, min(int(request.query_params.get("limit", self.default_limit)), self.max_limit))
+        except ValueError:
+            raise exceptions.ValidationError("Invalid limit.")
+        if not prefix:
+            return response.Response([], status=status.HTTP_200_OK)
+
+        users = User.objects.filter(Q(username__istartswith=prefix) | Q(email__istartswith=prefix) |
+                                    Q(first_name__istartswith=prefix) | Q(last_name__istartswith=prefix))\
+            .order_by("username").values("id", "email", "username")[:limit]
+        return response.Response(list(users), status=status.HTTP_200_OK)
+
+
+class UserImportView(views.APIView):
+    """
+    Bulk user import API, restricted to the usernames in settings.USER_IMPORT_ADMINS.
+    Takes a multipart 'file' (CSV or NDJSON, see users.importer) and ?dry_run=true to only validate it.
+    Returns the summary and the report of every row, rows are imported even when others are invalid.
+    """
+    model = User
+
+    def post(self, request, *args, **kwargs):
+        if request.user.username not in getattr(settings, "USER_IMPORT_ADMINS", ()):
+            raise exceptions.PermissionDenied("Only the import admins can import users.")
+        uploaded_file = request.FILES.get("file")
+        if uploaded_file is None:
+            raise exceptions.ValidationError("A CSV or NDJSON file is required.")
+        file_format = request.query_params.get("format") or importer.detect_format(uploaded_file.name)
+        if file_format not in (importer.FORMAT_CSV, importer.FORMAT_NDJSON):
+            raise exceptions.ValidationError("Invalid format.")
+
+        result = importer.import_file(importer.text_stream(uploaded_file), file_format,
+                                      dry_run=request.query_params.get("dry_run") in ("1", "true"))
+        status_code = status.HTTP_200_OK if result.dry_run else status.HTTP_201_CREATED
+        return response.Response({"summary": result.summary(), "rows": result.report}, status=status_code)
+
+
 class PasswordResetView(generics.CreateAPIView):
     """
     User password reset API
@@ -94,15 +150,33 @@ class LoginView(generics.CreateAPIView):
     """
 
     serializer_class = LoginSerializer
+    query_budget = 2
 
     def post(self, request, *args, **kargs):
         serializer = self.get_serializer(data=request.data)
         if serializer.is_valid(raise_exception=True):
-            user = User.objects.get(username=serializer.validated_data.get("username"))
+            user = serializer.validated_data.get("user")
             auth_token = user.get_jwt_token_for_user()
             user.last_login = timezone.now()
-            user.save()
+            user.save(update_fields=["last_login"])
             response_dict = user.basic_user_info()
             response_dict["auth_token"] = auth_token
 
             return response.Response(response_dict, status=status.HTTP_200_OK)
+
+
+class TokenRefreshView(generics.CreateAPIView):
+    """
+    Token refresh API. Exchanges a valid token for a new one without the password, until the refresh window of
+    the session (JWT_REFRESH_EXPIRATION_DELTA after the login) is over.
+    """
+
+    serializer_class = TokenRefreshSerializer
+    query_budget = 1
+
+    def post(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        if serializer.is_valid(raise_exception=True):
+            user = serializer.validated_data.get("user")
+            auth_token = user.get_jwt_token_for_user(orig_iat=serializer.validated_data.get("orig_iat"))
+            return response.Response({"auth_token": auth_token}, status=status.HTTP_200_OK)